@@ -0,0 +1,333 @@
+"""Drives concurrent load against /tourguide, /query_assistant or /sam and reports
+latency percentiles, throughput and the server's event-loop lag. By default it starts
+the stubs of benchmarks/stubs.py and the app pointed at them, so it needs no network
+or API keys:
+
+    python -m benchmarks.load tourguide --requests 100 --concurrency 10
+    python -m benchmarks.load query_assistant --compare benchmarks/results/<earlier run>.json
+
+Results are written as JSON to benchmarks/results/.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterator, Optional
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.stubs import base_urls
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+IMAGES_DIR = ROOT / "imgs"
+LAT, LON = 41.906314680189425, 12.454854851168495
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+@contextmanager
+def server(app: str, port: int, env: dict[str, str], log: Path) -> Iterator[str]:
+    url = f"http://127.0.0.1:{port}"
+    with open(log, "w") as log_file:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", app, "--port", str(port), "--log-level", "warning"],
+            cwd=ROOT,
+            env={**os.environ, **env},
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            yield url
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def read_image(name: str) -> bytes:
+    return (IMAGES_DIR / name).read_bytes()
+
+
+def make_request(scenario: str, i: int, repeat: bool, run_id: str) -> dict[str, Any]:
+    """The i-th request of a run. Unless `repeat` is set, requests differ in location (and,
+    for /sam, in image bytes) so they miss the app's caches and don't coalesce."""
+    n = 0 if repeat else i
+    lat, lon = LAT + (n % 20) * 0.05, LON + (n // 20) * 0.05
+    if scenario == "tourguide":
+        return {
+            "method": "POST",
+            "url": "/tourguide",
+            "json": {
+                "base_image": base64.b64encode(read_image("dali.jpg")).decode(),
+                "masked_image": base64.b64encode(read_image("masked_dali.jpg")).decode(),
+                "lat": lat,
+                "lon": lon,
+            },
+        }
+    if scenario == "query_assistant":
+        return {
+            "method": "POST",
+            "url": "/query_assistant",
+            "json": {
+                "id": f"bench-{run_id}-{i}",
+                "lat": lat,
+                "lon": lon,
+                "query_type": "restaurant",
+                "query": "Somewhere for pizza tonight" + ("" if repeat else f" ({i})"),
+            },
+        }
+    if scenario == "sam":
+        # JPEG decoders ignore bytes after the end-of-image marker, so appending the
+        # index gives each request a distinct image hash without changing the image.
+        image = read_image("dali.jpg") + (b"" if repeat else str(i).encode())
+        clicks = [[300 + (n % 7) * 20, 250 + (n % 5) * 20]]
+        return {
+            "method": "POST",
+            "url": "/sam/raw",
+            "params": {"clicks": json.dumps(clicks), "format": "rle"},
+            "content": image,
+        }
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+async def send(client: httpx.AsyncClient, request: dict[str, Any]) -> dict[str, Any]:
+    started = time.perf_counter()
+    first_byte = None
+    size = 0
+    try:
+        async with client.stream(**request) as response:
+            async for chunk in response.aiter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                size += len(chunk)
+            status = response.status_code
+    except httpx.HTTPError as e:
+        return {"status": type(e).__name__, "latency": time.perf_counter() - started, "ttfb": None, "bytes": 0}
+    return {"status": status, "latency": time.perf_counter() - started, "ttfb": first_byte, "bytes": size}
+
+
+async def drive(url: str, requests: list[dict[str, Any]], concurrency: int, timeout: float) -> tuple[list, float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+
+        async def one(request: dict[str, Any]) -> dict[str, Any]:
+            async with semaphore:
+                return await send(client, request)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one(request) for request in requests))
+        return results, time.perf_counter() - started
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(values: list[float]) -> dict[str, Optional[float]]:
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def scrape_lag(url: str) -> dict[str, float]:
+    """The cumulative buckets, sum and count of the app's event-loop lag histogram."""
+    samples: dict[str, float] = {}
+    text = httpx.get(f"{url}/metrics", timeout=10).text
+    for family in text_string_to_metric_families(text):
+        if family.name != "swag_event_loop_lag_seconds":
+            continue
+        for sample in family.samples:
+            if sample.name.endswith("_bucket"):
+                samples[sample.labels["le"]] = sample.value
+            elif sample.name.endswith("_sum"):
+                samples["sum"] = sample.value
+            elif sample.name.endswith("_count"):
+                samples["count"] = sample.value
+    return samples
+
+
+def lag_between(before: dict[str, float], after: dict[str, float]) -> dict[str, Optional[float]]:
+    """Event-loop lag over the run. Percentiles are the upper bound of the histogram
+    bucket they fall in."""
+    count = after.get("count", 0) - before.get("count", 0)
+    if count <= 0:
+        return {"samples": 0, "mean": None, "p50_le": None, "p95_le": None, "p99_le": None}
+    buckets = sorted(
+        ((float(le), after[le] - before.get(le, 0)) for le in after if le not in ("sum", "count")),
+        key=lambda b: b[0],
+    )
+
+    def bound(q: float) -> float:
+        return next(le for le, cumulative in buckets if cumulative >= q / 100 * count)
+
+    return {
+        "samples": int(count),
+        "mean": (after["sum"] - before.get("sum", 0)) / count,
+        "p50_le": bound(50),
+        "p95_le": bound(95),
+        "p99_le": bound(99),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any]) -> None:
+    print(f"\nCompared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    if baseline.get("scenario") != current["scenario"] or baseline.get("config") != current["config"]:
+        print("  (the runs differ in scenario or configuration)")
+    for section in ("latency", "ttfb", "event_loop_lag"):
+        for key, value in current[section].items():
+            old = baseline.get(section, {}).get(key)
+            if key != "samples" and isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                print(f"  {section}.{key}: {old:.4f} -> {value:.4f} ({(value - old) / old:+.1%})")
+    old = baseline.get("throughput")
+    if old:
+        print(f"  throughput: {old:.2f} -> {current['throughput']:.2f} req/s ({(current['throughput'] - old) / old:+.1%})")
+
+
+def stub_env(args: argparse.Namespace) -> dict[str, str]:
+    return {
+        "STUB_LLM_FIRST_TOKEN": str(args.llm_first_token),
+        "STUB_LLM_CHUNK_INTERVAL": str(args.llm_chunk_interval),
+        "STUB_LLM_ANSWER_CHUNKS": str(args.llm_answer_chunks),
+        "STUB_LLM_TOOL_STEPS": str(args.llm_tool_steps),
+        "STUB_API_LATENCY": str(args.api_latency),
+    }
+
+
+def app_env(stubs_url: str, scenario: str) -> dict[str, str]:
+    return {
+        "OUTBOUND_BASE_URLS": base_urls(stubs_url),
+        "ANTHROPIC_API_KEY": "stub",
+        "GOOGLE_API_KEY": "AIza" + "0" * 35,
+        "JINAI_API_KEY": "stub",
+        "SAM_WARMUP": "1" if scenario == "sam" else "0",
+        "TOOL_CACHE_PATH": "",
+        "CONVERSATION_STORE_PATH": "",
+    }
+
+
+def run(args: argparse.Namespace, url: str) -> dict[str, Any]:
+    run_id = f"{int(time.time())}-{random.randrange(1 << 16):04x}"
+    requests = [make_request(args.scenario, i, args.repeat, run_id) for i in range(args.requests)]
+    for i in range(args.warmup):
+        asyncio.run(drive(url, [make_request(args.scenario, -1 - i, args.repeat, run_id)], 1, args.timeout))
+
+    lag_before = scrape_lag(url)
+    results, elapsed = asyncio.run(drive(url, requests, args.concurrency, args.timeout))
+    lag_after = scrape_lag(url)
+
+    ok = [r for r in results if r["status"] == 200]
+    statuses: dict[str, int] = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    return {
+        "scenario": args.scenario,
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "repeat": args.repeat,
+            "warmup": args.warmup,
+            "stubs": None if args.url else stub_env(args),
+            "url": args.url,
+        },
+        "elapsed": elapsed,
+        "throughput": len(ok) / elapsed,
+        "errors": len(results) - len(ok),
+        "statuses": statuses,
+        "latency": summarize([r["latency"] for r in ok]),
+        "ttfb": summarize([r["ttfb"] for r in ok if r["ttfb"] is not None]),
+        "response_bytes": summarize([r["bytes"] for r in ok]),
+        "event_loop_lag": lag_between(lag_before, lag_after),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=["tourguide", "query_assistant", "sam"])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1, help="Requests sent one at a time before measuring.")
+    parser.add_argument("--repeat", action="store_true", help="Send identical requests, to measure caching and coalescing.")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--url", help="Benchmark a server that is already running instead of starting the app and stubs.")
+    parser.add_argument("--llm-first-token", type=float, default=0.5)
+    parser.add_argument("--llm-chunk-interval", type=float, default=0.02)
+    parser.add_argument("--llm-answer-chunks", type=int, default=40)
+    parser.add_argument("--llm-tool-steps", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=0.1)
+    parser.add_argument("--out", type=Path, help="Where to write the results (default: benchmarks/results/).")
+    parser.add_argument("--compare", type=Path, help="Earlier results to compare with.")
+    args = parser.parse_args()
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    if args.url:
+        result = run(args, args.url.rstrip("/"))
+    else:
+        stubs_port, app_port = free_port(), free_port()
+        with server("benchmarks.stubs:app", stubs_port, stub_env(args), RESULTS_DIR / "stubs.log") as stubs_url:
+            wait_until_up(f"{stubs_url}/docs", 30)
+            with server("main:app", app_port, app_env(stubs_url, args.scenario), RESULTS_DIR / "app.log") as app_url:
+                wait_until_up(f"{app_url}/healthz", 120)
+                if args.scenario == "sam":
+                    wait_until_up(f"{app_url}/readyz", 600)
+                result = run(args, app_url)
+
+    out = args.out or RESULTS_DIR / f"{args.scenario}-{result['timestamp'].replace(':', '')}-{result['commit']}.json"
+    out.write_text(json.dumps(result, indent=2))
+    print(json.dumps({k: result[k] for k in ("throughput", "errors", "latency", "ttfb", "event_loop_lag")}, indent=2))
+    print(f"Results written to {out}")
+    if args.compare:
+        compare(result, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""Times each stage of a /sam request separately over the bundled images, at several
+resolutions and click counts, and reports per-stage latency and peak memory. Runs on
+CPU without network access, given the SAM2 checkpoint that swag/sam.py loads:
+
+    python -m benchmarks.sam_stages --sizes 512 1024 2048 --clicks 1 3 --repeats 5
+    python -m benchmarks.sam_stages --skip-model   # image decoding and rendering only
+
+Results are written as JSON to benchmarks/results/.
+"""
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Optional
+import argparse
+import base64
+import json
+import resource
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from benchmarks.load import IMAGES_DIR, RESULTS_DIR, git_commit, summarize
+from swag import sam
+
+
+def resized(path: Path, max_edge: int) -> bytes:
+    """The image scaled so its longest edge is `max_edge`, re-encoded in its own format."""
+    img = Image.open(path).convert("RGB")
+    scale = max_edge / max(img.size)
+    img = img.resize((round(img.width * scale), round(img.height * scale)), Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    if path.suffix == ".png":
+        img.save(buffer, format="PNG")
+    else:
+        img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_clicks(shape: tuple[int, ...], count: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    """`count` clicks in the middle half of the image, the same for the same seed."""
+    h, w = shape[:2]
+    rng = np.random.default_rng(seed)
+    coords = np.stack([rng.integers(w // 4, 3 * w // 4, count), rng.integers(h // 4, 3 * h // 4, count)], axis=1)
+    return coords, np.ones(count, dtype=int)
+
+
+def synthetic_mask(shape: tuple[int, ...], point_coords: np.ndarray) -> np.ndarray:
+    """An ellipse around the clicks, standing in for a model mask with --skip-model."""
+    h, w = shape[:2]
+    mask = np.zeros((h, w), dtype=np.uint8)
+    x, y = point_coords.mean(axis=0).astype(int)
+    cv2.ellipse(mask, (int(x), int(y)), (w // 6, h // 5), 0, 0, 360, 1, -1)
+    return mask.astype(bool)
+
+
+def stages(image_bytes: bytes, clicks: int, predictor, encoder, model_context) -> list[tuple[str, Callable[[], Any]]]:
+    """The stages of one request, in order. Each stage stores its output in `state` for
+    the stages after it."""
+    state: dict[str, Any] = {"b64": base64.b64encode(image_bytes).decode()}
+
+    def decode_image():
+        state["key"], state["pil_img"], state["img"] = sam.decode_image(image_bytes)
+        state["point_coords"], state["point_labels"] = make_clicks(state["img"].shape, clicks, seed=clicks)
+
+    def prepare():
+        with model_context():
+            state["batch"] = sam.prepare_images(predictor, [state["img"]])
+
+    def encode():
+        with model_context():
+            state["features"] = sam.encode_images(encoder, state["batch"])
+
+    def decode_masks():
+        with model_context():
+            state["mask"] = sam.decode_masks(
+                predictor, state["features"], [state["img"].shape[:2]], [state["point_coords"]], [state["point_labels"]]
+            )[0]
+
+    def synthetic():
+        state["mask"] = synthetic_mask(state["img"].shape, state["point_coords"])
+
+    def render():
+        state["composite"] = sam.render_mask(state["pil_img"], state["mask"], state["point_coords"], state["point_labels"])
+
+    result = [
+        ("b64decode", lambda: base64.b64decode(state["b64"])),
+        ("decode_image", decode_image),
+    ]
+    if predictor is None:
+        result.append(("synthetic_mask", synthetic))
+    else:
+        result += [("prepare", prepare), ("encode", encode), ("decode_masks", decode_masks)]
+    result += [
+        ("contours", lambda: sam.mask_contours(state["mask"], epsilon=0.01)),
+        ("render", render),
+        ("encode_jpeg", lambda: sam.encode_jpeg(state["composite"])),
+        ("encode_png", lambda: sam.encode_png(state["mask"])),
+        ("encode_rle", lambda: sam.encode_result(state["pil_img"], state["mask"], None, None, "rle")),
+        ("encode_polygons", lambda: sam.encode_result(state["pil_img"], state["mask"], None, None, "polygons")),
+    ]
+    return result
+
+
+# Stages that run the model. Their tensors are allocated by torch, which tracemalloc
+# doesn't see, so their peak is read from torch: the CUDA counters on GPU, the
+# profiler's memory records on CPU.
+MODEL_STAGES = {"prepare", "encode", "decode_masks"}
+
+
+def max_rss_mb() -> float:
+    """Peak resident set size of this process so far (kilobytes on Linux, bytes on macOS)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / 1024
+
+
+def cuda_peak() -> Optional[Callable[[], float]]:
+    """On CUDA, resets torch's peak memory counter and returns a function giving the peak
+    allocated since, in MB, above what was allocated at the reset."""
+    if sam.get_device() != "cuda":
+        return None
+    import torch
+
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    before = torch.cuda.memory_allocated()
+
+    def peak() -> float:
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - before) / (1 << 20)
+
+    return peak
+
+
+def cpu_peak_mb(stage: Callable[[], Any]) -> float:
+    """Runs `stage` under the torch profiler and returns the peak of the CPU memory torch
+    allocated during it, in MB, replaying the profiler's allocation and free records."""
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        stage()
+    records = sorted(
+        (event.start_ns(), event.nbytes())
+        for event in prof.profiler.kineto_results.events()
+        if event.name() == "[memory]" and event.device_type() == torch.autograd.DeviceType.CPU
+    )
+    current = peak = 0
+    for _, nbytes in records:
+        current += nbytes
+        peak = max(peak, current)
+    return peak / (1 << 20)
+
+
+def run_case(image_bytes: bytes, clicks: int, repeats: int, predictor, encoder, model_context) -> dict[str, Any]:
+    """Times every stage `repeats` times, then runs them once more to measure their peak
+    memory: tracemalloc for the image stages, torch's CUDA counters or profiler for the
+    model stages."""
+    timings: dict[str, list[float]] = {}
+    for _ in range(repeats):
+        for name, stage in stages(image_bytes, clicks, predictor, encoder, model_context):
+            started = time.perf_counter()
+            stage()
+            timings.setdefault(name, []).append(time.perf_counter() - started)
+
+    peaks: dict[str, Optional[float]] = {}
+    tracemalloc.start()
+    try:
+        for name, stage in stages(image_bytes, clicks, predictor, encoder, model_context):
+            if name in MODEL_STAGES:
+                peak = cuda_peak()
+                if peak is None:
+                    peaks[name] = cpu_peak_mb(stage)
+                else:
+                    stage()
+                    peaks[name] = peak()
+                continue
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            stage()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks[name] = (peak - before) / (1 << 20)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "stages": {
+            name: {**summarize(values), "peak_alloc_mb": peaks.get(name)} for name, values in timings.items()
+        },
+        "max_rss_mb": max_rss_mb(),
+    }
+
+
+def load_model(backend: str) -> tuple[Any, Any, Callable[[], Any]]:
+    import torch
+    from swag.sam_backend import load_backend
+
+    model = sam.get_model()
+    predictor = sam.make_predictor(model)
+    encoder = load_backend(model, backend)
+
+    @contextmanager
+    def model_context():
+        with torch.inference_mode(), sam.autocast():
+            yield
+
+    # One throwaway pass so lazy initialisation isn't timed as the first stage.
+    with model_context():
+        img = np.zeros((64, 64, 3), dtype=np.uint8)
+        features = sam.encode_images(encoder, sam.prepare_images(predictor, [img]))
+        sam.decode_masks(predictor, features, [img.shape[:2]], [np.array([[32, 32]])], [np.array([1])])
+    return predictor, encoder, model_context
+
+
+def print_table(cases: list[dict[str, Any]]) -> None:
+    for case in cases:
+        print(f"\n{case['image']} at {case['size']}px ({case['width']}x{case['height']}), {case['clicks']} clicks, "
+              f"max RSS {case['max_rss_mb']:.0f} MB")
+        total = sum(stage["p50"] for stage in case["stages"].values())
+        for name, stage in case["stages"].items():
+            peak = stage["peak_alloc_mb"]
+            print(f"  {name:<16} p50 {stage['p50'] * 1000:9.2f} ms  p95 {stage['p95'] * 1000:9.2f} ms  "
+                  f"{stage['p50'] / total:6.1%}  peak " + (f"{peak:8.2f} MB" if peak is not None else "       -"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="*", type=Path, help="Images to use (default: imgs/*.jpg and imgs/*.png).")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[512, 1024, 2048], help="Longest edges to resize to.")
+    parser.add_argument("--clicks", nargs="+", type=int, default=[1, 3])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--backend", default=sam.cfg.SAM_BACKEND, help="Image encoder backend, see swag/sam_backend.py.")
+    parser.add_argument("--skip-model", action="store_true", help="Use a synthetic mask instead of running SAM2.")
+    parser.add_argument("--out", type=Path)
+    parser.add_argument("--compare", type=Path, help="Earlier results to compare with.")
+    args = parser.parse_args()
+
+    images = args.images or sorted([*IMAGES_DIR.glob("*.jpg"), *IMAGES_DIR.glob("*.png")])
+    if args.skip_model:
+        predictor, encoder, model_context = None, None, nullcontext
+    else:
+        predictor, encoder, model_context = load_model(args.backend)
+
+    cases = []
+    for path in images:
+        for size in args.sizes:
+            image_bytes = resized(path, size)
+            width, height = Image.open(BytesIO(image_bytes)).size
+            for clicks in args.clicks:
+                case = run_case(image_bytes, clicks, args.repeats, predictor, encoder, model_context)
+                cases.append({"image": path.name, "size": size, "width": width, "height": height, "clicks": clicks, **case})
+                print_table(cases[-1:])
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {
+            "sizes": args.sizes,
+            "clicks": args.clicks,
+            "repeats": args.repeats,
+            "backend": None if args.skip_model else args.backend,
+            "device": None if args.skip_model else sam.get_device(),
+        },
+        "cases": cases,
+    }
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    out = args.out or RESULTS_DIR / f"sam-stages-{result['timestamp'].replace(':', '')}-{result['commit']}.json"
+    out.write_text(json.dumps(result, indent=2))
+    print(f"\nResults written to {out}")
+    if args.compare:
+        compare_cases(result, json.loads(args.compare.read_text()))
+
+
+def compare_cases(current: dict[str, Any], baseline: dict[str, Any]) -> None:
+    """Prints the change in p50 of every stage of the cases both runs have."""
+    print(f"\nCompared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    old_cases = {(c["image"], c["size"], c["clicks"]): c for c in baseline.get("cases", [])}
+    for case in current["cases"]:
+        old = old_cases.get((case["image"], case["size"], case["clicks"]))
+        if old is None:
+            continue
+        print(f"  {case['image']} {case['size']}px {case['clicks']} clicks")
+        for name, stage in case["stages"].items():
+            old_p50: Optional[float] = old["stages"].get(name, {}).get("p50")
+            if old_p50:
+                print(f"    {name:<16} {old_p50 * 1000:9.2f} -> {stage['p50'] * 1000:9.2f} ms "
+                      f"({(stage['p50'] - old_p50) / old_p50:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""Local stand-ins for the APIs the app calls: the Anthropic Messages API, Google Places
+and Maps, and Jina search and reader. Run with
+
+    uvicorn benchmarks.stubs:app --port 9000
+
+and point the app at it with OUTBOUND_BASE_URLS (see `base_urls`). Latencies are set
+with the STUB_* environment variables below.
+"""
+from typing import Any, AsyncIterator
+from io import BytesIO
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from PIL import Image
+
+# Seconds before the model's first event, and between its streamed chunks.
+LLM_FIRST_TOKEN = float(os.getenv("STUB_LLM_FIRST_TOKEN", "0.5"))
+LLM_CHUNK_INTERVAL = float(os.getenv("STUB_LLM_CHUNK_INTERVAL", "0.02"))
+# Number of text chunks in the final answer, and of tool-calling turns before it.
+LLM_ANSWER_CHUNKS = int(os.getenv("STUB_LLM_ANSWER_CHUNKS", "40"))
+LLM_TOOL_STEPS = int(os.getenv("STUB_LLM_TOOL_STEPS", "1"))
+# Seconds each Google and Jina request takes.
+API_LATENCY = float(os.getenv("STUB_API_LATENCY", "0.1"))
+# Size of a page returned by the Jina reader, in paragraphs.
+PAGE_PARAGRAPHS = int(os.getenv("STUB_PAGE_PARAGRAPHS", "30"))
+
+WORDS = (
+    "the museum gallery fresco chapel painter century restaurant pasta square fountain "
+    "church palace garden opening hours ticket price view tower bridge river market"
+).split()
+
+app = FastAPI()
+
+
+def base_urls(url: str) -> str:
+    """The OUTBOUND_BASE_URLS value that sends every outbound request to the stubs at `url`."""
+    return ",".join(
+        f"{host}={url}{path}"
+        for host, path in {
+            "api.anthropic.com": "",
+            "places.googleapis.com": "",
+            "maps.googleapis.com": "",
+            "s.jina.ai": "/jina/search",
+            "r.jina.ai": "/jina/read",
+        }.items()
+    )
+
+
+def text(seed: str, words: int) -> str:
+    """Deterministic filler text, so the same request always gets the same response."""
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+# Model
+
+def scripted_calls(body: dict[str, Any], seed: str) -> list[tuple[str, dict[str, Any]]]:
+    """The tool calls of a tool-calling turn: one per scripted tool the request offers,
+    so the app runs them concurrently. Inputs depend on the system prompt and the
+    user's first message, so repeated requests hit the app's caches and distinct ones don't."""
+    location = re.search(r"lat: (-?[\d.]+), lon: (-?[\d.]+)", json.dumps(body.get("system", "")))
+    lat, lon = (float(location[1]), float(location[2])) if location else (41.9029, 12.4534)
+    calls = {
+        "SearchInternet": {"query": f"things to see {seed}"},
+        "ReadWebsite": {"url": f"https://example.com/{seed}", "query": "opening hours"},
+        "SearchForNearbyPlacesOfType": {"types": ["restaurant"], "lat": lat, "lon": lon},
+    }
+    offered = [tool["name"] for tool in body.get("tools", [])]
+    return [(name, calls[name]) for name in offered if name in calls]
+
+
+def sse(event: str, data: dict[str, Any]) -> bytes:
+    return f"event: {event}\ndata: {json.dumps({'type': event, **data})}\n\n".encode()
+
+
+def model_turn(body: dict[str, Any]) -> tuple[list[dict[str, Any]], str]:
+    """Decides the next turn from the conversation so far: tool calls until LLM_TOOL_STEPS
+    tool results have been returned, then a text answer."""
+    messages = body["messages"]
+    first = messages[0]["content"]
+    first_text = first if isinstance(first, str) else " ".join(
+        block.get("text", "") for block in first if block.get("type") == "text"
+    )
+    seed = hashlib.sha256(f"{json.dumps(body.get('system', ''))}{first_text}".encode()).hexdigest()[:12]
+    tool_steps = sum(
+        1
+        for message in messages
+        if message["role"] == "user"
+        and isinstance(message["content"], list)
+        and any(block.get("type") == "tool_result" for block in message["content"])
+    )
+    calls = scripted_calls(body, seed) if tool_steps < LLM_TOOL_STEPS else []
+    if calls:
+        blocks = [
+            {"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:20]}", "name": name, "input": tool_input}
+            for name, tool_input in calls
+        ]
+        return blocks, "tool_use"
+    answer = text(f"{seed}:{tool_steps}", LLM_ANSWER_CHUNKS * 4)
+    return [{"type": "text", "text": answer}], "end_turn"
+
+
+def usage(body: dict[str, Any], output_tokens: int) -> dict[str, Any]:
+    input_tokens = len(json.dumps(body["messages"])) // 4
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 0,
+    }
+
+
+async def stream_turn(body: dict[str, Any]) -> AsyncIterator[bytes]:
+    blocks, stop_reason = model_turn(body)
+    await asyncio.sleep(LLM_FIRST_TOKEN)
+    message = {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body["model"],
+        "content": [],
+        "stop_reason": None,
+        "stop_sequence": None,
+        "usage": usage(body, 1),
+    }
+    yield sse("message_start", {"message": message})
+    output_tokens = 0
+    for index, block in enumerate(blocks):
+        if block["type"] == "text":
+            yield sse("content_block_start", {"index": index, "content_block": {"type": "text", "text": ""}})
+            words = block["text"].split(" ")
+            for i in range(0, len(words), 4):
+                await asyncio.sleep(LLM_CHUNK_INTERVAL)
+                delta = " ".join(words[i:i + 4]) + " "
+                yield sse("content_block_delta", {"index": index, "delta": {"type": "text_delta", "text": delta}})
+                output_tokens += 4
+        else:
+            yield sse(
+                "content_block_start",
+                {"index": index, "content_block": {**block, "input": {}}},
+            )
+            await asyncio.sleep(LLM_CHUNK_INTERVAL)
+            partial_json = json.dumps(block["input"])
+            yield sse(
+                "content_block_delta",
+                {"index": index, "delta": {"type": "input_json_delta", "partial_json": partial_json}},
+            )
+            output_tokens += len(partial_json) // 4
+        yield sse("content_block_stop", {"index": index})
+    yield sse(
+        "message_delta",
+        {"delta": {"stop_reason": stop_reason, "stop_sequence": None}, "usage": {"output_tokens": output_tokens}},
+    )
+    yield sse("message_stop", {})
+
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    body = await request.json()
+    if body.get("stream"):
+        return StreamingResponse(stream_turn(body), media_type="text/event-stream")
+    blocks, stop_reason = model_turn(body)
+    await asyncio.sleep(LLM_FIRST_TOKEN + LLM_CHUNK_INTERVAL * LLM_ANSWER_CHUNKS)
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body["model"],
+        "content": blocks,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": usage(body, LLM_ANSWER_CHUNKS * 4),
+    }
+
+
+# Google Places
+
+def place(seed: str, lat: float, lon: float, radius: float, i: int) -> dict[str, Any]:
+    angle = 2 * math.pi * i / 10
+    distance = radius * (i + 1) / 12
+    return {
+        "id": f"place_{seed}_{i}",
+        "displayName": {"text": text(f"{seed}:{i}", 2).title(), "languageCode": "en"},
+        "rating": round(3.5 + (i % 4) * 0.4, 1),
+        "location": {
+            "latitude": lat + distance * math.cos(angle) / 111_320,
+            "longitude": lon + distance * math.sin(angle) / (111_320 * math.cos(math.radians(lat))),
+        },
+        "types": ["restaurant", "food"],
+        "photos": [{"name": f"places/place_{seed}_{i}/photos/photo_{i}"}],
+    }
+
+
+@app.post("/v1/places:searchNearby")
+async def search_nearby(request: Request):
+    body = await request.json()
+    await asyncio.sleep(API_LATENCY)
+    circle = body["locationRestriction"]["circle"]
+    lat, lon = circle["center"]["latitude"], circle["center"]["longitude"]
+    seed = hashlib.sha256(f"{lat:.5f},{lon:.5f}".encode()).hexdigest()[:8]
+    return {"places": [place(seed, lat, lon, circle["radius"], i) for i in range(body.get("maxResultCount", 20))]}
+
+
+@app.post("/v1/places:searchText")
+async def search_text(request: Request):
+    body = await request.json()
+    await asyncio.sleep(API_LATENCY)
+    seed = hashlib.sha256(body["textQuery"].encode()).hexdigest()[:8]
+    return {"places": [place(seed, 41.9, 12.45, 500, i) for i in range(10)]}
+
+
+@app.get("/v1/places/{place_id}")
+async def place_details(place_id: str):
+    await asyncio.sleep(API_LATENCY)
+    return {
+        "displayName": {"text": text(place_id, 2).title()},
+        "rating": 4.2,
+        "formattedAddress": "Via della Conciliazione, 00120 Rome, Italy",
+        "websiteUri": f"https://example.com/{place_id}",
+    }
+
+
+_photo: bytes | None = None
+
+
+@app.get("/v1/{photo_name:path}/media")
+async def place_photo(photo_name: str):
+    global _photo
+    await asyncio.sleep(API_LATENCY)
+    if _photo is None:
+        buffer = BytesIO()
+        Image.new("RGB", (400, 300), (180, 140, 90)).save(buffer, format="JPEG")
+        _photo = buffer.getvalue()
+    return Response(content=_photo, media_type="image/jpeg")
+
+
+# Google Maps
+
+@app.get("/maps/api/geocode/json")
+async def geocode(request: Request):
+    await asyncio.sleep(API_LATENCY)
+    params = request.query_params
+    if "latlng" in params:
+        lat, lon = (float(x) for x in params["latlng"].split(","))
+    else:
+        lat, lon = 41.9029, 12.4534
+    return {
+        "status": "OK",
+        "results": [
+            {
+                "formatted_address": "Viale Vaticano, 00165 Rome, Italy",
+                "geometry": {"location": {"lat": lat, "lng": lon}},
+                "types": ["street_address"],
+            }
+        ],
+    }
+
+
+@app.get("/maps/api/distancematrix/json")
+async def distance_matrix(request: Request):
+    await asyncio.sleep(API_LATENCY)
+    origins = request.query_params["origins"].split("|")
+    destinations = request.query_params["destinations"].split("|")
+    element = {
+        "status": "OK",
+        "distance": {"text": "2.3 km", "value": 2300},
+        "duration": {"text": "9 mins", "value": 540},
+    }
+    return {
+        "status": "OK",
+        "origin_addresses": origins,
+        "destination_addresses": destinations,
+        "rows": [{"elements": [element for _ in destinations]} for _ in origins],
+    }
+
+
+@app.get("/maps/api/directions/json")
+async def directions(request: Request):
+    await asyncio.sleep(API_LATENCY)
+    leg = {
+        "distance": {"text": "2.3 km", "value": 2300},
+        "duration": {"text": "9 mins", "value": 540},
+        "start_address": request.query_params["origin"],
+        "end_address": request.query_params["destination"],
+        "steps": [],
+    }
+    return {"status": "OK", "routes": [{"legs": [leg]}]}
+
+
+@app.get("/maps/api/{api}/json")
+async def other_maps_api(api: str):
+    await asyncio.sleep(API_LATENCY)
+    return {"status": "OK", "results": []}
+
+
+# Jina
+
+@app.get("/jina/search/{query:path}")
+async def jina_search(query: str):
+    await asyncio.sleep(API_LATENCY)
+    seed = hashlib.sha256(query.encode()).hexdigest()[:8]
+    return JSONResponse(
+        {
+            "code": 200,
+            "data": [
+                {
+                    "title": text(f"{seed}:{i}", 6).title(),
+                    "url": f"https://example.com/{seed}/{i}",
+                    "description": text(f"{seed}:{i}:d", 25),
+                    "content": text(f"{seed}:{i}:c", 200),
+                }
+                for i in range(5)
+            ],
+        }
+    )
+
+
+@app.get("/jina/read/{url:path}")
+async def jina_read(url: str):
+    await asyncio.sleep(API_LATENCY)
+    paragraphs = [text(f"{url}:{i}", 60) for i in range(PAGE_PARAGRAPHS)]
+    return PlainTextResponse(f"Title: {url}\n\nURL Source: {url}\n\nMarkdown Content:\n" + "\n\n".join(paragraphs))
@@ -1,17 +1,19 @@
 # main.py
 import sys
 import os
-from typing import List
+import asyncio
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
-from fastapi import FastAPI, Depends
-from fastapi.responses import StreamingResponse, Response
+from fastapi import FastAPI, Depends, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from anthropic import AsyncAnthropic
-from pydantic import BaseModel, ConfigDict
-from io import BytesIO
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
 import geocoder
+import base64
+import secrets
 import uuid
 
 from swag.tools import (
@@ -19,21 +21,53 @@ from swag.tools import (
     ReadWebsite,
     SearchForNearbyPlacesOfType,
     Geocode,
-    ReverseGeocode,
     GetDistanceMatrix,
     OptimizeRoute,
-    reverse_geocode
+    LoadTools,
+    ToolRegistry,
+    places_cache,
+    tool_flights,
 )
 from swag.assistant import Assistant
-from swag.sam import predict_mask
-from swag.everywhere_tour_guide import run_everywhere_tour_guide
+from swag import transport, scheduler
+from swag import config as cfg
+from swag.cache import tool_cache
+from swag import telemetry
+from swag.conversations import conversation_store
+from swag.landmarks import landmark_cache
+from swag import sam as sam_module
+from swag.sam import segment, embedding_cache, SamBusyError
+from swag.everywhere_tour_guide import run_everywhere_tour_guide, tour_guide_flights, tour_guide_key
 import logging
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+def sam_warm_up_done(future: asyncio.Future) -> None:
+    """Marks SAM as failed, so /readyz stays unready, if the warm-up didn't finish."""
+    if future.cancelled() or future.exception() is not None:
+        if sam_module.status != "failed":
+            # warm_up logs its own errors; this catches what escaped it.
+            logger.error("SAM warm-up did not finish: %r", None if future.cancelled() else future.exception())
+        sam_module.status = "failed"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if cfg.SAM_WARMUP:
+        # Not awaited: the server starts accepting requests while SAM warms up.
+        warm_up = asyncio.get_running_loop().run_in_executor(None, sam_module.warm_up)
+        warm_up.add_done_callback(sam_warm_up_done)
+    lag_monitor = asyncio.create_task(telemetry.monitor_event_loop(cfg.EVENT_LOOP_LAG_INTERVAL))
+    yield
+    lag_monitor.cancel()
+    await transport.aclose()
+    conversation_store.close()
+    tool_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 app.add_middleware(
@@ -43,11 +77,17 @@ app.add_middleware(
         allow_methods=["*"],
         allow_headers=["*"],
 )
+app.add_middleware(telemetry.TelemetryMiddleware)
+
+SamFormat = Literal["composite", "rle", "png", "polygons"]
+clicks_adapter = TypeAdapter(list[list[int]])
+
 
 class SamRequest(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
     image: str
     clicks: list[list[int]]
+    format: SamFormat = "composite"
 
 class TourGuideRequest(BaseModel):
     base_image: str
@@ -64,19 +104,18 @@ class Query(BaseModel):
     id: str
     lat: float
     lon: float
-    query_type: str  # 'restaurant' or 'place' or 'trip'
+    query_type: str  # 'restaurant' or 'place' or 'trip' or 'open'
     query: str
     stream: bool = True
 
 
 # In-memory storage for preferences (might be replaced with a database later)
 user_preferences: List[str] = []
-conversations = {}
 
 
 @app.get("/location")
 async def get_location():
-    g = geocoder.ip("me")
+    g = await asyncio.to_thread(geocoder.ip, "me")
     return {"city": g.city, "country": g.country, "latlng": g.latlng}
 
 
@@ -90,35 +129,129 @@ async def add_preference(preference: UserPreference):
 async def get_preferences():
     return {"preferences": user_preferences}
 
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    ready = sam_module.status == "warm" or not cfg.SAM_WARMUP
+    return JSONResponse(
+        {"ready": ready, "sam": sam_module.status},
+        status_code=200 if ready else 503,
+    )
+
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "tool_cache": tool_cache.stats(),
+        "places_cache": places_cache.stats(),
+        "sam_embeddings": embedding_cache.stats(),
+        "conversations": conversation_store.stats(),
+        "outbound": scheduler.stats(),
+        "coalesced": {"tools": tool_flights.stats(), "tour_guide": tour_guide_flights.stats()},
+        "landmarks": landmark_cache.stats(),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    content, media_type = telemetry.metrics()
+    return Response(content=content, media_type=media_type)
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not cfg.ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, cfg.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required.")
+
+
+@app.get("/admin/landmarks", dependencies=[Depends(require_admin)])
+async def list_landmarks():
+    return landmark_cache.entries()
+
+
+@app.delete("/admin/landmarks", dependencies=[Depends(require_admin)])
+async def invalidate_landmarks(id: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None):
+    """Removes a cached answer by id, the answers in the cell of (lat, lon), or all of them."""
+    return {"removed": landmark_cache.invalidate(landmark_id=id, lat=lat, lon=lon)}
+
+async def tourguide_response(
+    base_image: bytes, masked_image: bytes, location: str, lat: float, lon: float, stream: bool
+):
+    if not location:
+        location = await ToolRegistry.call("ReverseGeocode", {"lat": lat, "lng": lon})
+
+    key = await asyncio.to_thread(tour_guide_key, base_image, masked_image, location, lat, lon)
+    chunks = tour_guide_flights.stream(key, lambda: run_everywhere_tour_guide(
+        base_image=base_image,
+        masked_image=masked_image,
+        location=location,
+        lat=lat,
+        lon=lon
+    ))
+    if stream:
+        return StreamingResponse(chunks, media_type="text/plain")
+    return "".join([chunk async for chunk in chunks])
+
+
+def decode_data_url(image: str) -> bytes:
+    return base64.b64decode(image.split("base64,", 1)[-1])
+
+
 @app.post("/tourguide")
 async def query_everywhere_tourguide(
-        request: TourGuideRequest, location: dict[str, str] = Depends(get_location)
+        request: TourGuideRequest
 ):
-    if not request.location:
-        request.location = reverse_geocode(ReverseGeocode(lat=request.lat, lng=request.lon))
-
-    request.base_image = request.base_image.replace("data:image/jpeg;base64,", "")
-    request.masked_image = request.masked_image.replace("data:image/jpeg;base64,", "")
-
-    if request.stream:   
-        return StreamingResponse(
-                run_everywhere_tour_guide(
-                    base_image=request.base_image,
-                    masked_image=request.masked_image,
-                    location=request.location,
-                    lat=request.lat,
-                    lon=request.lon
-                ),
-                media_type="text/plain"
-        )
-
-    response = "".join([chunk async for chunk in run_everywhere_tour_guide(
-        base_image=request.base_image,
-        masked_image=request.masked_image,
+    base_image, masked_image = await asyncio.to_thread(
+        lambda: (decode_data_url(request.base_image), decode_data_url(request.masked_image))
+    )
+    return await tourguide_response(
+        base_image=base_image,
+        masked_image=masked_image,
         location=request.location,
         lat=request.lat,
-        lon=request.lon)])
-    return response
+        lon=request.lon,
+        stream=request.stream,
+    )
+
+
+@app.post("/tourguide/upload")
+async def query_everywhere_tourguide_upload(
+    base_image: UploadFile = File(...),
+    lat: float = Form(...),
+    lon: float = Form(...),
+    masked_image: Optional[UploadFile] = File(None),
+    location: str = Form(""),
+    stream: bool = Form(True),
+):
+    """Same as /tourguide, with the images uploaded as multipart files instead of base64 JSON."""
+    base_bytes = await base_image.read()
+    masked_bytes = await masked_image.read() if masked_image else b""
+    return await tourguide_response(base_bytes, masked_bytes, location, lat, lon, stream)
+
+
+@app.post("/tourguide/raw")
+async def query_everywhere_tourguide_raw(
+    request: Request,
+    lat: float,
+    lon: float,
+    location: str = "",
+    stream: bool = True,
+):
+    """Same as /tourguide, with the base image file as the raw request body and the other
+    fields in the query string. There is no masked image; use /tourguide/upload to send one."""
+    return await tourguide_response(await request.body(), b"", location, lat, lon, stream)
+
+
+def retrieve_tools(query: str, used: list[str]) -> list:
+    """Picks the tools for an open query: the pinned tools, the tools already used in the
+    conversation and the tools most relevant to the query, followed by LoadTools."""
+    names = list(dict.fromkeys(cfg.TOOL_RETRIEVAL_PINNED + used))
+    models = [ToolRegistry.get(name)[1] for name in names if ToolRegistry.get(name)[1]]
+    models += ToolRegistry.search(query, cfg.TOOL_RETRIEVAL_TOP_K, exclude=names)
+    return models + [LoadTools]
 
 
 @app.post("/query_assistant")
@@ -126,17 +259,20 @@ async def query_assistant(
     query: Query, preferences: dict[str, list[str]] = Depends(get_preferences)
 ):
 
-    previous_conversation = conversations.get(query.id, [])
+    previous_conversation = await asyncio.to_thread(conversation_store.get, query.id)
 
     assistant = Assistant(
-        client=AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY")),
+        client=transport.get_anthropic(),
         model="claude-3-5-haiku-latest",
     )
 
-    assistant.messages = previous_conversation
+    if previous_conversation:
+        assistant.resume(*previous_conversation)
     user_preferences = preferences["preferences"]
     preferences_str = ", ".join(user_preferences)
-    location_str = reverse_geocode(ReverseGeocode(lat=query.lat, lng=query.lon))
+    location_str = await ToolRegistry.call(
+        "ReverseGeocode", {"lat": query.lat, "lng": query.lon}
+    )
 
     async def generate_response():
         if query.query_type == "trip":
@@ -179,32 +315,84 @@ async def query_assistant(
                 additional_info=additional_info,
                 action=action)
             assistant.define_tools([SearchInternet, ReadWebsite, SearchForNearbyPlacesOfType])
+        elif query.query_type == "open":
+            system_open = """
+            You are an AI assistant helping a user with questions about their surroundings, places and travel.
+            The user is in {location} (lat: {lat}, lon: {lon}).
+            The user's preferences are: {preferences_str}.
+            Use tools to gather the necessary information. If none of your tools can do what you need, use LoadTools to get more."""
+            assistant.system = system_open.format(
+                location=location_str, lat=query.lat, lon=query.lon, preferences_str=preferences_str
+            )
+            assistant.define_tools(retrieve_tools(query.query, assistant.used_tool_names()))
         else:
-            yield f"Invalid query type: {query.query_type}. Supported types are 'restaurant', 'place', and 'trip'."
+            yield f"Invalid query type: {query.query_type}. Supported types are 'restaurant', 'place', 'trip' and 'open'."
             return
         
-        # Use async for to iterate over the assistant's response
-        async for response_chunk in assistant(query.query):
-            conversations[query.id] = assistant.messages
-            yield response_chunk
+        try:
+            async for response_chunk in assistant(query.query):
+                yield response_chunk
+        finally:
+            # Also saves the turn when the client disconnects mid-stream and the response is
+            # cancelled: the write runs in an executor thread that finishes regardless.
+            saved = asyncio.get_running_loop().run_in_executor(
+                None, conversation_store.set, query.id, assistant.messages, assistant.steps
+            )
+            await asyncio.shield(saved)
     
     if query.stream:
         return StreamingResponse(generate_response(), media_type="text/plain")
     else:
         return "".join([chunk async for chunk in generate_response()])
 
-@app.post("/sam")
-async def sam(request: SamRequest):
-    request.image = request.image.replace("data:image/jpeg;base64,", "")
-    image = predict_mask(request.image, request.clicks)
-    img_byte_arr = BytesIO()
-    image.save(img_byte_arr, format='JPEG')
-    img_byte_arr = img_byte_arr.getvalue()
+async def sam_response(image: bytes | str, clicks: list[list[int]], response_format: str) -> Response:
+    try:
+        content, media_type = await segment(image, clicks, response_format)
+    except SamBusyError:
+        return Response(
+            content="The segmentation queue is full, please try again shortly.",
+            status_code=503,
+            headers={"Retry-After": str(cfg.SAM_RETRY_AFTER)},
+        )
     return Response(
-        content=img_byte_arr,
-        media_type="image/jpeg"
+        content=content,
+        media_type=media_type
     )
 
+
+def parse_clicks(clicks: str) -> list[list[int]]:
+    try:
+        return clicks_adapter.validate_json(clicks)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid clicks: {e}")
+
+
+@app.post("/sam")
+async def sam(request: SamRequest):
+    image = request.image.replace("data:image/jpeg;base64,", "")
+    return await sam_response(image, request.clicks, request.format)
+
+
+@app.post("/sam/upload")
+async def sam_upload(
+    image: UploadFile = File(...),
+    clicks: str = Form(..., description="The clicks as a JSON list of [x, y] pairs."),
+    format: SamFormat = Form("composite"),
+):
+    """Same as /sam, with the image uploaded as a multipart file instead of base64 JSON."""
+    return await sam_response(await image.read(), parse_clicks(clicks), format)
+
+
+@app.post("/sam/raw")
+async def sam_raw(
+    request: Request,
+    clicks: str,
+    format: SamFormat = "composite",
+):
+    """Same as /sam, with the image file as the raw request body and the clicks as a
+    JSON list of [x, y] pairs in the query string."""
+    return await sam_response(await request.body(), parse_clicks(clicks), format)
+
 if __name__ == "__main__":
     import uvicorn
 
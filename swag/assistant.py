@@ -1,25 +1,36 @@
-from typing import List, Dict, Any, Optional, AsyncGenerator
+from typing import List, Dict, Any, Optional, AsyncGenerator, Tuple
+from dataclasses import dataclass, field
 from pathlib import Path
-from anthropic import AsyncAnthropic
-from anthropic.types import TextBlock, ToolUseBlock
+from anthropic import APIStatusError, AsyncAnthropic
+from anthropic.types import TextBlock, ToolUseBlock, Usage
 import base64
-from swag.tools import ToolRegistry
+from swag.tools import LoadTools, ToolRegistry
+from swag.images import EncodedImage
+from swag.compaction import CompactionPolicy, compact, estimate_tokens
+from swag.passages import SearchQueries, current_query, current_search_queries
+from swag.telemetry import CONVERSATION_STEPS, record_usage, span
+from swag import config as cfg
+import asyncio
 import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
-def convert_pydantic_to_anthropic_schema(model) -> Dict[str, Any]:
-    json_schema = model.model_json_schema()
-    return {
-        "name": json_schema["title"],
-        "description": json_schema["description"],
-        "input_schema": {
-            "type": "object",
-            "properties": json_schema["properties"],
-        },
-    }
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+@dataclass
+class Step:
+    """State of a single model turn and the tool calls it made."""
+
+    index: int
+    started_at: float = field(default_factory=time.monotonic)
+    tool_calls: List[ToolUseBlock] = field(default_factory=list)
+    tool_tasks: List[asyncio.Task] = field(default_factory=list)
+    stop_reason: Optional[str] = None
+    usage: Optional[Usage] = None
 
 
 class Assistant:
@@ -27,22 +38,33 @@ class Assistant:
         self,
         client: AsyncAnthropic,
         model: str,
-        system: Optional[str] = None,
+        system: Optional[str | List[str]] = None,
         tools: List[Dict] = [],
         max_steps: int = 10,
+        max_concurrent_tools: int = cfg.MAX_CONCURRENT_TOOLS,
+        max_duration: float = cfg.ASSISTANT_MAX_DURATION,
+        compaction: Optional[CompactionPolicy] = None,
     ):
         self.client = client
         self.model = model
         self.system = system
         self.max_steps = max_steps
+        self.max_concurrent_tools = max_concurrent_tools
+        self.max_duration = max_duration
+        self.compaction = compaction or CompactionPolicy()
         self.messages = []
+        self.steps = 0
+        self.context_tokens = 0
+        self.finished = False
         self.max_tokens = 1024
+        self.search_queries = SearchQueries(cfg.SEARCH_QUERY_MAX_URLS)
         self.define_tools(tools)
 
     def define_tools(self, tools: List[Any]):
         """Defines the tools available to the assistant."""
+        self.tool_models = list(tools)
         if tools:
-            self.tools = [convert_pydantic_to_anthropic_schema(tool) for tool in tools]
+            self.tools = ToolRegistry.catalog(tools)
             self.tool_fns = {
                 tool.__name__: ToolRegistry.get(tool.__name__)[0] for tool in tools
             }
@@ -50,82 +72,233 @@ class Assistant:
             self.tools = []
             self.tool_fns = {}
 
+    def resume(self, messages: List[Dict[str, Any]], steps: int):
+        """Continues a previous conversation, given its messages and the number of steps it took."""
+        self.messages = messages
+        self.steps = steps
+
     async def __call__(
         self,
         prompt: str | None = None,
-        images: List[str] | None = None,
+        images: List[str | EncodedImage] | None = None,
     ) -> AsyncGenerator[str, None]:
-        if len(self.messages) >= 2 * self.max_steps:
+        try:
+            async for chunk in self.run(prompt, images):
+                yield chunk
+        finally:
+            CONVERSATION_STEPS.observe(self.steps)
+
+    async def run(
+        self,
+        prompt: str | None = None,
+        images: List[str | EncodedImage] | None = None,
+    ) -> AsyncGenerator[str, None]:
+        self.finished = False
+        current_search_queries.set(self.search_queries)
+        if self.steps >= self.max_steps:
             yield f"\nMaximum number of steps {self.max_steps} reached. Please start a new conversation."
             return
         if prompt:
+            current_query.set(prompt)
             message = {"role": "user", "content": [{"type": "text", "text": prompt}]}
             if images:
                 for image in images:
+                    if isinstance(image, str):
+                        image = EncodedImage("image/jpeg", image)
                     message["content"].append(
                         {
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": image,
+                                "media_type": image.media_type,
+                                "data": image.data,
                             },
                         }
                     )
             self.messages.append(message)
-        
-        try:
-            response = await self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                tools=self.tools or [],
-                system=self.system or "",
-                messages=self.messages,
+
+        # The budgets are only checked between steps, so a step that has started
+        # always leaves the conversation with a tool_result for every tool_use.
+        deadline = time.monotonic() + self.max_duration
+        while True:
+            if self.steps >= self.max_steps:
+                yield f"\nMaximum number of steps {self.max_steps} reached. Please start a new conversation."
+                return
+            if time.monotonic() >= deadline:
+                yield f"\nTime limit of {self.max_duration} seconds reached. Please ask a follow-up question to continue."
+                return
+
+            self.messages = compact(self.messages, self.compaction)
+            self.context_tokens = estimate_tokens(self.messages)
+
+            step = Step(index=self.steps)
+            self.steps += 1
+            try:
+                async for chunk in self.run_step(step):
+                    yield chunk
+            except Exception as e:
+                if isinstance(e, APIStatusError) and e.status_code in cfg.OUTBOUND_RETRY_STATUSES:
+                    # Still rate limited or overloaded after the scheduler's retries.
+                    logger.warning("Step %d of the assistant was rejected with status %d", step.index, e.status_code)
+                    yield json.dumps({
+                        "type": "error",
+                        "step": step.index,
+                        "status": e.status_code,
+                        "text": "The model is busy right now, please try again shortly.",
+                    })
+                    return
+                logger.exception("Step %d of the assistant failed", step.index)
+                yield json.dumps({"type": "error", "step": step.index, "text": f"An error occurred: {str(e)}"})
+                return
+
+            usage = step.usage
+            logger.info(
+                "Step %d finished in %.2fs with stop reason %s and %d tool calls "
+                "(input tokens: %d, cache read: %d, cache write: %d, output tokens: %d, estimated context: %d)",
+                step.index,
+                time.monotonic() - step.started_at,
+                step.stop_reason,
+                len(step.tool_calls),
+                usage.input_tokens if usage else 0,
+                (usage.cache_read_input_tokens or 0) if usage else 0,
+                (usage.cache_creation_input_tokens or 0) if usage else 0,
+                usage.output_tokens if usage else 0,
+                self.context_tokens,
             )
-            
-            self.messages.append({"role": "assistant", "content": response.content})
-
-            for content in response.content:
-                if isinstance(content, TextBlock):
-                    logger.info(f"Assistant: {content.text}")
-                    yield f"\n{content.text}"
-                elif isinstance(content, ToolUseBlock):
-                    yield f"\nMaking a call to tool function {content.name} with input {content.input}."
-                    tool_function, tool_model = ToolRegistry.get(content.name)
-                    is_error = False
-                    try:
-                        if tool_function:
-                            if tool_model:
-                                model_instance = tool_model(**content.input)
-                                tool_result = tool_function(model_instance)
-                            else:
-                                tool_result = tool_function(**content.input)
-
-                            yield "\nTool function executed successfully."
-                        else:
-                            raise ValueError(f"Tool function {content.name} not found")
-                    except Exception as e:
-                        is_error = True
-                        tool_result = str(e)
+            if step.stop_reason != "tool_use":
+                self.finished = True
+                return
+
+    async def run_step(self, step: Step) -> AsyncGenerator[str, None]:
+        """Runs one model turn and the tool calls it requests, updating `self.messages`."""
+        try:
+            # Tool calls of a turn run concurrently and each one starts as soon as its
+            # block has been streamed, while text is forwarded as it arrives.
+            semaphore = asyncio.Semaphore(self.max_concurrent_tools)
+            with span("llm", self.model, step=step.index) as attributes:
+                async with self.client.messages.stream(
+                    model=self.model,
+                    max_tokens=self.max_tokens,
+                    tools=self.tools or [],
+                    system=self.system_blocks(),
+                    messages=self.cached_messages(),
+                ) as stream:
+                    async for event in stream:
+                        if event.type == "content_block_start" and event.content_block.type == "text":
+                            yield "\n"
+                        elif event.type == "text":
+                            yield event.text
+                        elif event.type == "content_block_stop":
+                            content = event.content_block
+                            if isinstance(content, TextBlock):
+                                logger.info(f"Assistant: {content.text}")
+                            elif isinstance(content, ToolUseBlock):
+                                yield f"\nMaking a call to tool function {content.name} with input {content.input}."
+                                step.tool_calls.append(content)
+                                step.tool_tasks.append(
+                                    asyncio.create_task(self.run_tool(content, semaphore))
+                                )
+                    response = await stream.get_final_message()
+                attributes.update(
+                    stop_reason=response.stop_reason,
+                    input_tokens=response.usage.input_tokens,
+                    output_tokens=response.usage.output_tokens,
+                )
+
+            step.stop_reason = response.stop_reason
+            step.usage = response.usage
+            record_usage(self.model, response.usage)
+            message = {"role": "assistant", "content": response.content}
+
+            # The tool_use turn is only added with its results, so a conversation saved
+            # after the client disconnects mid-step can still be resumed.
+            if not step.tool_calls:
+                self.messages.append(message)
+            else:
+                # Results are returned in the order the model requested the tools.
+                results = await asyncio.gather(*step.tool_tasks)
+
+                new_input = []
+                for content, (tool_result, is_error) in zip(step.tool_calls, results):
+                    if is_error:
                         yield "\nAn error occurred when trying to interact with the tool."
-                    
+                    else:
+                        yield "\nTool function executed successfully."
+
                     logger.info("Tool result: %s", tool_result[:100])
-                    new_input = [{
+                    new_input.append({
                         "type": "tool_result",
                         "tool_use_id": content.id,
                         "content": tool_result,
                         "is_error": is_error,
-                    }]
-                    self.messages.append({"role": "user", "content": new_input})
+                    })
+                self.messages += [message, {"role": "user", "content": new_input}]
+        finally:
+            for task in step.tool_tasks:
+                task.cancel()
 
+    def system_blocks(self) -> str | List[Dict[str, Any]]:
+        """Returns the system prompt as text blocks. A list of prompts is sent as
+        separate blocks, so a shared first part is cached apart from the per-user rest."""
+        if not self.system:
+            return ""
+        parts = [self.system] if isinstance(self.system, str) else [part for part in self.system if part]
+        blocks = [{"type": "text", "text": part} for part in parts]
+        blocks[0]["cache_control"] = CACHE_CONTROL
+        return blocks
 
-            if response.stop_reason == "tool_use":
-                async for chunk in self():
-                    yield chunk
+    def cached_messages(self) -> List[Dict[str, Any]]:
+        """Returns the messages with a cache breakpoint on the last block, so the
+        next step of the conversation reads everything up to here from the prompt cache."""
+        if not self.messages or not isinstance(self.messages[-1], dict):
+            return self.messages
+        last = self.messages[-1]
+        content = last["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        if not content or not isinstance(content[-1], dict):
+            return self.messages
+        content = [*content[:-1], {**content[-1], "cache_control": CACHE_CONTROL}]
+        return [*self.messages[:-1], {**last, "content": content}]
 
-        except Exception as e:
-            yield json.dumps({"type": "error", "text": f"An error occurred: {str(e)}"})
-            return
+    def used_tool_names(self) -> List[str]:
+        """Returns the names of the tools called so far in the conversation, in order."""
+        names = []
+        for message in self.messages:
+            if message["role"] != "assistant" or isinstance(message["content"], str):
+                continue
+            for block in message["content"]:
+                block_type = block["type"] if isinstance(block, dict) else block.type
+                if block_type == "tool_use":
+                    name = block["name"] if isinstance(block, dict) else block.name
+                    if name not in names:
+                        names.append(name)
+        return names
+
+    def load_tools(self, request: LoadTools) -> str:
+        """Adds the registered tools most relevant to the request to the assistant's tools."""
+        names = [model.__name__ for model in self.tool_models]
+        found = ToolRegistry.search(request.query, cfg.TOOL_RETRIEVAL_LOAD_K, exclude=names)
+        if not found:
+            return "No other relevant tools were found."
+        self.define_tools(self.tool_models + found)
+        logger.info("Loaded tools %s for %r", [model.__name__ for model in found], request.query)
+        return json.dumps([
+            {"name": model.__name__, "description": model.__doc__} for model in found
+        ])
+
+    async def run_tool(
+        self, content: ToolUseBlock, semaphore: asyncio.Semaphore
+    ) -> Tuple[str, bool]:
+        """Runs a single tool call, returning its result and whether it failed."""
+        async with semaphore:
+            try:
+                if content.name == LoadTools.__name__:
+                    return self.load_tools(LoadTools(**content.input)), False
+                return await ToolRegistry.call(content.name, content.input), False
+            except Exception as e:
+                logger.warning("Tool %s failed: %s", content.name, e)
+                return str(e), True
 
     @staticmethod
     def load_image_base64(file_path: Path) -> str:
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from pydantic import BaseModel
+from typing import Any, Optional
+import threading
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import json
+import time
+import os
+
+from . import config as cfg
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_input(name: str, request: BaseModel) -> str:
+    """Returns a canonical representation of a tool call, so that equivalent inputs
+    (different key order, surrounding whitespace) map to the same cache key."""
+
+    def normalize(value: Any) -> Any:
+        if isinstance(value, str):
+            return value.strip()
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        return value
+
+    dump = normalize(request.model_dump(mode="json"))
+    return f"{name}:{json.dumps(dump, sort_keys=True, separators=(',', ':'))}"
+
+
+def cache_key(name: str, request: BaseModel) -> str:
+    return hashlib.sha256(canonical_input(name, request).encode("utf-8")).hexdigest()
+
+
+class ToolCache:
+    """A TTL cache of tool results, bounded in memory by an LRU on the total size of
+    the cached results and optionally persisted to SQLite.
+
+    The file is only read on a memory miss, in a worker thread, and writes are queued
+    and flushed in batches by a background thread that also deletes expired rows.
+    Results larger than `max_bytes` are neither cached nor persisted."""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        path: Optional[str] = None,
+        flush_interval: float = cfg.TOOL_CACHE_FLUSH_INTERVAL,
+        purge_interval: float = cfg.TOOL_CACHE_PURGE_INTERVAL,
+    ):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._pending: dict[str, tuple[float, str]] = {}
+        self._wake = threading.Event()
+        self._closed = False
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tool_cache (key TEXT PRIMARY KEY, expires_at REAL, value TEXT)"
+            )
+            self.purge()
+            self._writer = threading.Thread(target=self._write_loop, name="tool-cache-writer", daemon=True)
+            self._writer.start()
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._size -= len(self._entries.pop(key)[1])
+            row = self._pending.get(key)
+
+        if row is None and self._db is not None:
+            row = await asyncio.to_thread(self._select, key)
+
+        with self._lock:
+            if row is None or row[0] < time.time():
+                self.misses += 1
+                return None
+            self._insert(key, *row)
+            self.hits += 1
+            return row[1]
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        if len(value) > self.max_bytes:
+            return
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._insert(key, expires_at, value)
+            if self._db is not None:
+                self._pending[key] = (expires_at, value)
+        if self._db is not None:
+            self._wake.set()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or self._db is None:
+            return
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tool_cache (key, expires_at, value) VALUES (?, ?, ?)",
+                [(key, *entry) for key, entry in pending.items()],
+            )
+            self._db.commit()
+
+    def purge(self) -> None:
+        """Deletes the expired rows of the SQLite file."""
+        with self._db_lock:
+            self._db.execute("DELETE FROM tool_cache WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    def close(self) -> None:
+        if self._db is None or self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "pending_writes": len(self._pending),
+            }
+
+    def _select(self, key: str) -> Optional[tuple[float, str]]:
+        with self._db_lock:
+            return self._db.execute("SELECT expires_at, value FROM tool_cache WHERE key = ?", (key,)).fetchone()
+
+    def _insert(self, key: str, expires_at: float, value: str) -> None:
+        """Caches the value in memory, unless it is larger than the whole cache."""
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key)[1])
+        self._entries[key] = (expires_at, value)
+        self._size += size
+        while self._size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _write_loop(self) -> None:
+        last_purge = time.monotonic()
+        while not self._closed:
+            # Wakes up for writes, and at least once per purge interval.
+            if self._wake.wait(timeout=self.purge_interval):
+                # Collects the writes of other calls that finish within the interval.
+                time.sleep(self.flush_interval)
+                self._wake.clear()
+            try:
+                self.flush()
+                if time.monotonic() - last_purge >= self.purge_interval:
+                    self.purge()
+                    last_purge = time.monotonic()
+            except sqlite3.Error:
+                logger.exception("Failed to write the tool cache to %s", self.path)
+
+
+tool_cache = ToolCache(
+    max_bytes=cfg.TOOL_CACHE_MAX_BYTES,
+    path=os.getenv("TOOL_CACHE_PATH") or None,
+)
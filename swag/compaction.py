@@ -0,0 +1,108 @@
+from dataclasses import dataclass
+from pydantic import BaseModel
+from typing import Any, Dict, List
+import json
+
+from . import config as cfg
+
+# Rough averages used to estimate the size of the context without a tokenizer.
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+
+
+@dataclass
+class CompactionPolicy:
+    """How the assistant shrinks its message history between steps."""
+
+    enabled: bool = cfg.COMPACTION_ENABLED
+    drop_images: bool = cfg.COMPACTION_DROP_IMAGES
+    tool_result_tokens: int = cfg.COMPACTION_TOOL_RESULT_TOKENS
+    keep_recent_steps: int = cfg.COMPACTION_KEEP_RECENT_STEPS
+    trigger_tokens: int = cfg.COMPACTION_TRIGGER_TOKENS
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    """Estimates the number of input tokens of a message history."""
+    return sum(_block_tokens(block) for message in messages for block in _content(message))
+
+
+def compact(messages: List[Dict[str, Any]], policy: CompactionPolicy) -> List[Dict[str, Any]]:
+    """Returns the messages with images and tool results of earlier turns compacted.
+    Tool results of the current turn are compacted too, apart from the most recent
+    steps, once the estimated context exceeds the policy's trigger.
+
+    Compaction is idempotent, so messages that were already compacted stay identical
+    and the prompt cache keeps matching them."""
+    if not policy.enabled:
+        return messages
+
+    # A turn starts with a user message that isn't only tool results.
+    turn_start = 0
+    for index, message in enumerate(messages):
+        if message["role"] == "user" and not all(
+            _type(block) == "tool_result" for block in _content(message)
+        ):
+            turn_start = index
+
+    tool_result_messages = [
+        index
+        for index, message in enumerate(messages)
+        if message["role"] == "user" and any(_type(block) == "tool_result" for block in _content(message))
+    ]
+    keep = set(tool_result_messages[-policy.keep_recent_steps:]) if policy.keep_recent_steps else set()
+    over_budget = estimate_tokens(messages) > policy.trigger_tokens
+
+    compacted = []
+    for index, message in enumerate(messages):
+        earlier_turn = index < turn_start
+        if message["role"] != "user" or not earlier_turn and (not over_budget or index in keep):
+            compacted.append(message)
+            continue
+        content = [_compact_block(block, policy, earlier_turn) for block in _content(message)]
+        compacted.append({**message, "content": content})
+    return compacted
+
+
+def _compact_block(block: Dict[str, Any], policy: CompactionPolicy, earlier_turn: bool) -> Dict[str, Any]:
+    # Images are only dropped once the turn they were sent with is over.
+    if block.get("type") == "image" and policy.drop_images and earlier_turn:
+        media_type = block.get("source", {}).get("media_type", "image")
+        return {"type": "text", "text": f"[{media_type} shown in an earlier turn, omitted]"}
+    if block.get("type") == "tool_result":
+        return {**block, "content": _truncate(block.get("content", ""), policy.tool_result_tokens)}
+    return block
+
+
+def _truncate(content: Any, max_tokens: int) -> Any:
+    if not isinstance(content, str):
+        return content
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(content) <= max_chars:
+        return content
+    marker = f"\n[truncated {len(content) - max_chars} characters]"
+    return content[: max_chars - len(marker)] + marker
+
+
+def _content(message: Dict[str, Any]) -> List[Any]:
+    content = message["content"]
+    return [{"type": "text", "text": content}] if isinstance(content, str) else content
+
+
+def _type(block: Any) -> str:
+    return block.get("type") if isinstance(block, dict) else block.type
+
+
+def _block_tokens(block: Any) -> int:
+    if isinstance(block, BaseModel):
+        block = block.model_dump()
+    kind = block.get("type")
+    if kind == "image":
+        return IMAGE_TOKENS
+    if kind == "text":
+        return len(block.get("text", "")) // CHARS_PER_TOKEN
+    if kind == "tool_result":
+        content = block.get("content", "")
+        if isinstance(content, str):
+            return len(content) // CHARS_PER_TOKEN
+        return sum(_block_tokens(part) for part in content)
+    return len(json.dumps(block, default=str)) // CHARS_PER_TOKEN
@@ -1 +1,169 @@
+import os
+
+# Maximum number of tool calls from a single model turn that run at the same time.
+MAX_CONCURRENT_TOOLS = 4
+
+# Wall-clock budget, in seconds, for a single call to the assistant.
+ASSISTANT_MAX_DURATION = 120.0
+
+# Tool retrieval for open /query_assistant queries. The top-k tools for the query are
+# sent along with the pinned tools, and LoadTools adds LOAD_K more per call.
+TOOL_RETRIEVAL_TOP_K = 4
+TOOL_RETRIEVAL_LOAD_K = 3
+TOOL_RETRIEVAL_PINNED = ["SearchInternet", "ReadWebsite"]
+
+# Context compaction of the assistant's messages (see swag/compaction.py). Images and
+# tool results from earlier turns are replaced/truncated; within a turn, older tool
+# results are only truncated once the estimated context exceeds the trigger.
+COMPACTION_ENABLED = True
+COMPACTION_DROP_IMAGES = True
+COMPACTION_TOOL_RESULT_TOKENS = 500
+COMPACTION_KEEP_RECENT_STEPS = 2
+COMPACTION_TRIGGER_TOKENS = 20_000
+
+# Shared HTTP transport used by the tools (see swag/transport.py). Timeouts are in seconds.
+HTTP_TIMEOUT = 30.0
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_MAX_CONNECTIONS_PER_HOST = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST = 10
+HTTP_KEEPALIVE_EXPIRY = 60.0
+
+# Outbound scheduler (see swag/scheduler.py). Each provider gets a token bucket of
+# (requests per second, burst) and a cap on concurrent requests, and requests that
+# fail with a retryable status are retried with jittered exponential backoff. Each
+# value can be set with OUTBOUND_<PROVIDER>_RPS, _BURST and _CONCURRENCY, e.g.
+# OUTBOUND_ANTHROPIC_RPS. The Anthropic default is the Tier 4 limit of 4,000 requests
+# per minute; set it to the account's tier (Tier 1: 50/min, Tier 2: 1,000/min).
+def _outbound_limit(provider: str, rate: float, burst: int, max_concurrency: int) -> tuple[float, int, int]:
+    prefix = f"OUTBOUND_{provider.upper()}_"
+    return (
+        float(os.getenv(prefix + "RPS", rate)),
+        int(os.getenv(prefix + "BURST", burst)),
+        int(os.getenv(prefix + "CONCURRENCY", max_concurrency)),
+    )
+
+
+OUTBOUND_LIMITS = {
+    # provider: (requests per second, burst, max concurrent requests)
+    "anthropic": _outbound_limit("anthropic", 4000 / 60, 100, 64),
+    "google": _outbound_limit("google", 50.0, 50, 20),
+    "jina": _outbound_limit("jina", 3.0, 10, 10),
+}
+OUTBOUND_PROVIDERS = {
+    "api.anthropic.com": "anthropic",
+    "places.googleapis.com": "google",
+    "maps.googleapis.com": "google",
+    "r.jina.ai": "jina",
+    "s.jina.ai": "jina",
+}
+# Replacement base URLs for outbound hosts, e.g. the local stand-ins of benchmarks/stubs.py,
+# given as "host=url,host=url". Requests keep their path, under the path of the URL.
+OUTBOUND_BASE_URLS = dict(
+    item.split("=", 1) for item in os.getenv("OUTBOUND_BASE_URLS", "").split(",") if "=" in item
+)
+OUTBOUND_RETRY_STATUSES = {429, 500, 502, 503, 504, 529}
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_BACKOFF_BASE = 0.5
+OUTBOUND_BACKOFF_MAX = 8.0
+ANTHROPIC_TIMEOUT = 600.0
+
+# Images sent to the model on /tourguide (see swag/images.py) are downscaled so their
+# longest edge is at most IMAGE_MAX_EDGE pixels and re-encoded as JPEG; only JPEGs within
+# both the edge limit and IMAGE_PASSTHROUGH_MAX_BYTES are sent unchanged. With
+# IMAGE_CROP_MASKED, the masked image is sent as a crop around the mask, padded by
+# IMAGE_CROP_MARGIN of its size.
+IMAGE_MAX_EDGE = 1024
+IMAGE_JPEG_QUALITY = 85
+IMAGE_PASSTHROUGH_MAX_BYTES = 256 * 1024
+IMAGE_CROP_MASKED = True
+IMAGE_CROP_MARGIN = 0.25
+
+# Tool result cache (see swag/cache.py). TTLs are in seconds; set the TOOL_CACHE_PATH
+# environment variable to persist the cache to a SQLite file.
+TOOL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TOOL_CACHE_DEFAULT_TTL = 60 * 60
+# Writes to the SQLite file are batched every TOOL_CACHE_FLUSH_INTERVAL seconds, and
+# expired rows are deleted every TOOL_CACHE_PURGE_INTERVAL seconds.
+TOOL_CACHE_FLUSH_INTERVAL = 0.5
+TOOL_CACHE_PURGE_INTERVAL = 10 * 60
+
+# Passage extraction for ReadWebsite (see swag/passages.py). Pages are split into
+# passages of about PASSAGE_CHARS characters and only the passages most relevant to the
+# query are returned, up to the token budget. Raw pages are cached for PAGE_TTL seconds.
+READ_WEBSITE_MAX_TOKENS = 2000
+READ_WEBSITE_TOP_K = 8
+READ_WEBSITE_PASSAGE_CHARS = 800
+READ_WEBSITE_PAGE_TTL = 60 * 60
+SEARCH_QUERY_MAX_URLS = 10_000
+
+# Conversation store for /query_assistant (see swag/conversations.py). Conversations
+# are kept in memory unless CONVERSATION_STORE_PATH points to a SQLite file, which lets
+# several workers share them.
+CONVERSATION_TTL = 24 * 60 * 60
+CONVERSATION_MAX_BYTES = 256 * 1024 * 1024
+CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH") or None
+
+# Geohash tile cache for SearchForNearbyPlacesOfType (see swag/places.py). Precision 7
+# tiles are roughly 150m tall and 150m * cos(latitude) wide; a search covers as many
+# tiles as its radius needs. A search with missing tiles makes one upstream query per
+# place type, for the circle that covers all of them, ranked by distance and capped at
+# PLACES_FETCH_MAX_RESULTS; the results are split into the tiles. Tiles older than the
+# TTL are refreshed in the background, tiles older than the max age are fetched again
+# before answering.
+PLACES_SEARCH_RADIUS = 100.0
+PLACES_MAX_RESULTS = 10
+PLACES_TILE_PRECISION = 7
+PLACES_TILE_TTL = 6 * 60 * 60
+PLACES_TILE_MAX_AGE = 7 * 24 * 60 * 60
+PLACES_TILE_MAX_ENTRIES = 50_000
+PLACES_FETCH_MAX_RESULTS = 20
+
+# Landmark answer cache for /tourguide (see swag/landmarks.py). Answers are keyed on a
+# 64-bit perceptual hash of the masked region (or the whole frame) and a geohash cell
+# of about 1.2km x 0.6km. A request within LANDMARK_HAMMING_THRESHOLD bits of a stored
+# hash in the same or a neighbouring cell gets the stored answer. The admin endpoints
+# are disabled unless ADMIN_TOKEN is set.
+LANDMARK_CACHE_ENABLED = True
+LANDMARK_GEOHASH_PRECISION = 6
+LANDMARK_HAMMING_THRESHOLD = 10
+LANDMARK_TTL = 7 * 24 * 60 * 60
+LANDMARK_MAX_ENTRIES = 10_000
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or None
+
+# Interval, in seconds, at which the event loop's lag is sampled for /metrics.
+EVENT_LOOP_LAG_INTERVAL = 0.1
+
+# Cache of SAM2 image embeddings (see swag/sam.py). A sam2.1_hiera_tiny embedding
+# takes about 16MB.
+SAM_EMBEDDING_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Micro-batching of /sam requests: requests arriving within the window (in seconds)
+# are run through the model together, up to the max batch size.
+SAM_BATCH_WINDOW = 0.005
+SAM_MAX_BATCH_SIZE = 4
+
+# SAM worker pool. Every worker thread has its own predictor over the shared model.
+# When more than SAM_QUEUE_SIZE requests are waiting, /sam answers 503 with a
+# Retry-After of SAM_RETRY_AFTER seconds. SAM_TORCH_THREADS sets torch's intra-op
+# threads for the whole process (0 keeps torch's default).
+SAM_WORKERS = int(os.getenv("SAM_WORKERS", "1"))
+SAM_IO_WORKERS = int(os.getenv("SAM_IO_WORKERS", "4"))
+SAM_QUEUE_SIZE = int(os.getenv("SAM_QUEUE_SIZE", "16"))
+SAM_TORCH_THREADS = int(os.getenv("SAM_TORCH_THREADS", "0"))
+SAM_RETRY_AFTER = 2
+
+# Maximum distance, in pixels, between a mask outline and the polygon returned by
+# /sam with format=polygons.
+SAM_POLYGON_EPSILON = 1.0
+
+# Load SAM and run one dummy segmentation in the background at startup. /readyz
+# reports ready once this is done.
+SAM_WARMUP = os.getenv("SAM_WARMUP", "1") == "1"
+
+# Image encoder backend for SAM (see swag/sam_backend.py): "eager", "traced" or "onnx".
+# SAM_QUANTIZE=1 applies dynamic int8 quantization to the encoder.
+SAM_BACKEND = os.getenv("SAM_BACKEND", "eager")
+SAM_QUANTIZE = os.getenv("SAM_QUANTIZE", "0") == "1"
+SAM_ONNX_DIR = os.getenv("SAM_ONNX_DIR", os.path.expanduser("~/sam2/onnx"))
+
 POSSIBLE_PLACE_TYPES = ["car_dealer", "car_rental", "car_repair", "car_wash", "electric_vehicle_charging_station", "gas_station", "parking", "rest_stop", "corporate_office", "farm", "ranch", "art_gallery", "art_studio", "auditorium", "cultural_landmark", "historical_place", "monument", "museum", "performing_arts_theater", "sculpture", "library", "preschool", "primary_school", "school", "secondary_school", "university", "adventure_sports_center", "amphitheatre", "amusement_center", "amusement_park", "aquarium", "banquet_hall", "barbecue_area", "botanical_garden", "bowling_alley", "casino", "childrens_camp", "comedy_club", "community_center", "concert_hall", "convention_center", "cultural_center", "cycling_park", "dance_hall", "dog_park", "event_venue", "ferris_wheel", "garden", "hiking_area", "historical_landmark", "internet_cafe", "karaoke", "marina", "movie_rental", "movie_theater", "national_park", "night_club", "observation_deck", "off_roading_area", "opera_house", "park", "philharmonic_hall", "picnic_ground", "planetarium", "plaza", "roller_coaster", "skateboard_park", "state_park", "tourist_attraction", "video_arcade", "visitor_center", "water_park", "wedding_venue", "wildlife_park", "wildlife_refuge", "zoo", "public_bath", "public_bathroom", "stable", "accounting", "atm", "bank", "acai_shop", "afghani_restaurant", "african_restaurant", "american_restaurant", "asian_restaurant", "bagel_shop", "bakery", "bar", "bar_and_grill", "barbecue_restaurant", "brazilian_restaurant", "breakfast_restaurant", "brunch_restaurant", "buffet_restaurant", "cafe", "cafeteria", "candy_store", "cat_cafe", "chinese_restaurant", "chocolate_factory", "chocolate_shop", "coffee_shop", "confectionery", "deli", "dessert_restaurant", "dessert_shop", "diner", "dog_cafe", "donut_shop", "fast_food_restaurant", "fine_dining_restaurant", "food_court", "french_restaurant", "greek_restaurant", "hamburger_restaurant", "ice_cream_shop", "indian_restaurant", "indonesian_restaurant", "italian_restaurant", "japanese_restaurant", "juice_shop", "korean_restaurant", "lebanese_restaurant", "meal_delivery", "meal_takeaway", "mediterranean_restaurant", "mexican_restaurant", "middle_eastern_restaurant", "pizza_restaurant", "pub", "ramen_restaurant", "restaurant", "sandwich_shop", "seafood_restaurant", "spanish_restaurant", "steak_house", "sushi_restaurant", "tea_house", "thai_restaurant", "turkish_restaurant", "vegan_restaurant", "vegetarian_restaurant", "vietnamese_restaurant", "wine_bar","administrative_area_level_1", "administrative_area_level_2", "country	locality", "postal_code", "school_district", "city_hall", "courthouse", "embassy", "fire_station", "government_office", "local_government_office", "police", "post_office", "chiropractor", "dental_clinic", "dentist", "doctor", "drugstore", "hospital", "massage", "medical_lab *	pharmacy", "physiotherapist", "sauna", "skin_care_clinic", "spa", "tanning_studio", "wellness_center", "yoga_studio", "apartment_building", "apartment_complex", "condominium_complex", "housing_complex", "bed_and_breakfast", "budget_japanese_inn", "campground", "camping_cabin", "cottage", "extended_stay_hotel", "farmstay", "guest_house hostel", "hotel", "inn", "japanese_inn", "lodging", "mobile_home_park", "motel", "private_guest_room", "resort_hotel", "rv_park", "beach",  "church", "hindu_temple", "mosque", "synagogue", "astrologer", "barber_shop", "beautician", "beauty_salon", "body_art_service", "catering_service", "cemetery", "child_care_agency", "consultant", "courier_service", "electrician", "florist", "food_delivery", "foot_care", "funeral_home", "hair_care", "hair_salon", "insurance_agency laundry", "lawyer", "locksmith", "makeup_artist", "moving_company", "nail_salon", "painter", "plumber", "psychic", "real_estate_agency", "roofing_contractor", "storage", "summer_camp_organizer", "tailor", "telecommunications_service_provider", "tour_agency", "tourist_information_center", "travel_agency", "veterinary_care", "asian_grocery_store", "auto_parts_store", "bicycle_store", "book_store", "butcher_shop", "cell_phone_store", "clothing_store", "convenience_store", "department_store", "discount_store", "electronics_store", "food_store", "furniture_store", "gift_shop", "grocery_store", "hardware_store", "home_goods_store", "home_improvement_store", "jewelry_store", "liquor_store", "market", "pet_store", "shoe_store", "shopping_mall", "sporting_goods_store", "store", "supermarket", "warehouse_store", "wholesaler", "arena", "athletic_field", "fishing_charter", "fishing_pond", "fitness_center", "golf_course", "gym", "ice_skating_rink", "playground", "ski_resort", "sports_activity_location", "sports_club", "sports_coaching", "sports_complex", "stadium", "swimming_pool", "airport", "airstrip", "bus_station", "bus_stop", "ferry_terminal", "heliport", "international_airport", "light_rail_station", "park_and_ride", "subway_station", "taxi_stand", "train_station", "transit_depot", "transit_station", "truck_stop"]
@@ -0,0 +1,189 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pydantic import BaseModel
+from typing import Any, List, Optional, Tuple
+import threading
+import logging
+import sqlite3
+import json
+import time
+
+from . import config as cfg
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_conversation(messages: List[Any], steps: int) -> str:
+    """Serializes a conversation to JSON, turning the SDK's content blocks into
+    the plain dicts the API accepts back."""
+
+    def to_json(value: Any) -> Any:
+        if isinstance(value, BaseModel):
+            return value.model_dump(mode="json", exclude_none=True)
+        raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+    return json.dumps({"messages": messages, "steps": steps}, default=to_json, separators=(",", ":"))
+
+
+class ConversationStore(ABC):
+    """Stores the message history and step count of each conversation."""
+
+    @abstractmethod
+    def get(self, conversation_id: str) -> Optional[Tuple[List[dict], int]]:
+        ...
+
+    @abstractmethod
+    def set(self, conversation_id: str, messages: List[Any], steps: int) -> None:
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict[str, Any]:
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryConversationStore(ConversationStore):
+    """Keeps conversations in memory as serialized JSON, expiring them after `ttl`
+    seconds and evicting the least recently used ones beyond `max_bytes`."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # id -> (expires_at, updated_at, payload)
+        self._entries: OrderedDict[str, tuple[float, float, str]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: str) -> Optional[Tuple[List[dict], int]]:
+        entry = self.get_entry(conversation_id)
+        if entry is None:
+            return None
+        return _load(entry[2])
+
+    def set(self, conversation_id: str, messages: List[Any], steps: int) -> None:
+        payload = serialize_conversation(messages, steps)
+        now = time.time()
+        self.put_entry(conversation_id, now + self.ttl, now, payload)
+
+    def get_entry(self, conversation_id: str) -> Optional[tuple[float, float, str]]:
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._size -= len(self._entries.pop(conversation_id)[2])
+                self.misses += 1
+                return None
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            return entry
+
+    def put_entry(self, conversation_id: str, expires_at: float, updated_at: float, payload: str) -> None:
+        with self._lock:
+            if conversation_id in self._entries:
+                self._size -= len(self._entries.pop(conversation_id)[2])
+            if len(payload) > self.max_bytes:
+                return
+            self._entries[conversation_id] = (expires_at, updated_at, payload)
+            self._size += len(payload)
+            while self._size > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class SqliteConversationStore(ConversationStore):
+    """Persists conversations to a SQLite file shared by all workers, with a memory
+    store in front of it. `set` writes the row before it returns, so the next turn of a
+    conversation sees it whichever worker it lands on; callers run it in a thread."""
+
+    def __init__(self, path: str, max_bytes: int, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.memory = MemoryConversationStore(max_bytes, ttl)
+        self.writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db_lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations "
+            "(id TEXT PRIMARY KEY, expires_at REAL, updated_at REAL, payload TEXT)"
+        )
+        self._purge()
+
+    def get(self, conversation_id: str) -> Optional[Tuple[List[dict], int]]:
+        # Another worker may have continued the conversation since it was cached here,
+        # so the row is only read back if it is newer than the cached copy.
+        entry = self.memory.get_entry(conversation_id)
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT expires_at, updated_at, payload FROM conversations "
+                "WHERE id = ? AND expires_at >= ? AND updated_at > ?",
+                (conversation_id, time.time(), entry[1] if entry else 0.0),
+            ).fetchone()
+        if row is not None:
+            self.memory.put_entry(conversation_id, *row)
+            return _load(row[2])
+        return _load(entry[2]) if entry else None
+
+    def set(self, conversation_id: str, messages: List[Any], steps: int) -> None:
+        payload = serialize_conversation(messages, steps)
+        now = time.time()
+        entry = (now + self.ttl, now, payload)
+        self.memory.put_entry(conversation_id, *entry)
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO conversations (id, expires_at, updated_at, payload) VALUES (?, ?, ?, ?)",
+                (conversation_id, *entry),
+            )
+            self._db.commit()
+            self.writes += 1
+            purge = now - self._last_purge > self.ttl / 10
+        if purge:
+            self._purge()
+
+    def close(self) -> None:
+        with self._db_lock:
+            self._db.close()
+
+    def stats(self) -> dict[str, Any]:
+        return {**self.memory.stats(), "writes": self.writes}
+
+    def _purge(self) -> None:
+        with self._db_lock:
+            self._db.execute("DELETE FROM conversations WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+            self._last_purge = time.time()
+
+
+def _load(payload: str) -> Tuple[List[dict], int]:
+    conversation = json.loads(payload)
+    return conversation["messages"], conversation["steps"]
+
+
+def make_conversation_store() -> ConversationStore:
+    if cfg.CONVERSATION_STORE_PATH:
+        return SqliteConversationStore(
+            cfg.CONVERSATION_STORE_PATH,
+            max_bytes=cfg.CONVERSATION_MAX_BYTES,
+            ttl=cfg.CONVERSATION_TTL,
+        )
+    return MemoryConversationStore(max_bytes=cfg.CONVERSATION_MAX_BYTES, ttl=cfg.CONVERSATION_TTL)
+
+
+conversation_store = make_conversation_store()
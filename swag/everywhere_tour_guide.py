@@ -1,34 +1,77 @@
-import anthropic
-import os
+import asyncio
+import hashlib
+import json
 import logging
 from typing import  AsyncGenerator
 
 from swag.assistant import Assistant 
+from swag.transport import get_anthropic
+from swag.geo import geohash_encode
+from swag.singleflight import StreamFlight
+from swag.landmarks import landmark_cache, landmark_hash
+from swag import config as cfg
+from swag.images import DECODE_ERRORS, prepare_tour_guide_images
 from swag.tools import SearchInternet, ReadWebsite, SearchForNearbyPlacesOfType
-from swag.prompts import SamAssistantPrompt, SamAssistantPromptOneImage
+from swag.prompts import SamAssistantPrompt, SamAssistantPromptOneImage, SamAssistantPromptCropped
 
 logger = logging.getLogger(__name__)
 
+# Concurrent runs for the same images at the same place share one assistant run.
+tour_guide_flights = StreamFlight("tour guide")
+
+
+def tour_guide_key(base_image: bytes, masked_image: bytes, location: str, lat: float, lon: float) -> str:
+    """Keys a run on the image hashes and the place tile the user is in."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(base_image)
+    digest.update(b"\0")
+    digest.update(masked_image)
+    return f"{digest.hexdigest()}:{geohash_encode(lat, lon, cfg.PLACES_TILE_PRECISION)}:{location}"
+
 async def run_everywhere_tour_guide(
-        base_image: str,
+        base_image: bytes,
         location: str,
         lat: float,
         lon: float,
-        masked_image: str = "",
+        masked_image: bytes = b"",
 ) -> AsyncGenerator[str, None]:
-    # cache : dict[str, str] = {}
+    if masked_image == base_image:
+        masked_image = b""
+
+    image_hash = None
+    if cfg.LANDMARK_CACHE_ENABLED:
+        try:
+            image_hash = await asyncio.to_thread(landmark_hash, base_image, masked_image)
+        except DECODE_ERRORS:
+            # Images that can't be hashed skip the cache; preparing them reports the error.
+            logger.warning("Could not hash the /tourguide images, skipping the landmark cache")
+        if image_hash is not None:
+            landmark = landmark_cache.get(lat, lon, image_hash, bool(masked_image))
+            if landmark is not None:
+                for chunk in landmark.chunks:
+                    yield chunk
+                return
 
-    if masked_image == "" or masked_image == base_image:
+    try:
+        images, cropped = await asyncio.to_thread(prepare_tour_guide_images, base_image, masked_image)
+    except DECODE_ERRORS as e:
+        logger.warning("Could not decode the /tourguide images: %s", e)
+        yield json.dumps({"type": "error", "text": "The image could not be read. Please send a JPEG or PNG image."})
+        return
+
+    if not masked_image:
         logger.info("Running Everywhere Tour Guide with one image")
-        masked_image = ""
         prompt = "Tell me about what I'm looking at."
-        system = str(SamAssistantPromptOneImage(location=location, lat=lat, lon=lon))
+        system = SamAssistantPromptOneImage(location=location, lat=lat, lon=lon).blocks()
+    elif cropped:
+        prompt = "Tell me about the object in the blue area surrounded by the white line."
+        system = SamAssistantPromptCropped(location=location, lat=lat, lon=lon).blocks()
     else:
 
         prompt = "Tell me about the object in the blue area surrounded by the white line."
-        system = str(SamAssistantPrompt(location=location, lat=lat, lon=lon))
+        system = SamAssistantPrompt(location=location, lat=lat, lon=lon).blocks()
 
-    client = anthropic.AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+    client = get_anthropic()
     tools = [SearchInternet, ReadWebsite, SearchForNearbyPlacesOfType]
     logger.info(f"Running Everywhere Tour Guide with location: {location}, lat: {lat}, lon: {lon}")
     assistant = Assistant(
@@ -38,5 +81,11 @@ async def run_everywhere_tour_guide(
         tools=tools
     )
 
-    async for chunk in assistant(prompt=prompt, images=[base_image, masked_image]):
+    chunks = []
+    async for chunk in assistant(prompt=prompt, images=images):
+        chunks.append(chunk)
         yield chunk
+
+    # Only answers the model finished are stored, not errors or runs cut short by a budget.
+    if image_hash is not None and assistant.finished:
+        landmark_cache.set(lat, lon, image_hash, bool(masked_image), chunks)
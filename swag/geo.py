@@ -0,0 +1,112 @@
+import math
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_M = 6_371_000
+
+
+def geohash_encode(lat: float, lon: float, precision: int) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+    return "".join(chars)
+
+
+def geohash_bbox(geohash: str) -> tuple[float, float, float, float]:
+    """Returns the (min_lat, min_lon, max_lat, max_lon) of a geohash cell."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def geohash_center(geohash: str) -> tuple[float, float]:
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash)
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+
+def geohash_neighbours(geohash: str) -> list[str]:
+    """Returns the cell and its (up to) eight surrounding cells."""
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash)
+    lat, lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    d_lat, d_lon = max_lat - min_lat, max_lon - min_lon
+    cells = []
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            n_lat = lat + i * d_lat
+            if not -90 <= n_lat <= 90:
+                continue
+            n_lon = (lon + j * d_lon + 180) % 360 - 180
+            cell = geohash_encode(n_lat, n_lon, len(geohash))
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance between two points in metres."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    d_lat, d_lon = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(d_lat / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def distance_to_cell(lat: float, lon: float, geohash: str) -> float:
+    """Distance in metres from a point to the closest point of a geohash cell."""
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash)
+    return haversine(lat, lon, min(max(lat, min_lat), max_lat), min(max(lon, min_lon), max_lon))
+
+
+def farthest_distance_to_cell(lat: float, lon: float, geohash: str) -> float:
+    """Distance in metres from a point to the farthest corner of a geohash cell, i.e.
+    the radius of the circle around the point that covers the whole cell."""
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash)
+    return max(haversine(lat, lon, c_lat, c_lon) for c_lat in (min_lat, max_lat) for c_lon in (min_lon, max_lon))
+
+
+def cells_within(lat: float, lon: float, radius: float, precision: int) -> list[str]:
+    """Returns the geohash cells that intersect the circle of `radius` metres around a point.
+    Grows ring by ring from the point's cell, so the result is complete whatever the
+    radius, and at high latitudes where cells are narrower than they are tall."""
+    start = geohash_encode(lat, lon, precision)
+    cells, frontier, seen = [start], [start], {start}
+    while frontier:
+        ring = []
+        for cell in frontier:
+            for neighbour in geohash_neighbours(cell):
+                if neighbour in seen:
+                    continue
+                seen.add(neighbour)
+                if distance_to_cell(lat, lon, neighbour) <= radius:
+                    ring.append(neighbour)
+        cells += ring
+        frontier = ring
+    return cells
+
+
+def cell_radius(geohash: str) -> float:
+    """Radius in metres of the circle, centred on the cell, that covers the whole cell."""
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash)
+    lat, lon = geohash_center(geohash)
+    return max(haversine(lat, lon, c_lat, c_lon) for c_lat in (min_lat, max_lat) for c_lon in (min_lon, max_lon))
@@ -0,0 +1,121 @@
+from typing import NamedTuple
+from PIL import Image
+from io import BytesIO
+import numpy as np
+import base64
+import cv2
+
+from . import config as cfg
+
+# The image types accepted by the Anthropic API, by their leading bytes.
+_SIGNATURES = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+}
+
+
+# What PIL raises for bytes it can't decode: unknown formats, truncated files and
+# decompression bombs.
+DECODE_ERRORS = (OSError, Image.DecompressionBombError)
+
+
+class EncodedImage(NamedTuple):
+    media_type: str
+    data: str  # base64
+
+
+def detect_media_type(image_bytes: bytes) -> str | None:
+    for signature, media_type in _SIGNATURES.items():
+        if image_bytes.startswith(signature):
+            return media_type
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def prepare_image(
+    image_bytes: bytes,
+    max_edge: int = cfg.IMAGE_MAX_EDGE,
+    quality: int = cfg.IMAGE_JPEG_QUALITY,
+    passthrough_bytes: int = cfg.IMAGE_PASSTHROUGH_MAX_BYTES,
+) -> EncodedImage:
+    """Downscales an image so its longest edge is at most `max_edge` and re-encodes it as
+    a JPEG. JPEGs that are already within both `max_edge` and `passthrough_bytes` are
+    sent as-is. Raises one of `DECODE_ERRORS` if the image can't be decoded."""
+    img = Image.open(BytesIO(image_bytes))
+    if (
+        detect_media_type(image_bytes) == "image/jpeg"
+        and len(image_bytes) <= passthrough_bytes
+        and max(img.size) <= max_edge
+    ):
+        img.load()
+        return EncodedImage("image/jpeg", base64.b64encode(image_bytes).decode("ascii"))
+    return encode_jpeg(img, max_edge, quality)
+
+
+def encode_jpeg(img: Image.Image, max_edge: int, quality: int) -> EncodedImage:
+    img = img.convert("RGB")
+    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return EncodedImage("image/jpeg", base64.b64encode(buffer.getvalue()).decode("ascii"))
+
+
+def mask_bbox(
+    base: Image.Image, masked: Image.Image, threshold: int = 60, sample_edge: int = 512
+) -> tuple[int, int, int, int] | None:
+    """Finds the bounding box, in `masked` coordinates, of the area where the masked image
+    differs from the base image, i.e. the blue mask drawn by /sam. Small specks of JPEG
+    noise are removed with a morphological opening first."""
+    if base.size != masked.size:
+        return None
+    scale = min(1.0, sample_edge / max(base.size))
+    size = (max(1, round(base.size[0] * scale)), max(1, round(base.size[1] * scale)))
+    a = np.asarray(base.convert("RGB").resize(size, Image.Resampling.BILINEAR), dtype=np.int16)
+    b = np.asarray(masked.convert("RGB").resize(size, Image.Resampling.BILINEAR), dtype=np.int16)
+    diff = (np.abs(a - b).sum(axis=2) > threshold).astype(np.uint8)
+    diff = cv2.morphologyEx(diff, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8))
+    ys, xs = np.nonzero(diff)
+    if len(xs) == 0:
+        return None
+    return (
+        int(xs.min() / scale),
+        int(ys.min() / scale),
+        min(base.size[0], int((xs.max() + 1) / scale)),
+        min(base.size[1], int((ys.max() + 1) / scale)),
+    )
+
+
+def crop_around(img: Image.Image, bbox: tuple[int, int, int, int], margin: float) -> Image.Image:
+    left, top, right, bottom = bbox
+    pad_x, pad_y = int((right - left) * margin), int((bottom - top) * margin)
+    return img.crop((
+        max(0, left - pad_x),
+        max(0, top - pad_y),
+        min(img.size[0], right + pad_x),
+        min(img.size[1], bottom + pad_y),
+    ))
+
+
+def prepare_tour_guide_images(
+    base_image: bytes, masked_image: bytes = b"", crop: bool = cfg.IMAGE_CROP_MASKED
+) -> tuple[list[EncodedImage], bool]:
+    """Prepares the images of a /tourguide request for the model. When `crop` is set, the
+    masked image is replaced by a close-up crop around the masked object. Returns the
+    images and whether the second one was cropped."""
+    images = [prepare_image(base_image)]
+    if not masked_image:
+        return images, False
+
+    if crop:
+        masked = Image.open(BytesIO(masked_image))
+        bbox = mask_bbox(Image.open(BytesIO(base_image)), masked)
+        if bbox is not None:
+            cropped = crop_around(masked, bbox, cfg.IMAGE_CROP_MARGIN)
+            images.append(encode_jpeg(cropped, cfg.IMAGE_MAX_EDGE, cfg.IMAGE_JPEG_QUALITY))
+            return images, True
+
+    images.append(prepare_image(masked_image))
+    return images, False
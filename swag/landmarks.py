@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Any, Optional
+from PIL import Image
+import numpy as np
+import threading
+import logging
+import time
+import uuid
+import cv2
+
+from . import config as cfg
+from .geo import geohash_encode, geohash_neighbours
+from .images import mask_bbox
+
+logger = logging.getLogger(__name__)
+
+
+def perceptual_hash(img: Image.Image) -> int:
+    """64-bit DCT hash of an image: similar-looking images differ in few bits."""
+    gray = np.asarray(img.convert("L").resize((32, 32), Image.Resampling.LANCZOS), dtype=np.float32)
+    low = cv2.dct(gray)[:8, :8].flatten()[1:]
+    bits = low > np.median(low)
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def landmark_hash(base_image: bytes, masked_image: bytes = b"") -> int:
+    """Hashes the region of the base image under the mask, or the whole frame when
+    there is no mask. The base image is used so the drawn mask doesn't affect the hash."""
+    base = Image.open(BytesIO(base_image))
+    # JPEGs are decoded at a reduced scale, which is all the hash needs.
+    base.draft("RGB", (512, 512))
+    if masked_image:
+        masked = Image.open(BytesIO(masked_image))
+        masked.draft("RGB", (512, 512))
+        bbox = mask_bbox(base, masked)
+        if bbox is not None:
+            return perceptual_hash(base.crop(bbox))
+    return perceptual_hash(base)
+
+
+@dataclass
+class Landmark:
+    id: str
+    geohash: str
+    image_hash: int
+    masked: bool
+    chunks: list[str]
+    expires_at: float
+    created_at: float = field(default_factory=time.time)
+    hits: int = 0
+
+
+class LandmarkCache:
+    """Stores /tourguide answers by perceptual image hash and geohash cell, expiring them
+    after `ttl` seconds and evicting the least recently used beyond `max_entries`."""
+
+    def __init__(self, precision: int, threshold: int, ttl: float, max_entries: int):
+        self.precision = precision
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Landmark] = OrderedDict()
+        self._cells: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, lat: float, lon: float, image_hash: int, masked: bool) -> Optional[Landmark]:
+        """Returns the closest stored answer within the Hamming threshold, if any."""
+        now = time.time()
+        best, best_distance = None, self.threshold + 1
+        with self._lock:
+            for cell in geohash_neighbours(geohash_encode(lat, lon, self.precision)):
+                for landmark_id in list(self._cells.get(cell, ())):
+                    landmark = self._entries[landmark_id]
+                    if landmark.expires_at < now:
+                        self._remove(landmark_id)
+                        continue
+                    if landmark.masked != masked:
+                        continue
+                    distance = (landmark.image_hash ^ image_hash).bit_count()
+                    if distance < best_distance:
+                        best, best_distance = landmark, distance
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best.id)
+            best.hits += 1
+            self.hits += 1
+        logger.info("Landmark cache hit %s at distance %d", best.id, best_distance)
+        return best
+
+    def set(self, lat: float, lon: float, image_hash: int, masked: bool, chunks: list[str]) -> Landmark:
+        geohash = geohash_encode(lat, lon, self.precision)
+        landmark = Landmark(
+            id=uuid.uuid4().hex,
+            geohash=geohash,
+            image_hash=image_hash,
+            masked=masked,
+            chunks=chunks,
+            expires_at=time.time() + self.ttl,
+        )
+        with self._lock:
+            self._entries[landmark.id] = landmark
+            self._cells.setdefault(geohash, set()).add(landmark.id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+        return landmark
+
+    def invalidate(
+        self, landmark_id: Optional[str] = None, lat: Optional[float] = None, lon: Optional[float] = None
+    ) -> int:
+        """Removes one entry by id, the entries in the cell of (lat, lon), or everything.
+        Returns the number of entries removed."""
+        with self._lock:
+            if landmark_id is not None:
+                ids = [landmark_id] if landmark_id in self._entries else []
+            elif lat is not None and lon is not None:
+                ids = list(self._cells.get(geohash_encode(lat, lon, self.precision), ()))
+            else:
+                ids = list(self._entries)
+            for landmark_id in ids:
+                self._remove(landmark_id)
+        return len(ids)
+
+    def entries(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    "id": landmark.id,
+                    "geohash": landmark.geohash,
+                    "image_hash": f"{landmark.image_hash:016x}",
+                    "masked": landmark.masked,
+                    "hits": landmark.hits,
+                    "created_at": landmark.created_at,
+                    "expires_at": landmark.expires_at,
+                    "preview": "".join(landmark.chunks)[:200],
+                }
+                for landmark in self._entries.values()
+            ]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _remove(self, landmark_id: str) -> None:
+        landmark = self._entries.pop(landmark_id)
+        cell = self._cells.get(landmark.geohash)
+        if cell is not None:
+            cell.discard(landmark_id)
+            if not cell:
+                del self._cells[landmark.geohash]
+
+
+landmark_cache = LandmarkCache(
+    precision=cfg.LANDMARK_GEOHASH_PRECISION,
+    threshold=cfg.LANDMARK_HAMMING_THRESHOLD,
+    ttl=cfg.LANDMARK_TTL,
+    max_entries=cfg.LANDMARK_MAX_ENTRIES,
+)
@@ -0,0 +1,150 @@
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import Optional
+import math
+import re
+
+from . import config as cfg
+from .compaction import CHARS_PER_TOKEN
+
+# The query of the user turn being answered. Tool tasks inherit it from the assistant.
+current_query: ContextVar[Optional[str]] = ContextVar("current_query", default=None)
+
+WORD = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what which who with".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+class SearchQueries:
+    """Remembers which search query surfaced each URL, so a page read afterwards can
+    be ranked against it. Each assistant keeps its own, so one user's searches never
+    rank another user's pages."""
+
+    def __init__(self, max_urls: int):
+        self.max_urls = max_urls
+        self._queries: OrderedDict[str, str] = OrderedDict()
+
+    def record(self, url: str, query: str) -> None:
+        self._queries[url] = query
+        self._queries.move_to_end(url)
+        while len(self._queries) > self.max_urls:
+            self._queries.popitem(last=False)
+
+    def get(self, url: str) -> Optional[str]:
+        return self._queries.get(url)
+
+
+# The SearchQueries of the assistant being run, set alongside current_query.
+current_search_queries: ContextVar[Optional[SearchQueries]] = ContextVar("current_search_queries", default=None)
+
+
+def split_passages(text: str, passage_chars: int) -> list[str]:
+    """Splits a page into passages of about `passage_chars` characters, breaking at
+    blank lines and merging short paragraphs with the ones that follow."""
+    passages: list[str] = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Headings start a new passage, so they stay with the text they introduce.
+        if current and (paragraph.startswith("#") or len(current) + len(paragraph) > passage_chars):
+            passages.append(current)
+            current = ""
+        while len(paragraph) > passage_chars:
+            cut = paragraph.rfind(" ", 0, passage_chars)
+            cut = cut if cut > 0 else passage_chars
+            passages.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip()
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+
+class BM25Index:
+    """Okapi BM25 over tokenized documents, with the document statistics computed once."""
+
+    def __init__(self, documents: list[list[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.frequencies = [Counter(document) for document in documents]
+        self.norms = []
+        average_length = sum(len(document) for document in documents) / max(len(documents), 1) or 1.0
+        for document in documents:
+            self.norms.append(k1 * (1 - b + b * len(document) / average_length))
+        document_frequency = Counter(term for document in documents for term in set(document))
+        self.idf = {
+            term: math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def scores(self, query: list[str]) -> list[float]:
+        terms = [term for term in set(query) if term in self.idf]
+        return [
+            sum(
+                self.idf[term] * frequencies[term] * (self.k1 + 1) / (frequencies[term] + norm)
+                for term in terms
+                if frequencies[term]
+            )
+            for frequencies, norm in zip(self.frequencies, self.norms)
+        ]
+
+
+def extract_passages(
+    text: str,
+    url: str,
+    query: Optional[str],
+    max_tokens: int = cfg.READ_WEBSITE_MAX_TOKENS,
+    top_k: int = cfg.READ_WEBSITE_TOP_K,
+    passage_chars: int = cfg.READ_WEBSITE_PASSAGE_CHARS,
+) -> str:
+    """Returns the passages of a page most relevant to `query`, in page order and
+    within `max_tokens`, headed by the source URL. Pages that fit the budget are
+    returned whole. Without a query, or if no passage matches it, the start of the
+    page is returned."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return f"Source: {url}\n\n{text}"
+
+    passages = split_passages(text, passage_chars)
+    query_tokens = tokenize(query or "")
+    scores = BM25Index([tokenize(passage) for passage in passages]).scores(query_tokens) if query_tokens else []
+    ranked = [
+        index
+        for index in sorted(range(len(passages)), key=lambda index: scores[index], reverse=True)
+        if scores[index] > 0
+    ] if scores else []
+    matched = bool(ranked)
+    if not matched:
+        ranked = list(range(len(passages)))
+
+    selected: list[int] = []
+    used = 0
+    for index in ranked:
+        if len(selected) == top_k:
+            break
+        if used + len(passages[index]) > max_chars:
+            continue
+        selected.append(index)
+        used += len(passages[index])
+
+    header = f"Source: {url}\n"
+    if matched:
+        header += f"The {len(selected)} of {len(passages)} passages most relevant to: {query}\n"
+    else:
+        header += f"The first {len(selected)} of {len(passages)} passages of the page.\n"
+
+    parts = []
+    previous = None
+    for index in sorted(selected):
+        if previous is not None and index != previous + 1:
+            parts.append("[...]")
+        parts.append(passages[index])
+        previous = index
+    return header + "\n" + "\n\n".join(parts)
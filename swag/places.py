@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+import asyncio
+import logging
+import time
+
+from .geo import cells_within, farthest_distance_to_cell, geohash_encode, haversine
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Fetches the places of the given types within `radius` metres of (lat, lon).
+FetchPlaces = Callable[[float, float, float, list[str]], Awaitable[list[dict[str, Any]]]]
+
+
+class PlaceTileCache:
+    """Caches nearby place results per (geohash tile, place type).
+
+    A radius query is answered by merging the tiles that intersect the circle and
+    filtering the places by their distance to the user, so nearby users share results.
+    When any of those tiles is missing for a type, one upstream query per type covers
+    all of them and its results are split into the tiles. Tiles older than `ttl` are
+    still served but refreshed in the background, tiles older than `max_age` are
+    fetched again before answering.
+    """
+
+    def __init__(
+        self,
+        fetch: FetchPlaces,
+        precision: int,
+        ttl: float,
+        max_age: float,
+        max_entries: int,
+        max_fetch_results: int,
+    ):
+        self.fetch = fetch
+        self.precision = precision
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.max_fetch_results = max_fetch_results
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.fetches = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[float, list[dict[str, Any]]]] = OrderedDict()
+        self._refreshing: set[tuple[tuple[str, ...], str]] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._fills: SingleFlight[list[dict[str, Any]]] = SingleFlight("places tile")
+
+    async def search(
+        self, lat: float, lon: float, types: list[str], radius: float, max_results: int
+    ) -> list[dict[str, Any]]:
+        tiles = tuple(cells_within(lat, lon, radius, self.precision))
+        found = await asyncio.gather(*(self._places_of_type(lat, lon, tiles, place_type) for place_type in types))
+
+        places: dict[str, tuple[float, dict[str, Any]]] = {}
+        for place in (place for type_places in found for place in type_places):
+            location = place.get("location", {})
+            distance = haversine(lat, lon, location.get("latitude", 0), location.get("longitude", 0))
+            if distance <= radius:
+                places[place["id"]] = (distance, place)
+
+        return [place for _, place in sorted(places.values(), key=lambda p: p[0])][:max_results]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "fetches": self.fetches,
+            "entries": len(self._entries),
+            "coalesced": self._fills.followers,
+        }
+
+    async def _places_of_type(
+        self, lat: float, lon: float, tiles: tuple[str, ...], place_type: str
+    ) -> list[dict[str, Any]]:
+        """The places of one type in `tiles`, from the cache if every tile is there."""
+        now = time.time()
+        entries = [self._entries.get((tile, place_type)) for tile in tiles]
+        if any(entry is None or now - entry[0] > self.max_age for entry in entries):
+            self.misses += 1
+            # Concurrent searches over the same tiles share the fetch.
+            return await self._fills.do((tiles, place_type), lambda: self._fill(lat, lon, tiles, place_type))
+
+        self.hits += 1
+        for tile in tiles:
+            self._entries.move_to_end((tile, place_type))
+        if any(now - entry[0] > self.ttl for entry in entries):
+            self._refresh_in_background(lat, lon, tiles, place_type)
+        return [place for entry in entries for place in entry[1]]
+
+    async def _fill(self, lat: float, lon: float, tiles: tuple[str, ...], place_type: str) -> list[dict[str, Any]]:
+        """Fetches one type for the circle around (lat, lon) that covers every tile, and
+        caches each tile the response covers completely. One type per fetch, so the
+        result cap of a dense type doesn't crowd out the others."""
+        corners = {tile: farthest_distance_to_cell(lat, lon, tile) for tile in tiles}
+        radius = max(corners.values())
+        places = await self.fetch(lat, lon, radius, [place_type])
+        self.fetches += 1
+
+        # Results are ranked by distance, so a capped response is only complete up to
+        # its farthest place.
+        complete = radius
+        if len(places) >= self.max_fetch_results:
+            complete = max(
+                haversine(lat, lon, place.get("location", {}).get("latitude", 0), place.get("location", {}).get("longitude", 0))
+                for place in places
+            )
+
+        buckets: dict[str, list[dict[str, Any]]] = {tile: [] for tile in tiles}
+        for place in places:
+            location = place.get("location", {})
+            tile = geohash_encode(location.get("latitude", 0), location.get("longitude", 0), self.precision)
+            if tile in buckets:
+                buckets[tile].append(place)
+
+        now = time.time()
+        for tile, tile_places in buckets.items():
+            if corners[tile] <= complete:
+                self._entries[(tile, place_type)] = (now, tile_places)
+                self._entries.move_to_end((tile, place_type))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return places
+
+    def _refresh_in_background(self, lat: float, lon: float, tiles: tuple[str, ...], place_type: str) -> None:
+        if (tiles, place_type) in self._refreshing:
+            return
+        self._refreshing.add((tiles, place_type))
+        self.refreshes += 1
+
+        async def refresh():
+            try:
+                await self._fill(lat, lon, tiles, place_type)
+            except Exception as e:
+                logger.warning("Failed to refresh places tiles %s for %s: %s", ",".join(tiles), place_type, e)
+            finally:
+                self._refreshing.discard((tiles, place_type))
+
+        task = asyncio.create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
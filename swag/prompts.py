@@ -1,11 +1,10 @@
 from pydantic import BaseModel
 
 
-class SamAssistantPrompt(BaseModel):
-
-    task: str = "You are an expert in using the internet to find information about locations and objects in images. The user provides you with two images, the first image is a screenshot from their eyeballs, and the second image is almost identical to the first, except for part of the image has been masked by a blue translucent area surrounded by a white line, containing a green dot. Your task is to provide the user with accurate information about the object in the blue area. Make sure to research as much information as you can about the object in the blue area, providing the user with more information than they could have gotten from the first image alone."
-    guidelines: list[str] = ["Only make broad assumptions about the image, and use the tools to confirm and get more details", "You MUST consider the users current location", "Make sure that the information is relevant to the object in the blue area, avoid detailing facts about other parts of the image", "You MUST always make a clarifying search to confirm that the object you believe you are looking at is in the user's current location", "Use as many tool use requests as required. You have no limit of the number of tool use requests", "If you receive a ValidationError from the tool, do not give up, try to fix it and make the request again", "For each fact, produce a citation to the source of the information", "The SearchForNearbyPlacesOfType is the ground truth, if the image is of a valid type of place, it will be in the NearbyPlacesTool"]
-    final_remarks: str = "If possible, start with the NearbyPlacesSearch tool. This will give you an idea of all the places that are within 100 metres of the user's location. If you can't find the object using this tool, you can use the SearchInternet tool to search for more information. If you find a website that may contain information about the object, you can use the ReadWebsite tool to extract the information from the website. You should repeat the 'SearchInternet', 'ReadWebsite' sequence if required.\n First, desscribe only what you can directly observe in the image. Express uncertainty where neccessary. Once you have a good idea of what the object is, use the tools to confirm your hypothesis. If you are unsure, ask the user for more information."
+class LocationPrompt(BaseModel):
+    task: str
+    guidelines: list[str]
+    final_remarks: str
     location: str
     lat: float
     lon: float
@@ -14,15 +13,27 @@ class SamAssistantPrompt(BaseModel):
         formatted_guidelines = "\n".join(self.guidelines)
         return f"{self.task}\n\n<guidelines>\n{formatted_guidelines}</guidelines>\n<users_current_location>{self.location}, lat: {self.lat}, lon: {self.lon}</users_current_location>\n{self.final_remarks}"
 
+    def blocks(self) -> list[str]:
+        """The prompt split into the part shared by every user and the user's location,
+        so the shared part can be served from the prompt cache."""
+        formatted_guidelines = "\n".join(self.guidelines)
+        return [
+            f"{self.task}\n\n<guidelines>\n{formatted_guidelines}</guidelines>\n{self.final_remarks}",
+            f"<users_current_location>{self.location}, lat: {self.lat}, lon: {self.lon}</users_current_location>",
+        ]
+
+
+class SamAssistantPrompt(LocationPrompt):
+    task: str = "You are an expert in using the internet to find information about locations and objects in images. The user provides you with two images, the first image is a screenshot from their eyeballs, and the second image is almost identical to the first, except for part of the image has been masked by a blue translucent area surrounded by a white line, containing a green dot. Your task is to provide the user with accurate information about the object in the blue area. Make sure to research as much information as you can about the object in the blue area, providing the user with more information than they could have gotten from the first image alone."
+    guidelines: list[str] = ["Only make broad assumptions about the image, and use the tools to confirm and get more details", "You MUST consider the users current location", "Make sure that the information is relevant to the object in the blue area, avoid detailing facts about other parts of the image", "You MUST always make a clarifying search to confirm that the object you believe you are looking at is in the user's current location", "Use as many tool use requests as required. You have no limit of the number of tool use requests", "If you receive a ValidationError from the tool, do not give up, try to fix it and make the request again", "For each fact, produce a citation to the source of the information", "The SearchForNearbyPlacesOfType is the ground truth, if the image is of a valid type of place, it will be in the NearbyPlacesTool"]
+    final_remarks: str = "If possible, start with the NearbyPlacesSearch tool. This will give you an idea of all the places that are within 100 metres of the user's location. If you can't find the object using this tool, you can use the SearchInternet tool to search for more information. If you find a website that may contain information about the object, you can use the ReadWebsite tool to extract the information from the website. You should repeat the 'SearchInternet', 'ReadWebsite' sequence if required.\n First, desscribe only what you can directly observe in the image. Express uncertainty where neccessary. Once you have a good idea of what the object is, use the tools to confirm your hypothesis. If you are unsure, ask the user for more information."
+
 
-class SamAssistantPromptOneImage(BaseModel):
+class SamAssistantPromptOneImage(LocationPrompt):
     task: str = "You are an expert in using the internet to find information about locations and objects in images. The user has provided you with an image, a screenshot from their eyeballs. Your task is to provide the user with accurate information about the object in the image."
     guidelines: list[str] = ["Only make broad assumptions about the image, and use the tools to confirm and get more details", "You MUST consider the users current location", "You MUST always make a clarifying search to confirm that the object you believe you are looking at is in the user's current location", "Use as many tool use requests as required. You have no limit of the number of tool use requests", "If you receive a ValidationError from the tool, do not give up, try to fix it and make the request again", "For each fact, produce a citation to the source of the information", "The SearchForNearbyPlacesOfType is the ground truth, if the image is of a valid type of place, it will be in the NearbyPlacesTool"]
     final_remarks: str = "If possible, start with the NearbyPlacesSearch tool. This will give you an idea of all the places that are within 100 metres of the user's location. If you can't find the location in the image using this tool, you can use the SearchInternet tool to search for more information. If you find a website that may contain information about the object, you can use the ReadWebsite tool to extract the information from the website.\n First, desscribe only what you can directly observe in the image. Express uncertainty where neccessary. Once you have a good idea of what the object is, use the tools to confirm your hypothesis. If you are unsure, ask the user for more information."
-    location: str
-    lat: float
-    lon: float
 
-    def __str__(self) -> str:
-        formatted_guidelines = "\n".join(self.guidelines)
-        return f"{self.task}\n\n<guidelines>\n{formatted_guidelines}</guidelines>\n<users_current_location>{self.location}, lat: {self.lat}, lon: {self.lon}</users_current_location>\n{self.final_remarks}"
+
+class SamAssistantPromptCropped(SamAssistantPrompt):
+    task: str = "You are an expert in using the internet to find information about locations and objects in images. The user provides you with two images, the first image is a screenshot from their eyeballs, and the second image is a close-up crop of the first around the object they are interested in, which has been masked by a blue translucent area surrounded by a white line, containing a green dot. Your task is to provide the user with accurate information about the object in the blue area. Make sure to research as much information as you can about the object in the blue area, providing the user with more information than they could have gotten from the first image alone."
@@ -1,57 +1,403 @@
-from sam2.sam2_image_predictor import SAM2ImagePredictor
-from sam2.build_sam import build_sam2
+from __future__ import annotations
+
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Optional
+import threading
+import asyncio
+import logging
+import queue
+import time
+import hashlib
+import json
 import cv2
-import torch
 import numpy as np
 from PIL import Image, ImageDraw
 from io import BytesIO
 import os
 import base64
 
+from . import config as cfg
+from .telemetry import SPAN_LATENCY, span
+
+# torch and sam2 are imported when the model is first loaded, so the server and the
+# image-only stages of benchmarks/sam_stages.py don't need them.
+if TYPE_CHECKING:
+    import torch
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+logger = logging.getLogger(__name__)
+
 checkpoint = os.environ["HOME"] + "/sam2/checkpoints/sam2.1_hiera_tiny.pt"
 config = "configs/sam2.1/sam2.1_hiera_t.yaml"
 
-predictor = SAM2ImagePredictor(build_sam2(config, checkpoint))
 
-def predict_mask(og_image: str, clicks: list[list[int]]) -> Image.Image:
-    image_bytes = base64.b64decode(og_image)
-    pil_img = Image.open(BytesIO(image_bytes))
-    img = np.array(pil_img.convert("RGB"))
 
-    point_coords = np.array(clicks)
-    point_labels = np.array([1 for _ in range(len(clicks))])
+def get_device() -> str:
+    import torch
 
-    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
-        predictor.set_image(img)
-        masks, scores, logits = predictor.predict(
-                point_coords = point_coords,
-                point_labels = point_labels,
-                multimask_output=True
-        )
+    return "cuda" if torch.cuda.is_available() else "cpu"
 
 
-    sorted_ind = np.argsort(scores)[-1]
-    mask = masks[sorted_ind]
-    # score = scores[sorted_ind]
-    # logit = logits[sorted_ind]
+def autocast():
+    """bfloat16 autocast on GPU. On CPU the model runs as configured by the backend."""
+    import torch
 
+    if get_device() == "cuda":
+        return torch.autocast("cuda", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def make_predictor(model: torch.nn.Module) -> SAM2ImagePredictor:
+    """A predictor over the shared model. Each holds its own image state."""
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    return SAM2ImagePredictor(model)
+
+
+class EmbeddingCache:
+    """An LRU of SAM2 image embeddings keyed by a hash of the image, bounded by the
+    total size of the cached tensors. Lets follow-up clicks on the same photo skip the
+    image encoder and only run the prompt decoder."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[dict[str, Any], list, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[dict[str, Any], list] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key: str, features: dict[str, Any], orig_hw: list) -> None:
+        size = features["image_embed"].nbytes + sum(f.nbytes for f in features["high_res_feats"])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[2]
+            self._entries[key] = (features, orig_hw, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+embedding_cache = EmbeddingCache(max_bytes=cfg.SAM_EMBEDDING_CACHE_MAX_BYTES)
+
+
+def image_hash(image_bytes: bytes) -> str:
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+@dataclass
+class SegmentationJob:
+    key: str | None  # None skips the embedding cache
+    img: np.ndarray
+    point_coords: np.ndarray
+    point_labels: np.ndarray
+    future: Future = field(default_factory=Future)
+    submitted_at: float = field(default_factory=time.perf_counter)
+
+
+class SamBusyError(Exception):
+    """Raised when the segmentation queue is full."""
+
+
+class SamBatcher:
+    """Runs segmentation requests on a pool of worker threads, each with its own
+    predictor over the shared model so that requests never race on image state.
+
+    Requests that arrive within `window` seconds of each other (up to `max_batch_size`)
+    are run as one batch: images without a cached embedding go through `encoder` (see
+    swag/sam_backend.py) together, then the decoder runs on the whole batch. The queue is bounded by
+    `max_queue_size`, beyond which `submit` raises `SamBusyError`.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        encoder: Callable[[torch.Tensor], dict[str, Any]],
+        window: float,
+        max_batch_size: int,
+        workers: int,
+        max_queue_size: int,
+    ):
+        self.encoder = encoder
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queue: queue.Queue[SegmentationJob] = queue.Queue(maxsize=max_queue_size)
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(make_predictor(model),),
+                name=f"sam-worker-{i}",
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def is_full(self) -> bool:
+        return self._queue.full()
+
+    def submit(self, key: str | None, img: np.ndarray, point_coords: np.ndarray, point_labels: np.ndarray) -> Future:
+        job = SegmentationJob(key, img, point_coords, point_labels)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise SamBusyError("Too many segmentation requests are queued")
+        return job.future
+
+    def _run(self, predictor: SAM2ImagePredictor) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                started = time.perf_counter()
+                for job in batch:
+                    SPAN_LATENCY.labels("sam", "queue").observe(started - job.submitted_at)
+                try:
+                    masks = self._predict_batch(predictor, batch)
+                except Exception as e:
+                    logger.exception("SAM batch of %d failed", len(batch))
+                    for job in batch:
+                        _resolve(job.future, exception=e)
+                    continue
+                for job, mask in zip(batch, masks):
+                    _resolve(job.future, result=mask)
+            except Exception as e:
+                # Never lets one batch stop the worker: its jobs fail, later jobs still run.
+                logger.exception("SAM worker failed on a batch")
+                for job in batch:
+                    _resolve(job.future, exception=e)
+
+    def _next_batch(self) -> list[SegmentationJob]:
+        """Waits for a job, then collects the jobs that arrive within the window. Jobs
+        whose caller has already gone away (cancelled futures) are dropped."""
+        batch: list[SegmentationJob] = []
+        while not batch:
+            job = self._queue.get()
+            if job.future.set_running_or_notify_cancel():
+                batch.append(job)
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job.future.set_running_or_notify_cancel():
+                batch.append(job)
+        return batch
+
+    def _predict_batch(self, predictor: SAM2ImagePredictor, batch: list[SegmentationJob]) -> list[np.ndarray]:
+        import torch
+
+        with torch.inference_mode(), autocast():
+            # Jobs without a cache key are encoded on their own and never cached.
+            keys = [job.key if job.key is not None else id(job) for job in batch]
+            features = {}
+            uncached = {}
+            for key, job in zip(keys, batch):
+                if key in features or key in uncached:
+                    continue
+                cached = embedding_cache.get(key) if job.key is not None else None
+                if cached is None:
+                    uncached[key] = job.img
+                else:
+                    features[key] = cached
+
+            if uncached:
+                images = list(uncached.values())
+                with span("sam", "encode", images=len(images), batch=len(batch)):
+                    encoded = encode_images(self.encoder, prepare_images(predictor, images))
+                for key, image, image_features in zip(uncached, images, encoded):
+                    features[key] = (image_features, [image.shape[:2]])
+                    if isinstance(key, str):
+                        embedding_cache.put(key, *features[key])
+
+            with span("sam", "decode", batch=len(batch)):
+                return decode_masks(
+                    predictor,
+                    [features[key][0] for key in keys],
+                    [features[key][1][0] for key in keys],
+                    [job.point_coords for job in batch],
+                    [job.point_labels for job in batch],
+                )
+
+
+def _resolve(future: Future, result: Any = None, exception: Optional[BaseException] = None) -> None:
+    if future.done():
+        return
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def prepare_images(predictor: SAM2ImagePredictor, images: list[np.ndarray]) -> torch.Tensor:
+    """Resizes and normalizes `images` into one input batch for the image encoder."""
+    return predictor._transforms.forward_batch(images).to(predictor.device)
 
-    color = np.array([30/255, 144/255, 255/255, 0.5])
-    h, w = mask.shape[-2:]
-    mask = mask.astype(np.uint8)
-    mask_image = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = [cv2.approxPolyDP(contour, epsilon=0.01, closed=True) for contour in contours]
-    mask_image = cv2.drawContours(mask_image, contours, -1, (1, 1, 1, 1.0), thickness=2)
 
-    if pil_img.mode != 'RGBA':
-        pil_img = pil_img.convert('RGBA')
+def encode_images(encoder: Callable[[torch.Tensor], dict[str, Any]], batch: torch.Tensor) -> list[dict[str, Any]]:
+    """Runs the image encoder on a batch, returning the features of each image."""
+    encoded = encoder(batch)
+    # Cloned so a cached entry doesn't keep the whole batch alive.
+    return [
+        {
+            "image_embed": encoded["image_embed"][i:i + 1].clone(),
+            "high_res_feats": [feat[i:i + 1].clone() for feat in encoded["high_res_feats"]],
+        }
+        for i in range(batch.shape[0])
+    ]
 
-    mask_pil = Image.fromarray((mask_image * 255).astype(np.uint8), 'RGBA')
 
-    result = Image.alpha_composite(pil_img, mask_pil)
+def decode_masks(
+    predictor: SAM2ImagePredictor,
+    features: list[dict[str, Any]],
+    orig_hw: list[tuple[int, int]],
+    point_coords: list[np.ndarray],
+    point_labels: list[np.ndarray],
+) -> list[np.ndarray]:
+    """Runs the prompt decoder on each image's features and clicks, returning the
+    highest-scoring mask of each."""
+    import torch
 
+    predictor.reset_predictor()
+    predictor._features = {
+        "image_embed": torch.cat([f["image_embed"] for f in features]),
+        "high_res_feats": [
+            torch.cat([f["high_res_feats"][level] for f in features])
+            for level in range(len(features[0]["high_res_feats"]))
+        ],
+    }
+    predictor._orig_hw = orig_hw
+    predictor._is_image_set = True
+    predictor._is_batch = True
+    masks, scores, _ = predictor.predict_batch(
+        point_coords_batch=point_coords,
+        point_labels_batch=point_labels,
+        multimask_output=True,
+    )
+    return [image_masks[np.argsort(image_scores)[-1]] for image_masks, image_scores in zip(masks, scores)]
+
+
+# The model and the batcher are loaded on first use (or by `warm_up`), so importing
+# this module stays cheap for processes that never segment.
+_init_lock = threading.Lock()
+_sam_model: torch.nn.Module | None = None
+_batcher: SamBatcher | None = None
+status = "cold"  # cold -> loading -> warm, or failed
+
+
+def get_model() -> torch.nn.Module:
+    global _sam_model
+    if _sam_model is None:
+        with _init_lock:
+            if _sam_model is None:
+                import torch
+                from sam2.build_sam import build_sam2
+
+                if cfg.SAM_TORCH_THREADS:
+                    torch.set_num_threads(cfg.SAM_TORCH_THREADS)
+                logger.info("Loading SAM2 from %s", checkpoint)
+                _sam_model = build_sam2(config, checkpoint, device=get_device())
+    return _sam_model
+
+
+def get_batcher() -> SamBatcher:
+    global _batcher
+    if _batcher is None:
+        from .sam_backend import load_backend
+
+        model = get_model()
+        with _init_lock:
+            if _batcher is None:
+                _batcher = SamBatcher(
+                    model,
+                    load_backend(model),
+                    window=cfg.SAM_BATCH_WINDOW,
+                    max_batch_size=cfg.SAM_MAX_BATCH_SIZE,
+                    workers=cfg.SAM_WORKERS,
+                    max_queue_size=cfg.SAM_QUEUE_SIZE,
+                )
+    return _batcher
+
+
+def warm_up() -> None:
+    """Loads the model and runs one dummy segmentation, so the first request doesn't
+    pay for the cold start."""
+    global status
+    status = "loading"
+    try:
+        img = np.zeros((64, 64, 3), dtype=np.uint8)
+        get_batcher().submit(None, img, np.array([[32, 32]]), np.array([1])).result()
+    except Exception:
+        status = "failed"
+        logger.exception("SAM warm-up failed")
+        raise
+    status = "warm"
+    logger.info("SAM is warm")
+
+
+# Decoding the uploaded image and rendering the result run here, off the event loop.
+io_executor = ThreadPoolExecutor(max_workers=cfg.SAM_IO_WORKERS, thread_name_prefix="sam-io")
+
+
+def decode_image(image: bytes | str) -> tuple[str, Image.Image, np.ndarray]:
+    """Decodes an uploaded image, given either as the raw file bytes or as a base64 string."""
+    image_bytes = base64.b64decode(image) if isinstance(image, str) else image
+    pil_img = Image.open(BytesIO(image_bytes))
+    img = np.array(pil_img.convert("RGB"))
+    return image_hash(image_bytes), pil_img, img
+
+
+def mask_contours(mask: np.ndarray, epsilon: float) -> list[np.ndarray]:
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [cv2.approxPolyDP(contour, epsilon=epsilon, closed=True) for contour in contours]
+
+
+def render_mask(
+    pil_img: Image.Image, mask: np.ndarray, point_coords: np.ndarray, point_labels: np.ndarray
+) -> Image.Image:
+    """Draws the mask as a translucent blue area with a white outline, plus the clicks.
+    Works on uint8 pixels only: the 50% blend is `(pixel + colour) // 2`."""
+    mask = mask.astype(bool)
+    img = np.array(pil_img.convert("RGB"))
+    color = np.array([30, 144, 255], dtype=np.uint16)
+    img[mask] = ((img[mask] + color) >> 1).astype(np.uint8)
+    cv2.drawContours(img, mask_contours(mask, epsilon=0.01), -1, (255, 255, 255), thickness=2)
+
+    result = Image.fromarray(img)
     if point_coords is not None and point_labels is not None:
         draw = ImageDraw.Draw(result)
 
@@ -63,6 +409,79 @@ def predict_mask(og_image: str, clicks: list[list[int]]) -> Image.Image:
                         fill=color)
             draw.ellipse([x-radius, y-radius, x+radius, y+radius],
                         outline='white', width=2)
-    
-    result = result.convert("RGB")
+
     return result
+
+
+def mask_to_rle(mask: np.ndarray) -> list[int]:
+    """Run lengths of the row-major flattened mask, starting with a run of 0s."""
+    flat = mask.astype(bool).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(boundaries).tolist()
+    if flat.size and flat[0]:
+        counts.insert(0, 0)
+    return counts
+
+
+def encode_png(mask: np.ndarray) -> bytes:
+    img_byte_arr = BytesIO()
+    Image.fromarray(mask.astype(bool)).save(img_byte_arr, format="PNG", optimize=True)
+    return img_byte_arr.getvalue()
+
+
+def encode_result(
+    pil_img: Image.Image,
+    mask: np.ndarray,
+    point_coords: np.ndarray,
+    point_labels: np.ndarray,
+    response_format: str,
+) -> tuple[bytes, str]:
+    """Encodes the segmentation as one of `RESPONSE_FORMATS`, returning the body and its media type."""
+    if response_format == "composite":
+        return encode_jpeg(render_mask(pil_img, mask, point_coords, point_labels)), "image/jpeg"
+    if response_format == "png":
+        return encode_png(mask), "image/png"
+
+    h, w = mask.shape[-2:]
+    if response_format == "rle":
+        body = {"size": [h, w], "counts": mask_to_rle(mask)}
+    elif response_format == "polygons":
+        contours = mask_contours(mask, epsilon=cfg.SAM_POLYGON_EPSILON)
+        body = {"size": [h, w], "polygons": [contour.reshape(-1, 2).tolist() for contour in contours]}
+    else:
+        raise ValueError(f"Unknown response format {response_format}. Choose from: {', '.join(RESPONSE_FORMATS)}")
+    return json.dumps(body, separators=(",", ":")).encode("utf-8"), "application/json"
+
+
+RESPONSE_FORMATS = ("composite", "rle", "png", "polygons")
+
+
+def encode_jpeg(image: Image.Image) -> bytes:
+    img_byte_arr = BytesIO()
+    image.save(img_byte_arr, format="JPEG")
+    return img_byte_arr.getvalue()
+
+
+async def segment(
+    og_image: bytes | str, clicks: list[list[int]], response_format: str = "composite"
+) -> tuple[bytes, str]:
+    """Segments the image (raw file bytes or a base64 string) without blocking the event
+    loop, returning the result encoded as `response_format` and its media type. Raises
+    `SamBusyError` when the segmentation queue is full."""
+    loop = asyncio.get_running_loop()
+    batcher = _batcher or await loop.run_in_executor(None, get_batcher)
+    if batcher.is_full():
+        raise SamBusyError("Too many segmentation requests are queued")
+
+    with span("sam", "load_image"):
+        key, pil_img, img = await loop.run_in_executor(io_executor, decode_image, og_image)
+    point_coords = np.array(clicks)
+    point_labels = np.array([1 for _ in range(len(clicks))])
+
+    with span("sam", "predict"):
+        mask = await asyncio.wrap_future(batcher.submit(key, img, point_coords, point_labels))
+    with span("sam", "render", format=response_format):
+        return await loop.run_in_executor(
+            io_executor, encode_result, pil_img, mask, point_coords, point_labels, response_format
+        )
@@ -0,0 +1,231 @@
+"""Image encoder backends for SAM2 on CPU.
+
+The image encoder is where nearly all of the SAM2 inference time goes, so it can be
+swapped for a traced TorchScript module or an ONNX Runtime session, optionally with
+dynamic int8 quantization. The prompt encoder and mask decoder are small and stay in
+eager PyTorch.
+
+Run `python -m swag.sam_backend --backend onnx --quantize` to check a backend's
+parity against the eager model on the images in `imgs/`.
+"""
+from pathlib import Path
+from typing import Any
+import argparse
+import logging
+import sys
+
+import numpy as np
+import torch
+
+from . import config as cfg
+
+logger = logging.getLogger(__name__)
+
+# Sizes of the backbone feature maps of the sam2.1 models, from high to low resolution.
+BACKBONE_FEATURE_SIZES = [(256, 256), (128, 128), (64, 64)]
+
+
+class ImageEncoder(torch.nn.Module):
+    """The part of SAM2ImagePredictor.set_image_batch that runs the model, returning
+    the image embedding and the two high resolution feature maps."""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        backbone_out = self.model.forward_image(images)
+        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+        if self.model.directly_add_no_mem_embed:
+            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+
+        batch_size = images.shape[0]
+        feats = [
+            feat.permute(1, 2, 0).reshape(batch_size, -1, *feat_size)
+            for feat, feat_size in zip(vision_feats[::-1], BACKBONE_FEATURE_SIZES[::-1])
+        ][::-1]
+        return feats[-1], feats[0], feats[1]
+
+
+def to_features(outputs: tuple[torch.Tensor, torch.Tensor, torch.Tensor]) -> dict[str, Any]:
+    image_embed, high_res_0, high_res_1 = outputs
+    return {"image_embed": image_embed, "high_res_feats": [high_res_0, high_res_1]}
+
+
+class EagerBackend:
+    def __init__(self, model: torch.nn.Module, quantize: bool = False):
+        encoder = ImageEncoder(model).eval()
+        if quantize:
+            encoder = torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+        self.encoder = encoder
+
+    def __call__(self, images: torch.Tensor) -> dict[str, Any]:
+        return to_features(self.encoder(images))
+
+
+class TracedBackend(EagerBackend):
+    """The encoder traced and frozen with a batch of one image. Freezing can bake the
+    example's shapes into the graph, so batches are run through it one image at a time."""
+
+    def __init__(self, model: torch.nn.Module, quantize: bool = False):
+        super().__init__(model, quantize)
+        example = torch.zeros(1, 3, model.image_size, model.image_size)
+        with torch.inference_mode():
+            traced = torch.jit.trace(self.encoder, example)
+        self.encoder = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+    def __call__(self, images: torch.Tensor) -> dict[str, Any]:
+        outputs = [self.encoder(image) for image in images.split(1)]
+        return to_features(tuple(torch.cat(parts) for parts in zip(*outputs)))
+
+
+class OnnxBackend:
+    def __init__(self, model: torch.nn.Module, quantize: bool = False, cache_dir: str = cfg.SAM_ONNX_DIR):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx SAM backend needs `onnx` and `onnxruntime` to be installed")
+
+        path = export_onnx(model, Path(cache_dir))
+        if quantize:
+            path = quantize_onnx(path)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if cfg.SAM_TORCH_THREADS:
+            options.intra_op_num_threads = cfg.SAM_TORCH_THREADS
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, images: torch.Tensor) -> dict[str, Any]:
+        outputs = self.session.run(None, {"images": images.cpu().numpy().astype(np.float32)})
+        return to_features(tuple(torch.from_numpy(output) for output in outputs))
+
+
+def export_onnx(model: torch.nn.Module, cache_dir: Path) -> Path:
+    path = cache_dir / "sam2_image_encoder.onnx"
+    if path.exists():
+        return path
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    logger.info("Exporting the SAM2 image encoder to %s", path)
+    example = torch.zeros(1, 3, model.image_size, model.image_size)
+    with torch.no_grad():
+        torch.onnx.export(
+            ImageEncoder(model).eval(),
+            (example,),
+            str(path),
+            input_names=["images"],
+            output_names=["image_embed", "high_res_feat_0", "high_res_feat_1"],
+            dynamic_axes={
+                "images": {0: "batch"},
+                "image_embed": {0: "batch"},
+                "high_res_feat_0": {0: "batch"},
+                "high_res_feat_1": {0: "batch"},
+            },
+            opset_version=17,
+        )
+    return path
+
+
+def quantize_onnx(path: Path) -> Path:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized = path.with_name(path.stem + ".int8.onnx")
+    if not quantized.exists():
+        logger.info("Quantizing %s to %s", path, quantized)
+        quantize_dynamic(str(path), str(quantized), weight_type=QuantType.QInt8)
+    return quantized
+
+
+BACKENDS = {"eager": EagerBackend, "traced": TracedBackend, "onnx": OnnxBackend}
+
+
+def load_backend(model: torch.nn.Module, name: str = cfg.SAM_BACKEND, quantize: bool = cfg.SAM_QUANTIZE):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown SAM backend {name}. Choose from: {', '.join(BACKENDS)}")
+    logger.info("Loading the %s SAM image encoder (quantize=%s)", name, quantize)
+    return BACKENDS[name](model, quantize=quantize)
+
+
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+def predict_mask(predictor, features: dict[str, Any], hw: tuple[int, int], click: np.ndarray) -> np.ndarray:
+    predictor.reset_predictor()
+    predictor._features = features
+    predictor._orig_hw = [hw]
+    predictor._is_image_set = True
+    image_masks, scores, _ = predictor.predict(point_coords=click, point_labels=np.array([1]))
+    return image_masks[np.argmax(scores)] > 0
+
+
+def image_features(features: dict[str, Any], i: int) -> dict[str, Any]:
+    return {
+        "image_embed": features["image_embed"][i:i + 1],
+        "high_res_feats": [feat[i:i + 1] for feat in features["high_res_feats"]],
+    }
+
+
+def check_parity(
+    model: torch.nn.Module, backend, image_paths: list[Path], batch_size: int = cfg.SAM_MAX_BATCH_SIZE
+) -> list[dict[str, Any]]:
+    """Compares the features and the masks for a click in the middle of each image
+    between the eager encoder and `backend`, with each image encoded on its own and in
+    batches of `batch_size` as SamBatcher sends them."""
+    from PIL import Image
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    predictor = SAM2ImagePredictor(model)
+    eager = EagerBackend(model)
+    imgs = [np.array(Image.open(image_path).convert("RGB")) for image_path in image_paths]
+    results = []
+    with torch.inference_mode():
+        inputs = [predictor._transforms.forward_batch([img]) for img in imgs]
+        batched = []
+        for start in range(0, len(inputs), batch_size):
+            features = backend(torch.cat(inputs[start:start + batch_size]))
+            batched += [image_features(features, i) for i in range(features["image_embed"].shape[0])]
+
+        for image_path, img, images, batch_features in zip(image_paths, imgs, inputs, batched):
+            h, w = img.shape[:2]
+            click = np.array([[w // 2, h // 2]])
+            reference = eager(images)
+            candidate = backend(images)
+            masks = [predict_mask(predictor, features, (h, w), click) for features in (reference, candidate, batch_features)]
+            results.append({
+                "image": image_path.name,
+                "max_abs_diff": float((reference["image_embed"] - candidate["image_embed"]).abs().max()),
+                "batch_max_abs_diff": float((reference["image_embed"] - batch_features["image_embed"]).abs().max()),
+                "cosine": float(torch.nn.functional.cosine_similarity(
+                    reference["image_embed"].flatten(), candidate["image_embed"].flatten(), dim=0
+                )),
+                "mask_iou": mask_iou(masks[0], masks[1]),
+                "batch_mask_iou": mask_iou(masks[0], masks[2]),
+            })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check a SAM backend against the eager model.")
+    parser.add_argument("--backend", choices=list(BACKENDS), default=cfg.SAM_BACKEND)
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--images", type=Path, default=Path(__file__).parent.parent / "imgs")
+    parser.add_argument("--min-iou", type=float, default=0.9)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from swag.sam import get_model
+
+    model = get_model()
+    image_paths = sorted(p for p in args.images.iterdir() if p.suffix in (".jpg", ".png"))
+    results = check_parity(model, load_backend(model, args.backend, args.quantize), image_paths)
+    for result in results:
+        print(
+            f"{result['image']:20} max_abs_diff={result['max_abs_diff']:.4f} cosine={result['cosine']:.5f} "
+            f"mask_iou={result['mask_iou']:.4f} batch_max_abs_diff={result['batch_max_abs_diff']:.4f} "
+            f"batch_mask_iou={result['batch_mask_iou']:.4f}"
+        )
+    sys.exit(0 if all(min(r["mask_iou"], r["batch_mask_iou"]) >= args.min_iou for r in results) else 1)
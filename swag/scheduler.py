@@ -0,0 +1,195 @@
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+from swag import config as cfg
+from swag.telemetry import OUTBOUND_QUEUE_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ProviderLimiter:
+    """Rate limit, concurrency cap and queue-wait statistics for one provider."""
+
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def acquire(self) -> None:
+        """Waits for a concurrency slot and a token, recording the time spent queued."""
+        started = time.monotonic()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+            try:
+                await self.bucket.acquire()
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.queued -= 1
+        wait = time.monotonic() - started
+        self.requests += 1
+        self.in_flight += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        OUTBOUND_QUEUE_WAIT.labels(self.name).observe(wait)
+        if wait > 1.0:
+            logger.info("Waited %.2fs for a %s slot", wait, self.name)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "failures": self.failures,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "queue_wait_avg": self.wait_total / self.requests if self.requests else 0.0,
+            "queue_wait_max": self.wait_max,
+        }
+
+
+limiters: dict[str, ProviderLimiter] = {
+    name: ProviderLimiter(name, rate, burst, max_concurrency)
+    for name, (rate, burst, max_concurrency) in cfg.OUTBOUND_LIMITS.items()
+}
+
+
+def get_limiter(provider: Optional[str]) -> Optional[ProviderLimiter]:
+    return limiters.get(provider) if provider else None
+
+
+def provider_for(host: str) -> Optional[str]:
+    return cfg.OUTBOUND_PROVIDERS.get(host)
+
+
+def backoff(attempt: int, retry_after: Optional[str]) -> float:
+    """Returns the delay before retry `attempt`: the server's Retry-After if it sent one,
+    otherwise exponential backoff with full jitter."""
+    if retry_after:
+        try:
+            return min(float(retry_after), cfg.OUTBOUND_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(cfg.OUTBOUND_BACKOFF_MAX, cfg.OUTBOUND_BACKOFF_BASE * 2 ** attempt))
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Holds the provider slot until the response body has been read or closed, so
+    streamed responses count against the concurrency cap for as long as they run."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, limiter: ProviderLimiter):
+        self._stream = stream
+        self._limiter = limiter
+        self._released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._limiter.release()
+
+
+class SchedulingTransport(httpx.AsyncBaseTransport):
+    """An httpx transport that sends every request through its provider's limiter and
+    retries rate-limited and failed requests."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: ProviderLimiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                response = await self.transport.handle_async_request(request)
+            except BaseException:
+                self.limiter.release()
+                raise
+
+            if response.status_code not in cfg.OUTBOUND_RETRY_STATUSES or attempt >= cfg.OUTBOUND_MAX_RETRIES:
+                if response.status_code in cfg.OUTBOUND_RETRY_STATUSES:
+                    self.limiter.failures += 1
+                return httpx.Response(
+                    status_code=response.status_code,
+                    headers=response.headers,
+                    stream=_ReleasingStream(response.stream, self.limiter),
+                    extensions=response.extensions,
+                )
+
+            await response.aclose()
+            self.limiter.release()
+            if response.status_code == 429:
+                self.limiter.throttled += 1
+            self.limiter.retries += 1
+            delay = backoff(attempt, response.headers.get("retry-after"))
+            logger.warning(
+                "%s %s returned %d, retrying in %.2fs", request.method, request.url.host, response.status_code, delay
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def stats() -> dict[str, Any]:
+    return {name: limiter.stats() for name, limiter in limiters.items()}
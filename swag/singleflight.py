@@ -0,0 +1,123 @@
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Generic, Hashable, TypeVar
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Coalesces concurrent calls with the same key into one in-flight call, whose
+    result (or exception) every caller receives.
+
+    The call runs in its own task, so a caller that goes away doesn't cancel it for
+    the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.leaders = 0
+        self.followers = 0
+        self._flights: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._flights.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            self.followers += 1
+            logger.info("Joined in-flight %s call", self.name)
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, Any]:
+        return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)}
+
+
+class _Broadcast:
+    """The chunks of one streamed run, buffered so that late subscribers replay them."""
+
+    def __init__(self, key: Hashable) -> None:
+        self.key = key
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task: asyncio.Task | None = None
+
+
+class StreamFlight:
+    """Coalesces concurrent streamed runs with the same key. The first caller's run is
+    consumed by a background task, and every caller (including the first) receives all
+    of its chunks in order, from the start. The run is cancelled once every caller
+    has gone away."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.leaders = 0
+        self.followers = 0
+        self._flights: dict[Hashable, _Broadcast] = {}
+
+    def stream(self, key: Hashable, fn: Callable[[], AsyncIterator[str]]) -> AsyncGenerator[str, None]:
+        broadcast = self._flights.get(key)
+        if broadcast is None:
+            self.leaders += 1
+            broadcast = _Broadcast(key)
+            self._flights[key] = broadcast
+            broadcast.task = asyncio.ensure_future(self._produce(broadcast, fn))
+        else:
+            self.followers += 1
+            logger.info("Joined in-flight %s run", self.name)
+        return self._subscribe(broadcast)
+
+    async def _produce(self, broadcast: _Broadcast, fn: Callable[[], AsyncIterator[str]]) -> None:
+        try:
+            async for chunk in fn():
+                async with broadcast.changed:
+                    broadcast.chunks.append(chunk)
+                    broadcast.changed.notify_all()
+        except BaseException as e:
+            broadcast.error = e
+            if not isinstance(e, asyncio.CancelledError):
+                logger.exception("%s run failed", self.name)
+        finally:
+            # No new subscribers once the run has finished, they start a run of their own.
+            self._forget(broadcast)
+            async with broadcast.changed:
+                broadcast.done = True
+                broadcast.changed.notify_all()
+
+    async def _subscribe(self, broadcast: _Broadcast) -> AsyncGenerator[str, None]:
+        broadcast.subscribers += 1
+        position = 0
+        try:
+            while True:
+                async with broadcast.changed:
+                    await broadcast.changed.wait_for(
+                        lambda: position < len(broadcast.chunks) or broadcast.done
+                    )
+                    chunks = broadcast.chunks[position:]
+                    done = broadcast.done
+                position += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                if done and position == len(broadcast.chunks):
+                    if broadcast.error is not None and not isinstance(broadcast.error, asyncio.CancelledError):
+                        raise broadcast.error
+                    return
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done and broadcast.task:
+                self._forget(broadcast)
+                broadcast.task.cancel()
+
+    def _forget(self, broadcast: _Broadcast) -> None:
+        if self._flights.get(broadcast.key) is broadcast:
+            del self._flights[broadcast.key]
+
+    def stats(self) -> dict[str, Any]:
+        return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)}
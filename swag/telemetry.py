@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+import asyncio
+import logging
+import time
+import uuid
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+# Set per HTTP request by `TelemetryMiddleware` and inherited by the tasks it starts.
+trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    "swag_request_duration_seconds",
+    "Time until the response of a request has been sent, by endpoint.",
+    ["endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+SPAN_LATENCY = Histogram(
+    "swag_span_duration_seconds",
+    "Latency of traced stages: model calls by model, tool calls by tool and SAM stages.",
+    ["kind", "name"],
+    buckets=LATENCY_BUCKETS,
+)
+TOOL_CALLS = Counter("swag_tool_calls_total", "Tool calls by tool and outcome.", ["tool", "outcome"])
+LLM_TOKENS = Counter(
+    "swag_llm_tokens_total", "Tokens used by the model, by model and type.", ["model", "type"]
+)
+CONVERSATION_STEPS = Histogram(
+    "swag_conversation_steps",
+    "Model steps taken by a conversation at the end of each assistant call.",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20),
+)
+OUTBOUND_QUEUE_WAIT = Histogram(
+    "swag_outbound_queue_wait_seconds",
+    "Time outbound requests wait for their provider's rate limit and concurrency cap.",
+    ["provider"],
+    buckets=LATENCY_BUCKETS,
+)
+EVENT_LOOP_LAG = Histogram(
+    "swag_event_loop_lag_seconds",
+    "How late the event loop woke up from a sleep, sampled every EVENT_LOOP_LAG_INTERVAL seconds.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+@contextmanager
+def span(kind: str, name: str, **attributes: Any) -> Iterator[dict[str, Any]]:
+    """Times a stage of a request, recording it in `SPAN_LATENCY` and logging it with
+    the request's trace id. The yielded attributes can be added to before the span ends."""
+    span_id = uuid.uuid4().hex[:8]
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        SPAN_LATENCY.labels(kind, name).observe(duration)
+        logger.info(
+            "trace=%s span=%s %s %s took %.3fs %s", trace_id.get(), span_id, kind, name, duration, attributes
+        )
+
+
+def record_usage(model: str, usage: Any) -> None:
+    """Counts the tokens of a model response."""
+    LLM_TOKENS.labels(model, "input").inc(usage.input_tokens)
+    LLM_TOKENS.labels(model, "output").inc(usage.output_tokens)
+    LLM_TOKENS.labels(model, "cache_read").inc(usage.cache_read_input_tokens or 0)
+    LLM_TOKENS.labels(model, "cache_write").inc(usage.cache_creation_input_tokens or 0)
+
+
+async def monitor_event_loop(interval: float) -> None:
+    """Records in `EVENT_LOOP_LAG` how long past `interval` each sleep took, i.e. how long
+    callbacks wait for the loop because something is blocking it."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+def metrics() -> tuple[bytes, str]:
+    """The metrics in the Prometheus text format, and its media type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class TelemetryMiddleware:
+    """Gives every HTTP request a trace id (from the X-Request-ID header, or a new one)
+    and records its latency until the last byte of the response, so streamed
+    responses are timed in full."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1") or uuid.uuid4().hex[:16]
+        token = trace_id.set(request_id)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            # The router records the matched route in the scope, so the endpoint label
+            # is the path template rather than the raw path.
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            REQUEST_LATENCY.labels(endpoint, scope["method"], str(status)).observe(time.perf_counter() - started)
+            trace_id.reset(token)
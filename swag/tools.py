@@ -1,21 +1,48 @@
 from pydantic import BaseModel, Field, model_validator
 from urllib.parse import quote_plus
 from typing import Any, Self, List, Tuple
-import requests
+import asyncio
+import inspect
+import re
+import threading
 import logging
 import base64
 import json
 import os
 
 from . import config as cfg
+from .cache import tool_cache, cache_key
+from .places import PlaceTileCache
+from .passages import BM25Index, current_query, current_search_queries, extract_passages, tokenize
+from .transport import get_client
+from .scheduler import get_limiter
+from .singleflight import SingleFlight
+from .telemetry import TOOL_CALLS, span
 import googlemaps
+import httpx
 
 from dotenv import load_dotenv
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-gmaps = googlemaps.Client(key=os.environ["GOOGLE_API_KEY"])
+_gmaps: googlemaps.Client | None = None
+_gmaps_lock = threading.Lock()
+
+
+def get_gmaps() -> googlemaps.Client:
+    """Returns the shared googlemaps client, creating it on first use."""
+    global _gmaps
+    if _gmaps is None:
+        with _gmaps_lock:
+            if _gmaps is None:
+                _gmaps = googlemaps.Client(
+                    key=os.environ["GOOGLE_API_KEY"],
+                    timeout=cfg.HTTP_TIMEOUT,
+                    base_url=cfg.OUTBOUND_BASE_URLS.get("maps.googleapis.com", "https://maps.googleapis.com"),
+                )
+    return _gmaps
+
 
 class SearchInternet(BaseModel):
     """Search the internet with the provided query. The response from this tool is a list of the search results as JSON objects containing the URL, title and a short description of the website."""
@@ -26,9 +53,14 @@ class SearchInternet(BaseModel):
 
 
 class ReadWebsite(BaseModel):
-    """Collect the entire content of a website given a URL. The response from this tool is a string."""
+    """Read a website given a URL. The response from this tool is a string with the source URL followed by the passages of the page that are most relevant to the query."""
 
     url: str
+    query: str | None = Field(
+        description="What you are looking for on the page. Defaults to the search that found the URL.",
+        default=None,
+        max_length=200,
+    )
 
 
 class SearchGoogleMapsWithText(BaseModel):
@@ -178,13 +210,73 @@ class GetPhoto(BaseModel):
     photo_name: str = Field(description="The name of the photo to get.")
 
 
+class LoadTools(BaseModel):
+    """Load more tools when none of the available tools can do what you need. Describe the task, and the most relevant tools are added to the tools you can use from the next step on. The response from this tool is the list of tools that were added."""
+
+    query: str = Field(description="The task you need a tool for.", max_length=200)
+
+
+def convert_pydantic_to_anthropic_schema(model) -> dict[str, Any]:
+    json_schema = model.model_json_schema()
+    return {
+        "name": json_schema["title"],
+        "description": json_schema["description"],
+        "input_schema": {
+            "type": "object",
+            "properties": json_schema["properties"],
+        },
+    }
+
+
+tool_flights: SingleFlight[str] = SingleFlight("tool")
+
+
+def record_search_queries(query: str, result: str) -> None:
+    """Remembers, for the running conversation, the query that surfaced each URL of a
+    SearchInternet result. Runs on every call, including cached and coalesced ones."""
+    search_queries = current_search_queries.get()
+    if search_queries is None:
+        return
+    try:
+        items = json.loads(result)
+    except ValueError:
+        return
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and item.get("url"):
+            search_queries.record(item["url"], query)
+
+
 class ToolRegistry:
     tools = {}
+    cache_ttls = {}
+    providers = {}
+    coalesce = {}
+    schemas = {}
+    catalogs = {}
+    index: BM25Index | None = None
+    index_names: List[str] = []
 
     @classmethod
-    def register(cls, model):
+    def register(
+        cls,
+        model,
+        cache_ttl: float | None = cfg.TOOL_CACHE_DEFAULT_TTL,
+        provider: str | None = None,
+        coalesce: bool = True,
+    ):
+        """Registers a tool for `model`. Results are cached for `cache_ttl` seconds,
+        tools with side effects or volatile results opt out with `cache_ttl=None`.
+        Synchronous tools that call a `provider` through its own client run under
+        that provider's limiter, async tools are limited by the shared transport.
+        Tools whose result depends on more than their input opt out of coalescing."""
+
         def decorator(func):
             cls.tools[model.__name__] = (func, model)
+            cls.cache_ttls[model.__name__] = cache_ttl
+            cls.providers[model.__name__] = provider
+            cls.coalesce[model.__name__] = coalesce
+            cls.schemas[model.__name__] = convert_pydantic_to_anthropic_schema(model)
+            cls.index = None
             return func
 
         return decorator
@@ -193,9 +285,115 @@ class ToolRegistry:
     def get(cls, name):
         return cls.tools.get(name, (None, None))
 
+    @classmethod
+    def catalog(cls, models: List[Any]) -> List[dict[str, Any]]:
+        """Returns the tool definitions for `models`, built once per tool set. The last
+        definition carries a cache breakpoint so the tool list is served from the prompt cache."""
+        names = tuple(model.__name__ for model in models)
+        if names not in cls.catalogs:
+            definitions = [
+                cls.schemas.get(name) or convert_pydantic_to_anthropic_schema(model)
+                for name, model in zip(names, models)
+            ]
+            if definitions:
+                definitions[-1] = {**definitions[-1], "cache_control": {"type": "ephemeral"}}
+            cls.catalogs[names] = definitions
+        return cls.catalogs[names]
+
+    @classmethod
+    def build_index(cls) -> None:
+        """Indexes the registered tools by their name, docstring and field descriptions."""
+        documents = []
+        for name, schema in cls.schemas.items():
+            words = re.sub(r"(?<!^)(?=[A-Z])", " ", name)
+            fields = " ".join(
+                f"{field} {properties.get('description', '')}"
+                for field, properties in schema["input_schema"]["properties"].items()
+            )
+            documents.append(tokenize(f"{words} {schema['description']} {fields}"))
+        cls.index_names = list(cls.schemas)
+        cls.index = BM25Index(documents)
+
+    @classmethod
+    def search(cls, query: str, k: int, exclude: List[str] = []) -> List[Any]:
+        """Returns the models of the `k` registered tools most relevant to `query`."""
+        if cls.index is None:
+            cls.build_index()
+        scores = cls.index.scores(tokenize(query))
+        ranked = sorted(zip(scores, cls.index_names), key=lambda item: item[0], reverse=True)
+        return [
+            cls.tools[name][1] for score, name in ranked if score > 0 and name not in exclude
+        ][:k]
+
+    @classmethod
+    async def call(cls, name: str, tool_input: dict[str, Any]) -> str:
+        """Validates the input and runs a tool. `async def` tools are awaited directly,
+        synchronous tools run in a worker thread so they don't block the event loop."""
+        tool_function, tool_model = cls.get(name)
+        if not tool_function:
+            raise ValueError(f"Tool function {name} not found")
+
+        with span("tool", name) as attributes:
+            try:
+                result = await cls._call(name, tool_function, tool_model, tool_input, attributes)
+            except Exception:
+                attributes["outcome"] = "error"
+                raise
+            finally:
+                TOOL_CALLS.labels(name, attributes.get("outcome", "error")).inc()
+        if name == SearchInternet.__name__:
+            record_search_queries(tool_model(**tool_input).query, result)
+        return result
+
+    @classmethod
+    async def _call(
+        cls, name: str, tool_function, tool_model, tool_input: dict[str, Any], attributes: dict[str, Any]
+    ) -> str:
+        if tool_model:
+            request = tool_model(**tool_input)
+            args, kwargs = (request,), {}
+        else:
+            request = None
+            args, kwargs = (), tool_input
+
+        ttl = cls.cache_ttls.get(name)
+        key = cache_key(name, request) if request is not None else None
+        if key and ttl:
+            cached = await tool_cache.get(key)
+            if cached is not None:
+                logger.info("Tool cache hit for `%s`", name)
+                attributes["outcome"] = "cache_hit"
+                return cached
+
+        async def run() -> str:
+            if inspect.iscoroutinefunction(tool_function):
+                result = await tool_function(*args, **kwargs)
+            elif limiter := get_limiter(cls.providers.get(name)):
+                async with limiter.slot():
+                    result = await asyncio.to_thread(tool_function, *args, **kwargs)
+            else:
+                result = await asyncio.to_thread(tool_function, *args, **kwargs)
+            if key and ttl:
+                tool_cache.set(key, result, ttl)
+            return result
+
+        # Identical calls that arrive while one is running share its result.
+        attributes["outcome"] = "ok"
+        if key and cls.coalesce.get(name, True):
+            return await tool_flights.do(key, run)
+        return await run()
+
+
+def raise_for_status(response: httpx.Response) -> httpx.Response:
+    """Raises with the body of an error response, so the model sees what went wrong
+    and the error is not cached as a result."""
+    if response.is_error:
+        raise ValueError(f"Request failed with status {response.status_code}: {response.text}")
+    return response
+
 
 @ToolRegistry.register(SearchInternet)
-def search_internet(
+async def search_internet(
         request: SearchInternet,
 ) -> str:
     url = f"https://s.jina.ai/{quote_plus(request.query)}"
@@ -204,7 +402,7 @@ def search_internet(
         "Authorization": f"Bearer {os.environ['JINAI_API_KEY']}",
         "X-Retain-Images": "none",
     }
-    response = requests.get(url, headers=headers, verify=True)
+    response = raise_for_status(await get_client("s.jina.ai").get(url, headers=headers))
     data: list[dict[str, Any]] = response.json()["data"]
 
     return_value = []
@@ -216,31 +414,44 @@ def search_internet(
     return json.dumps(return_value)
 
 
-@ToolRegistry.register(ReadWebsite)
-def read_website(request: ReadWebsite) -> str:
+# The page itself is cached and coalesced rather than the tool result, since the
+# passages returned depend on the query.
+@ToolRegistry.register(ReadWebsite, cache_ttl=None, coalesce=False)
+async def read_website(request: ReadWebsite) -> str:
+    key = cache_key("ReadWebsite:page", ReadWebsite(url=request.url))
 
-    url = f"https://r.jina.ai/{request.url}"
-    headers = {"Authorization": f"Bearer {os.environ['JINAI_API_KEY']}"}
-    response = requests.get(url, headers=headers, verify=True)
-    logger.info("Received response from: `read_website`")
-    return response.text
+    async def fetch_page() -> str:
+        url = f"https://r.jina.ai/{request.url}"
+        headers = {"Authorization": f"Bearer {os.environ['JINAI_API_KEY']}"}
+        response = raise_for_status(await get_client("r.jina.ai").get(url, headers=headers))
+        logger.info("Received response from: `read_website`")
+        tool_cache.set(key, response.text, cfg.READ_WEBSITE_PAGE_TTL)
+        return response.text
 
+    page = await tool_cache.get(key)
+    if page is None:
+        page = await tool_flights.do(key, fetch_page)
 
-@ToolRegistry.register(GetDetailsOfPlace)
-def get_details_of_place(request: GetDetailsOfPlace) -> str:
+    search_queries = current_search_queries.get()
+    query = request.query or (search_queries and search_queries.get(request.url)) or current_query.get()
+    return await asyncio.to_thread(extract_passages, page, request.url, query)
+
+
+@ToolRegistry.register(GetDetailsOfPlace, cache_ttl=24 * 60 * 60)
+async def get_details_of_place(request: GetDetailsOfPlace) -> str:
     url = f"https://places.googleapis.com/v1/places/{request.place_id}"
     headers = {
         "Content-Type": "application/json",
         "X-Goog-Api-Key": os.environ["GOOGLE_API_KEY"],
         "X-Goog-FieldMask": "displayName,rating,formattedAddress,priceRange,websiteUri",
     }
-    response = requests.get(url, headers=headers)
+    response = raise_for_status(await get_client("places.googleapis.com").get(url, headers=headers))
     logger.info(f"`get_details_of_place`: {response.text}")
     return json.dumps(response.json())
 
 
 @ToolRegistry.register(SearchGoogleMapsWithText)
-def search_google_maps_with_text(request: SearchGoogleMapsWithText) -> str:
+async def search_google_maps_with_text(request: SearchGoogleMapsWithText) -> str:
     url = "https://places.googleapis.com/v1/places:searchText"
     headers = {
         "Content-Type": "application/json",
@@ -250,39 +461,70 @@ def search_google_maps_with_text(request: SearchGoogleMapsWithText) -> str:
     payload = {
         "textQuery": request.query,
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = raise_for_status(
+        await get_client("places.googleapis.com").post(url, headers=headers, json=payload)
+    )
     logger.info(f"`search_google_maps_with_text`: {response.text}")
     return json.dumps(response.json())
 
 
-@ToolRegistry.register(SearchForNearbyPlacesOfType)
-def search_for_nearby_places_of_type(
-    request: SearchForNearbyPlacesOfType
-) -> str:
+async def fetch_nearby_places(
+    lat: float, lon: float, radius: float, types: list[str]
+) -> list[dict[str, Any]]:
     url = "https://places.googleapis.com/v1/places:searchNearby"
-    fields = "places.id,places.displayName,places.rating"
-    if request.include_photos:
-        fields += ",places.photos"
     headers = {
         "Content-Type": "application/json",
         "X-Goog-Api-Key": os.environ["GOOGLE_API_KEY"],
-        "X-Goog-FieldMask": fields,
+        "X-Goog-FieldMask": "places.id,places.displayName,places.rating,places.photos,places.location,places.types",
     }
     payload = {
-        "includedTypes": request.types,
-        "maxResultCount": 10,
+        "includedTypes": types,
+        "maxResultCount": cfg.PLACES_FETCH_MAX_RESULTS,
+        "rankPreference": "DISTANCE",
         "locationRestriction": {
-            "circle": {"center": {"latitude": request.lat, "longitude": request.lon}, "radius": 100}
+            "circle": {"center": {"latitude": lat, "longitude": lon}, "radius": radius}
         },
     }
-    response = requests.post(url, headers=headers, json=payload)
-    logger.info(f"`search_for_nearby_places_of_type`: {response.text}")
-    return json.dumps(response.json())
+    response = raise_for_status(
+        await get_client("places.googleapis.com").post(url, headers=headers, json=payload)
+    )
+    logger.info("Received response from: `fetch_nearby_places`")
+    return response.json().get("places", [])
+
 
+places_cache = PlaceTileCache(
+    fetch=fetch_nearby_places,
+    precision=cfg.PLACES_TILE_PRECISION,
+    ttl=cfg.PLACES_TILE_TTL,
+    max_age=cfg.PLACES_TILE_MAX_AGE,
+    max_entries=cfg.PLACES_TILE_MAX_ENTRIES,
+    max_fetch_results=cfg.PLACES_FETCH_MAX_RESULTS,
+)
 
-@ToolRegistry.register(GetDirections)
+
+# Cached per geohash tile by `places_cache` rather than per exact input.
+@ToolRegistry.register(SearchForNearbyPlacesOfType, cache_ttl=None)
+async def search_for_nearby_places_of_type(
+    request: SearchForNearbyPlacesOfType
+) -> str:
+    places = await places_cache.search(
+        request.lat,
+        request.lon,
+        request.types,
+        radius=cfg.PLACES_SEARCH_RADIUS,
+        max_results=cfg.PLACES_MAX_RESULTS,
+    )
+    fields = ["id", "displayName", "rating"]
+    if request.include_photos:
+        fields.append("photos")
+    result = {"places": [{k: place[k] for k in fields if k in place} for place in places]}
+    logger.info(f"`search_for_nearby_places_of_type`: {result}")
+    return json.dumps(result)
+
+
+@ToolRegistry.register(GetDirections, cache_ttl=10 * 60, provider="google")
 def get_directions(request: GetDirections) -> str:
-    directions = gmaps.directions(
+    directions = get_gmaps().directions(
         request.origin, request.destination, mode=request.mode
     )
     legs = directions[0]["legs"]
@@ -290,10 +532,10 @@ def get_directions(request: GetDirections) -> str:
     return json.dumps(legs)
 
 
-@ToolRegistry.register(GetDistanceMatrix)
+@ToolRegistry.register(GetDistanceMatrix, cache_ttl=10 * 60, provider="google")
 def get_distance_matrix(request: GetDistanceMatrix) -> str:
     try:
-        matrix = gmaps.distance_matrix(
+        matrix = get_gmaps().distance_matrix(
             request.origins, request.destinations, mode=request.mode.value
         )
         logger.info(f"`get_distance_matrix`: {matrix}")
@@ -303,45 +545,45 @@ def get_distance_matrix(request: GetDistanceMatrix) -> str:
         raise ValueError(f"Unexpected error: {str(e)}")
 
 
-@ToolRegistry.register(GetElevation)
+@ToolRegistry.register(GetElevation, cache_ttl=7 * 24 * 60 * 60, provider="google")
 def get_elevation(request: GetElevation) -> str:
-    elevation = gmaps.elevation(request.locations)
+    elevation = get_gmaps().elevation(request.locations)
     logger.info(f"`get_elevation`: {elevation}")
     return json.dumps(elevation)
 
 
-@ToolRegistry.register(Geocode)
+@ToolRegistry.register(Geocode, cache_ttl=7 * 24 * 60 * 60, provider="google")
 def geocode(request: Geocode) -> str:
-    geocode_result = gmaps.geocode(request.address)
+    geocode_result = get_gmaps().geocode(request.address)
     logger.info(f"`geocode`: {geocode_result}")
     coordinates = geocode_result[0]["geometry"]["location"]
     return json.dumps(coordinates)
 
 
-@ToolRegistry.register(ReverseGeocode)
+@ToolRegistry.register(ReverseGeocode, cache_ttl=7 * 24 * 60 * 60, provider="google")
 def reverse_geocode(request: ReverseGeocode) -> str:
-    reverse_geocode_result = gmaps.reverse_geocode((request.lat, request.lng))
+    reverse_geocode_result = get_gmaps().reverse_geocode((request.lat, request.lng))
     logger.info(f"`reverse_geocode`: {reverse_geocode_result}")
     return json.dumps(reverse_geocode_result)
 
 
-@ToolRegistry.register(GetTimeZone)
+@ToolRegistry.register(GetTimeZone, provider="google")
 def get_time_zone(request: GetTimeZone) -> str:
-    timezone = gmaps.timezone(request.location, request.timestamp)
+    timezone = get_gmaps().timezone(request.location, request.timestamp)
     logger.info(f"`get_time_zone`: {timezone}")
     return json.dumps(timezone)
 
 
-@ToolRegistry.register(GetNearestRoads)
+@ToolRegistry.register(GetNearestRoads, provider="google")
 def get_nearest_roads(request: GetNearestRoads) -> str:
-    roads = gmaps.nearest_roads(request.points)
+    roads = get_gmaps().nearest_roads(request.points)
     logger.info(f"`get_nearest_roads`: {roads}")
     return json.dumps(roads)
 
 
-@ToolRegistry.register(GetStaticMap)
+@ToolRegistry.register(GetStaticMap, provider="google")
 def get_static_map(request: GetStaticMap) -> str:
-    static_map_url = gmaps.static_map(
+    static_map_url = get_gmaps().static_map(
         center=request.center,
         zoom=request.zoom,
         size=(request.size[0], request.size[1]),
@@ -350,7 +592,7 @@ def get_static_map(request: GetStaticMap) -> str:
     return static_map_url
 
 
-@ToolRegistry.register(ValidateAddress)
+@ToolRegistry.register(ValidateAddress, cache_ttl=None)
 def validate_address(request: ValidateAddress) -> str:
     # Note: The googlemaps Python client doesn't support address validation yet
     # We'll use a placeholder implementation
@@ -360,7 +602,7 @@ def validate_address(request: ValidateAddress) -> str:
     return json.dumps({"input_address": request.address, "validated": False})
 
 
-@ToolRegistry.register(OptimizeRoute)
+@ToolRegistry.register(OptimizeRoute, cache_ttl=None)
 def optimize_route(request: OptimizeRoute) -> str:
     distances = request.distance_matrix
     num_points = len(distances)
@@ -386,10 +628,15 @@ def optimize_route(request: OptimizeRoute) -> str:
     return json.dumps(result)
 
 
-@ToolRegistry.register(GetPhoto)
-def get_photo(request: GetPhoto) -> str:
+@ToolRegistry.register(GetPhoto, cache_ttl=None)
+async def get_photo(request: GetPhoto) -> str:
     url = f"https://places.googleapis.com/v1/{request.photo_name}/media?maxHeightPx=400&maxWidthPx=400&key={os.environ['GOOGLE_API_KEY']}"
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
-    response = requests.get(url, headers=headers)
+    response = raise_for_status(
+        await get_client("places.googleapis.com").get(url, headers=headers, follow_redirects=True)
+    )
     base64_image = base64.b64encode(response.content).decode("utf-8")
     return base64_image
+
+
+ToolRegistry.build_index()
@@ -0,0 +1,99 @@
+from anthropic import AsyncAnthropic
+import httpx
+import logging
+import os
+
+from swag import config as cfg
+from swag.scheduler import SchedulingTransport, get_limiter, provider_for
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_anthropic: AsyncAnthropic | None = None
+
+
+class RedirectTransport(httpx.AsyncBaseTransport):
+    """Sends requests to `base_url` instead of their own host, keeping their path under
+    the path of `base_url`. Used to point the app at stand-ins for the real APIs."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, base_url: str):
+        self.transport = transport
+        self.base_url = httpx.URL(base_url)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # A new request each time: the scheduler retries with the caller's request, which
+        # must keep its original URL.
+        url = request.url.copy_with(
+            scheme=self.base_url.scheme,
+            host=self.base_url.host,
+            port=self.base_url.port,
+            raw_path=self.base_url.raw_path.rstrip(b"/") + request.url.raw_path,
+        )
+        headers = request.headers.copy()
+        headers["Host"] = self.base_url.netloc.decode("ascii")
+        redirected = httpx.Request(
+            request.method, url, headers=headers, stream=request.stream, extensions=request.extensions
+        )
+        return await self.transport.handle_async_request(redirected)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def get_client(host: str, timeout: float = cfg.HTTP_TIMEOUT) -> httpx.AsyncClient:
+    """Returns the shared, keep-alive client for `host`, creating it on first use.
+
+    Every host gets its own client so that connection limits apply per host rather
+    than across all the APIs the tools talk to. Requests to a known provider go
+    through its limiter in swag/scheduler.py.
+    """
+    client = _clients.get(host)
+    if client is None or client.is_closed:
+        transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=cfg.HTTP_MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=cfg.HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST,
+                keepalive_expiry=cfg.HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        base_url = cfg.OUTBOUND_BASE_URLS.get(host)
+        if base_url:
+            transport = RedirectTransport(transport, base_url)
+        limiter = get_limiter(provider_for(host))
+        if limiter:
+            transport = SchedulingTransport(transport, limiter)
+        client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(timeout, connect=cfg.HTTP_CONNECT_TIMEOUT),
+        )
+        _clients[host] = client
+        logger.info("Opened HTTP client for %s (http2=%s)", host, HTTP2_AVAILABLE)
+    return client
+
+
+def get_anthropic() -> AsyncAnthropic:
+    """Returns the shared Anthropic client. Retries are left to the scheduler."""
+    global _anthropic
+    if _anthropic is None or _anthropic.is_closed():
+        _anthropic = AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            http_client=get_client("api.anthropic.com", timeout=cfg.ANTHROPIC_TIMEOUT),
+            max_retries=0,
+        )
+    return _anthropic
+
+
+async def aclose() -> None:
+    """Closes every shared client. Called when the application shuts down."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
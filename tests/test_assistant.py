@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from anthropic import AsyncAnthropic
+
+from swag.assistant import Assistant
+from swag.tools import SearchInternet, ToolRegistry
+
+
+def sse(turn):
+    """A streamed Messages API response for `turn`, a list of ("text", text) and
+    ("tool", name, input) blocks."""
+    events = []
+
+    def event(event_type, data):
+        events.append(f"event: {event_type}\ndata: {json.dumps({'type': event_type, **data})}\n\n")
+
+    event("message_start", {"message": {
+        "id": "msg", "type": "message", "role": "assistant", "model": "test", "content": [],
+        "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 10, "output_tokens": 0},
+    }})
+    stop_reason = "end_turn"
+    for index, block in enumerate(turn):
+        if block[0] == "text":
+            event("content_block_start", {"index": index, "content_block": {"type": "text", "text": ""}})
+            for word in block[1].split(" "):
+                event("content_block_delta", {"index": index, "delta": {"type": "text_delta", "text": word + " "}})
+        else:
+            stop_reason = "tool_use"
+            event("content_block_start", {"index": index, "content_block": {
+                "type": "tool_use", "id": f"toolu_{index}", "name": block[1], "input": {},
+            }})
+            event("content_block_delta", {"index": index, "delta": {
+                "type": "input_json_delta", "partial_json": json.dumps(block[2]),
+            }})
+        event("content_block_stop", {"index": index})
+    event("message_delta", {"delta": {"stop_reason": stop_reason, "stop_sequence": None}, "usage": {"output_tokens": 5}})
+    event("message_stop", {})
+    return "".join(events).encode()
+
+
+def make_client(turns, requests=None, status=200):
+    turns = iter(turns)
+
+    def handler(request):
+        if requests is not None:
+            requests.append(json.loads(request.content))
+        if status != 200:
+            return httpx.Response(status, json={"type": "error", "error": {"type": "invalid_request_error", "message": "bad"}})
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=sse(next(turns)))
+
+    return AsyncAnthropic(api_key="test", max_retries=0, http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+def run(assistant, prompt="Where am I?"):
+    async def collect():
+        return [chunk async for chunk in assistant(prompt=prompt)]
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture
+def tool_calls(monkeypatch):
+    """Replaces the tools with one that takes 0.1s, recording the peak concurrency."""
+    state = {"running": 0, "peak": 0, "inputs": []}
+
+    async def call(name, tool_input):
+        state["running"] += 1
+        state["peak"] = max(state["peak"], state["running"])
+        state["inputs"].append(tool_input["query"])
+        await asyncio.sleep(0.1)
+        state["running"] -= 1
+        if tool_input["query"] == "fail":
+            raise ValueError("tool failed")
+        return f"result for {tool_input['query']}"
+
+    monkeypatch.setattr(ToolRegistry, "call", call)
+    return state
+
+
+def test_text_is_streamed_and_the_turn_is_saved():
+    assistant = Assistant(client=make_client([[("text", "You are in Rome.")]]), model="test")
+    chunks = run(assistant)
+    assert "".join(chunks).strip() == "You are in Rome."
+    assert len(chunks) > 2
+    assert assistant.finished
+    assert [message["role"] for message in assistant.messages] == ["user", "assistant"]
+
+
+def test_tool_calls_of_a_turn_run_concurrently_and_keep_their_order(tool_calls):
+    turns = [
+        [("tool", "SearchInternet", {"query": "first"}), ("tool", "SearchInternet", {"query": "fail"}),
+         ("tool", "SearchInternet", {"query": "third"})],
+        [("text", "Done.")],
+    ]
+    requests = []
+    assistant = Assistant(client=make_client(turns, requests), model="test", tools=[SearchInternet])
+    chunks = run(assistant)
+
+    assert tool_calls["peak"] == 3
+    assert assistant.finished
+    results = requests[1]["messages"][-1]["content"]
+    assert [result["tool_use_id"] for result in results] == ["toolu_0", "toolu_1", "toolu_2"]
+    assert [result["content"] for result in results] == ["result for first", "tool failed", "result for third"]
+    assert [result["is_error"] for result in results] == [False, True, False]
+    assert "\nAn error occurred when trying to interact with the tool." in chunks
+
+
+def test_concurrency_is_limited_per_turn(tool_calls):
+    turns = [[("tool", "SearchInternet", {"query": str(i)}) for i in range(4)], [("text", "Done.")]]
+    assistant = Assistant(client=make_client(turns), model="test", tools=[SearchInternet], max_concurrent_tools=2)
+    run(assistant)
+    assert tool_calls["peak"] == 2
+    assert sorted(tool_calls["inputs"]) == ["0", "1", "2", "3"]
+
+
+def test_step_budget_leaves_every_tool_call_answered(tool_calls):
+    turns = [[("tool", "SearchInternet", {"query": str(i)})] for i in range(5)]
+    assistant = Assistant(client=make_client(turns), model="test", tools=[SearchInternet], max_steps=2)
+    chunks = run(assistant)
+
+    assert chunks[-1] == "\nMaximum number of steps 2 reached. Please start a new conversation."
+    assert not assistant.finished
+    assert assistant.steps == 2
+    assert assistant.messages[-1]["role"] == "user"
+    assert assistant.messages[-1]["content"][0]["type"] == "tool_result"
+
+    # A resumed conversation that is out of steps doesn't call the model again.
+    assert run(assistant, "And now?") == [chunks[-1]]
+
+
+def test_time_budget_is_checked_between_steps(tool_calls):
+    turns = [[("tool", "SearchInternet", {"query": "slow"})], [("text", "Done.")]]
+    requests = []
+    assistant = Assistant(client=make_client(turns, requests), model="test", tools=[SearchInternet], max_duration=0.05)
+    chunks = run(assistant)
+
+    assert chunks[-1] == "\nTime limit of 0.05 seconds reached. Please ask a follow-up question to continue."
+    assert len(requests) == 1
+    assert assistant.messages[-1]["content"][0]["type"] == "tool_result"
+
+
+def test_a_failed_step_is_reported_as_an_error_chunk():
+    assistant = Assistant(client=make_client([], status=400), model="test")
+    chunks = run(assistant)
+    error = json.loads(chunks[-1])
+    assert error["type"] == "error"
+    assert error["step"] == 0
+    assert not assistant.finished
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from swag.cache import ToolCache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ToolCache(max_bytes=10)
+    cache.set("a", "aaaa", ttl=60)
+    cache.set("b", "bbbb", ttl=60)
+    assert asyncio.run(cache.get("a")) == "aaaa"
+    cache.set("c", "cccc", ttl=60)
+    assert asyncio.run(cache.get("b")) is None
+    assert asyncio.run(cache.get("a")) == "aaaa"
+    assert asyncio.run(cache.get("c")) == "cccc"
+    assert cache.stats()["bytes"] == 8
+
+
+def test_expired_entries_miss():
+    cache = ToolCache(max_bytes=100)
+    cache.set("a", "value", ttl=-1)
+    assert asyncio.run(cache.get("a")) is None
+    assert cache.stats()["bytes"] == 0
+    assert cache.stats()["misses"] == 1
+
+
+def test_values_larger_than_the_cache_are_not_cached():
+    cache = ToolCache(max_bytes=10)
+    cache.set("a", "x" * 11, ttl=60)
+    assert asyncio.run(cache.get("a")) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_round_trip(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ToolCache(max_bytes=100, path=path, flush_interval=0.01)
+    cache.set("a", "value", ttl=60)
+    cache.close()
+
+    reopened = ToolCache(max_bytes=100, path=path)
+    assert asyncio.run(reopened.get("a")) == "value"
+    reopened.close()
+
+
+def test_sqlite_skips_oversized_values(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ToolCache(max_bytes=100, path=path, flush_interval=0.01)
+    cache.set("big", "x" * 500, ttl=60)
+    cache.close()
+
+    reopened = ToolCache(max_bytes=100, path=path)
+    assert asyncio.run(reopened.get("big")) is None
+    reopened.close()
+
+
+def test_oversized_row_is_returned_without_caching_it(tmp_path):
+    # A row written by a worker with a larger max_bytes.
+    path = str(tmp_path / "cache.db")
+    writer = ToolCache(max_bytes=1000, path=path, flush_interval=0.01)
+    writer.set("big", "x" * 500, ttl=60)
+    writer.close()
+
+    reader = ToolCache(max_bytes=100, path=path)
+    assert asyncio.run(reader.get("big")) == "x" * 500
+    assert reader.stats()["entries"] == 0
+    reader.close()
+
+
+def test_purge_deletes_expired_rows(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ToolCache(max_bytes=100, path=path, flush_interval=0.01)
+    cache.set("old", "value", ttl=0.01)
+    cache.set("new", "value", ttl=60)
+    cache.flush()
+    time.sleep(0.02)
+    cache.purge()
+    rows = cache._db.execute("SELECT key FROM tool_cache").fetchall()
+    assert rows == [("new",)]
+    cache.close()
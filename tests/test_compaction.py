@@ -0,0 +1,63 @@
+from swag.compaction import CHARS_PER_TOKEN, CompactionPolicy, compact, estimate_tokens
+
+
+def user(text):
+    return {"role": "user", "content": [{"type": "text", "text": text}]}
+
+
+def image():
+    return {"role": "user", "content": [
+        {"type": "text", "text": "what is this?"},
+        {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": "x"}},
+    ]}
+
+
+def tool_step(tool_id, result):
+    return [
+        {"role": "assistant", "content": [{"type": "tool_use", "id": tool_id, "name": "t", "input": {}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_id, "content": result}]},
+    ]
+
+
+def result_of(message):
+    return message["content"][0]["content"]
+
+
+def test_earlier_turns_are_compacted():
+    policy = CompactionPolicy(tool_result_tokens=10, trigger_tokens=10**6)
+    messages = [image(), *tool_step("a", "x" * 1000), {"role": "assistant", "content": "done"}, user("next")]
+    compacted = compact(messages, policy)
+    assert compacted[0]["content"][1] == {"type": "text", "text": "[image/jpeg shown in an earlier turn, omitted]"}
+    assert len(result_of(compacted[2])) == 10 * CHARS_PER_TOKEN
+    assert compacted[-1] is messages[-1]
+
+
+def test_current_turn_is_kept_below_the_trigger():
+    policy = CompactionPolicy(tool_result_tokens=10, trigger_tokens=10**6)
+    messages = [image(), *tool_step("a", "x" * 1000), *tool_step("b", "y" * 1000)]
+    assert compact(messages, policy) == messages
+
+
+def test_current_turn_keeps_recent_steps_above_the_trigger():
+    policy = CompactionPolicy(tool_result_tokens=10, keep_recent_steps=1, trigger_tokens=100)
+    messages = [user("question"), *tool_step("a", "x" * 1000), *tool_step("b", "y" * 1000)]
+    compacted = compact(messages, policy)
+    assert len(result_of(compacted[2])) == 10 * CHARS_PER_TOKEN
+    assert result_of(compacted[4]) == "y" * 1000
+
+
+def test_compaction_is_idempotent():
+    policy = CompactionPolicy(tool_result_tokens=10, trigger_tokens=100)
+    messages = [image(), *tool_step("a", "x" * 1000), user("next"), *tool_step("b", "y" * 1000)]
+    once = compact(messages, policy)
+    assert compact(once, policy) == once
+
+
+def test_disabled_policy_changes_nothing():
+    messages = [image(), *tool_step("a", "x" * 1000), user("next")]
+    assert compact(messages, CompactionPolicy(enabled=False, trigger_tokens=0)) is messages
+
+
+def test_estimate_tokens():
+    assert estimate_tokens([user("x" * 400)]) == 100
+    assert estimate_tokens([image()]) > 1000
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+from anthropic.types import TextBlock, ToolUseBlock
+
+from swag.conversations import (
+    ConversationStore,
+    MemoryConversationStore,
+    SqliteConversationStore,
+    serialize_conversation,
+)
+
+
+def messages(text="hello"):
+    return [
+        {"role": "user", "content": text},
+        {
+            "role": "assistant",
+            "content": [
+                TextBlock(type="text", text="Looking it up."),
+                ToolUseBlock(type="tool_use", id="toolu_1", name="SearchInternet", input={"query": text}),
+            ],
+        },
+    ]
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        ConversationStore()
+
+
+def test_memory_round_trips_sdk_blocks():
+    store = MemoryConversationStore(max_bytes=10_000, ttl=60)
+    store.set("a", messages(), 3)
+    loaded, steps = store.get("a")
+    assert steps == 3
+    assert loaded[1]["content"][1] == {
+        "type": "tool_use", "id": "toolu_1", "name": "SearchInternet", "input": {"query": "hello"},
+    }
+    assert store.get("missing") is None
+    assert store.stats()["hits"] == 1
+    assert store.stats()["misses"] == 1
+
+
+def test_memory_evicts_least_recently_used_beyond_max_bytes():
+    size = len(serialize_conversation(messages("a"), 1))
+    store = MemoryConversationStore(max_bytes=size * 2, ttl=60)
+    store.set("a", messages("a"), 1)
+    store.set("b", messages("b"), 1)
+    store.get("a")
+    store.set("c", messages("c"), 1)
+    assert store.get("b") is None
+    assert store.get("a") is not None
+    assert store.get("c") is not None
+    assert store.stats()["evictions"] == 1
+    assert store.stats()["bytes"] <= size * 2
+
+
+def test_memory_expires_after_ttl(monkeypatch):
+    store = MemoryConversationStore(max_bytes=10_000, ttl=60)
+    store.set("a", messages(), 1)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert store.get("a") is None
+    assert store.stats()["entries"] == 0
+
+
+def test_sqlite_is_shared_between_stores(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    first = SqliteConversationStore(path, max_bytes=10_000, ttl=60)
+    second = SqliteConversationStore(path, max_bytes=10_000, ttl=60)
+    try:
+        first.set("a", messages("one"), 1)
+        assert second.get("a")[1] == 1
+
+        # A turn written by the other worker replaces the copy cached here.
+        time.sleep(0.01)
+        first.set("a", messages("two"), 2)
+        loaded, steps = second.get("a")
+        assert steps == 2
+        assert loaded[0]["content"] == "two"
+        assert first.stats()["writes"] == 2
+    finally:
+        first.close()
+        second.close()
+
+
+def test_sqlite_survives_a_restart(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    store = SqliteConversationStore(path, max_bytes=10_000, ttl=60)
+    store.set("a", messages(), 4)
+    store.close()
+
+    store = SqliteConversationStore(path, max_bytes=10_000, ttl=60)
+    try:
+        assert store.get("a")[1] == 4
+    finally:
+        store.close()
@@ -0,0 +1,69 @@
+import math
+import random
+
+import pytest
+
+from swag.geo import (
+    cells_within,
+    distance_to_cell,
+    geohash_bbox,
+    geohash_encode,
+    geohash_neighbours,
+    haversine,
+)
+
+
+def test_encode_known_values():
+    assert geohash_encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert geohash_encode(42.605, -5.603, 5) == "ezs42"
+
+
+def test_bbox_contains_point():
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash_encode(48.8584, 2.2945, 7))
+    assert min_lat <= 48.8584 <= max_lat
+    assert min_lon <= 2.2945 <= max_lon
+
+
+def test_neighbours():
+    cell = geohash_encode(41.9009, 12.4833, 6)
+    neighbours = geohash_neighbours(cell)
+    assert len(neighbours) == 9
+    assert neighbours[4] == cell
+    assert all(len(neighbour) == 6 for neighbour in neighbours)
+    assert all(distance_to_cell(*_center(cell), neighbour) < 2000 for neighbour in neighbours)
+
+
+def test_neighbours_wrap_around_the_antimeridian():
+    cell = geohash_encode(0.1, 179.999, 5)
+    lons = [_center(neighbour)[1] for neighbour in geohash_neighbours(cell)]
+    assert any(lon < 0 for lon in lons)
+
+
+def test_haversine():
+    # Paris to London is about 344km.
+    assert haversine(48.8566, 2.3522, 51.5074, -0.1278) == pytest.approx(343_500, rel=0.01)
+
+
+@pytest.mark.parametrize("lat", [0, 30, 49, 55, 60, 70])
+def test_cells_within_covers_the_circle(lat):
+    rng = random.Random(lat)
+    radius = 100.0
+    for _ in range(20):
+        center_lat, center_lon = lat + rng.uniform(-0.5, 0.5), rng.uniform(-180, 180)
+        cells = set(cells_within(center_lat, center_lon, radius, 7))
+        for _ in range(50):
+            # A random point inside the circle.
+            bearing, distance = rng.uniform(0, 2 * math.pi), radius * math.sqrt(rng.random()) * 0.999
+            d_lat = math.degrees(distance * math.cos(bearing) / 6_371_000)
+            d_lon = math.degrees(distance * math.sin(bearing) / (6_371_000 * math.cos(math.radians(center_lat))))
+            assert geohash_encode(center_lat + d_lat, center_lon + d_lon, 7) in cells
+
+
+def test_cells_within_only_returns_cells_that_intersect():
+    cells = cells_within(60.0, 10.0, 100.0, 7)
+    assert all(distance_to_cell(60.0, 10.0, cell) <= 100.0 for cell in cells)
+
+
+def _center(cell):
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(cell)
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
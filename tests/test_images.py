@@ -0,0 +1,85 @@
+import asyncio
+import base64
+import json
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from swag import config as cfg
+from swag import everywhere_tour_guide
+from swag.images import DECODE_ERRORS, prepare_image, prepare_tour_guide_images
+
+IMAGES = Path(__file__).resolve().parent.parent / "imgs"
+
+
+def decoded(image):
+    return Image.open(BytesIO(base64.b64decode(image.data)))
+
+
+def jpeg(size, quality=80):
+    buffer = BytesIO()
+    Image.new("RGB", size, (120, 80, 40)).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def test_small_jpegs_are_sent_unchanged():
+    image_bytes = jpeg((640, 480))
+    image = prepare_image(image_bytes)
+    assert image.media_type == "image/jpeg"
+    assert base64.b64decode(image.data) == image_bytes
+
+
+def test_large_images_are_downscaled():
+    image = prepare_image((IMAGES / "dali.jpg").read_bytes())
+    assert image.media_type == "image/jpeg"
+    assert max(decoded(image).size) == cfg.IMAGE_MAX_EDGE
+
+
+def test_small_pngs_are_reencoded_as_jpeg():
+    png = (IMAGES / "dali.png").read_bytes()
+    image = prepare_image(png)
+    assert image.media_type == "image/jpeg"
+    assert decoded(image).size == Image.open(IMAGES / "dali.png").size
+    assert len(base64.b64decode(image.data)) < len(png) / 4
+
+
+def test_jpegs_over_the_byte_budget_are_reencoded():
+    image_bytes = jpeg((640, 480), quality=100)
+    image = prepare_image(image_bytes, passthrough_bytes=len(image_bytes) - 1)
+    assert base64.b64decode(image.data) != image_bytes
+
+
+def test_masked_image_is_cropped_around_the_mask():
+    base = Image.open(IMAGES / "dali.png").convert("RGB")
+    masked = base.copy()
+    masked.paste((30, 144, 255), (400, 300, 500, 400))
+    images, cropped = prepare_tour_guide_images(encode(base), encode(masked), crop=True)
+    assert cropped
+    assert len(images) == 2
+    # The 100px mask plus a 25% margin on each side, within the mask sampling's rounding.
+    assert all(145 <= edge <= 155 for edge in decoded(images[1]).size)
+
+
+def encode(img):
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("image_bytes", [b"not an image", jpeg((640, 480))[:200]])
+def test_undecodable_images_raise_decode_errors(image_bytes):
+    with pytest.raises(DECODE_ERRORS):
+        prepare_image(image_bytes)
+
+
+def test_tour_guide_reports_undecodable_images(monkeypatch):
+    monkeypatch.setattr(cfg, "LANDMARK_CACHE_ENABLED", False)
+
+    async def run():
+        return [chunk async for chunk in everywhere_tour_guide.run_everywhere_tour_guide(b"garbage", "Rome", 41.9, 12.5)]
+
+    chunks = asyncio.run(run())
+    assert len(chunks) == 1
+    assert json.loads(chunks[0])["type"] == "error"
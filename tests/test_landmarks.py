@@ -0,0 +1,74 @@
+import asyncio
+import json
+from pathlib import Path
+
+from PIL import Image, ImageEnhance
+
+from swag import everywhere_tour_guide
+from swag.landmarks import LandmarkCache, perceptual_hash
+
+IMAGES = Path(__file__).resolve().parent.parent / "imgs"
+
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def test_similar_images_hash_close():
+    image = Image.open(IMAGES / "trevi.jpg")
+    original = perceptual_hash(image)
+    assert 0 <= original < 2 ** 64
+    resized = perceptual_hash(image.resize((image.width // 3, image.height // 3)))
+    brighter = perceptual_hash(ImageEnhance.Brightness(image.convert("RGB")).enhance(1.2))
+    assert distance(original, resized) <= 4
+    assert distance(original, brighter) <= 10
+
+
+def test_different_images_hash_far_apart():
+    trevi = perceptual_hash(Image.open(IMAGES / "trevi.jpg"))
+    dali = perceptual_hash(Image.open(IMAGES / "dali.jpg"))
+    assert distance(trevi, dali) > 10
+
+
+def test_cache_matches_within_the_threshold():
+    cache = LandmarkCache(precision=6, threshold=3, ttl=60, max_entries=10)
+    stored = cache.set(41.9009, 12.4833, 0b1111, masked=False, chunks=["answer"])
+    assert cache.get(41.9009, 12.4833, 0b1000, masked=False) is stored
+    assert cache.get(41.9009, 12.4833, 0b1110000, masked=False) is None
+    assert cache.get(41.9009, 12.4833, 0b1111, masked=True) is None
+
+
+def test_cache_returns_the_closest_match():
+    cache = LandmarkCache(precision=6, threshold=5, ttl=60, max_entries=10)
+    cache.set(41.9009, 12.4833, 0b1111, masked=False, chunks=["far"])
+    close = cache.set(41.9009, 12.4833, 0b0111, masked=False, chunks=["close"])
+    assert cache.get(41.9009, 12.4833, 0b0011, masked=False) is close
+
+
+def test_cache_is_scoped_to_neighbouring_cells():
+    cache = LandmarkCache(precision=6, threshold=3, ttl=60, max_entries=10)
+    cache.set(41.9009, 12.4833, 0b1111, masked=False, chunks=["rome"])
+    assert cache.get(48.8584, 2.2945, 0b1111, masked=False) is None
+
+
+def test_cache_expires_and_evicts():
+    expired = LandmarkCache(precision=6, threshold=3, ttl=-1, max_entries=10)
+    expired.set(41.9, 12.48, 0, masked=False, chunks=["x"])
+    assert expired.get(41.9, 12.48, 0, masked=False) is None
+    assert expired.stats()["entries"] == 0
+
+    bounded = LandmarkCache(precision=6, threshold=0, ttl=60, max_entries=2)
+    for image_hash in range(3):
+        bounded.set(41.9, 12.48, image_hash, masked=False, chunks=[str(image_hash)])
+    assert bounded.get(41.9, 12.48, 0, masked=False) is None
+    assert bounded.get(41.9, 12.48, 2, masked=False) is not None
+
+
+def test_tour_guide_skips_the_cache_for_undecodable_images(monkeypatch):
+    monkeypatch.setattr(everywhere_tour_guide.cfg, "LANDMARK_CACHE_ENABLED", True)
+
+    async def run():
+        return [chunk async for chunk in everywhere_tour_guide.run_everywhere_tour_guide(b"garbage", "Rome", 41.9, 12.5)]
+
+    chunks = asyncio.run(run())
+    assert [json.loads(chunk)["type"] for chunk in chunks] == ["error"]
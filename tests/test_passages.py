@@ -0,0 +1,102 @@
+import asyncio
+import json
+import uuid
+
+from swag.passages import (
+    BM25Index,
+    SearchQueries,
+    current_search_queries,
+    extract_passages,
+    split_passages,
+    tokenize,
+)
+from swag.tools import SearchInternet, ToolRegistry
+
+
+def test_tokenize_drops_stopwords():
+    assert tokenize("Who built the Trevi Fountain?") == ["built", "trevi", "fountain"]
+
+
+def test_bm25_ranks_matching_documents_first():
+    documents = [
+        tokenize("gelato and crowded streets in summer"),
+        tokenize("the sculptor Nicola Salvi designed the fountain"),
+        tokenize("the fountain at night, the fountain by day"),
+    ]
+    scores = BM25Index(documents).scores(tokenize("fountain sculptor"))
+    assert scores[0] == 0
+    assert scores[1] > scores[2] > 0
+
+
+def test_bm25_rare_terms_weigh_more():
+    documents = [tokenize("rome rome salvi"), tokenize("rome rome rome"), tokenize("rome city")]
+    index = BM25Index(documents)
+    assert index.idf["salvi"] > index.idf["rome"]
+
+
+def test_split_passages_respects_the_size():
+    text = "\n\n".join(f"Paragraph {i} " + "word " * 50 for i in range(20))
+    passages = split_passages(text, 600)
+    assert all(len(passage) <= 600 for passage in passages)
+    assert " ".join(passages).split() == text.split()
+
+
+def test_split_passages_starts_a_passage_at_headings():
+    passages = split_passages("intro\n\n# Heading\n\nbody", 1000)
+    assert passages == ["intro", "# Heading\n\nbody"]
+
+
+def test_short_pages_are_returned_whole():
+    result = extract_passages("short page", "https://example.com", "query", max_tokens=100)
+    assert result == "Source: https://example.com\n\nshort page"
+
+
+def _page() -> str:
+    paragraphs = [f"Paragraph {i} about gelato and crowded streets. " + "filler " * 60 for i in range(40)]
+    paragraphs[25] = "The sculptor Nicola Salvi finished the fountain in 1762. " + "filler " * 60
+    return "\n\n".join(paragraphs)
+
+
+def test_extract_passages_returns_the_relevant_passages_within_budget():
+    result = extract_passages(_page(), "https://example.com", "fountain sculptor", max_tokens=300, top_k=3, passage_chars=500)
+    assert "Nicola Salvi" in result
+    assert "most relevant to: fountain sculptor" in result
+    body = result.split("\n\n", 1)[1]
+    assert len(body.replace("\n\n[...]", "")) <= 300 * 4 + 2 * 3
+
+
+def test_extract_passages_without_a_match_returns_the_start_of_the_page():
+    result = extract_passages(_page(), "https://example.com", "volcano", max_tokens=300, top_k=3, passage_chars=500)
+    assert "The first" in result
+    assert "Paragraph 0 " in result
+
+
+def test_search_queries_are_bounded():
+    queries = SearchQueries(max_urls=2)
+    queries.record("a", "qa")
+    queries.record("b", "qb")
+    queries.record("c", "qc")
+    assert queries.get("a") is None
+    assert queries.get("c") == "qc"
+
+
+def test_search_queries_are_recorded_on_cache_hits(monkeypatch):
+    calls = []
+
+    async def search(request):
+        calls.append(request.query)
+        return json.dumps([{"url": "https://example.com/trevi", "title": "Trevi"}])
+
+    monkeypatch.setitem(ToolRegistry.tools, "SearchInternet", (search, SearchInternet))
+    query = f"trevi fountain sculptor {uuid.uuid4().hex[:8]}"
+
+    async def conversation():
+        queries = SearchQueries(max_urls=10)
+        current_search_queries.set(queries)
+        await ToolRegistry.call("SearchInternet", {"query": query})
+        return queries.get("https://example.com/trevi")
+
+    # Each conversation runs in its own task, the second one from the tool cache.
+    assert asyncio.run(conversation()) == query
+    assert asyncio.run(conversation()) == query
+    assert len(calls) == 1
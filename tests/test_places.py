@@ -0,0 +1,99 @@
+import asyncio
+import math
+import random
+
+import pytest
+
+from swag.geo import cells_within, haversine
+from swag.places import PlaceTileCache
+
+
+class FakePlaces:
+    """A fixed set of places around a point, searched like the Places API ranked by distance."""
+
+    def __init__(self, lat, lon, count=200, spread=400.0, seed=0):
+        rng = random.Random(seed)
+        self.places = []
+        for i in range(count):
+            bearing, distance = rng.uniform(0, 2 * math.pi), spread * math.sqrt(rng.random())
+            d_lat = math.degrees(distance * math.cos(bearing) / 6_371_000)
+            d_lon = math.degrees(distance * math.sin(bearing) / (6_371_000 * math.cos(math.radians(lat))))
+            place_type = "cafe" if i % 2 else "museum"
+            self.places.append({
+                "id": f"place-{i}",
+                "types": [place_type],
+                "location": {"latitude": lat + d_lat, "longitude": lon + d_lon},
+            })
+        self.calls = []
+
+    async def fetch(self, lat, lon, radius, types, max_results=20):
+        self.calls.append((lat, lon, radius, tuple(types)))
+        found = [
+            (self._distance(lat, lon, place), place)
+            for place in self.places
+            if set(place["types"]) & set(types) and self._distance(lat, lon, place) <= radius
+        ]
+        return [place for _, place in sorted(found, key=lambda p: p[0])][:max_results]
+
+    def nearest(self, lat, lon, types, radius, max_results):
+        found = [(self._distance(lat, lon, place), place) for place in self.places if set(place["types"]) & set(types)]
+        found = [p for p in found if p[0] <= radius]
+        return [place["id"] for _, place in sorted(found, key=lambda p: p[0])][:max_results]
+
+    @staticmethod
+    def _distance(lat, lon, place):
+        return haversine(lat, lon, place["location"]["latitude"], place["location"]["longitude"])
+
+
+def _cache(fetch, max_fetch_results=20):
+    return PlaceTileCache(fetch, precision=7, ttl=60, max_age=3600, max_entries=1000, max_fetch_results=max_fetch_results)
+
+
+# Rome, Berkeley and Oslo: a 100m search covers 4, 6 and 8 tiles there.
+@pytest.mark.parametrize("lat, lon", [(41.9009, 12.4833), (37.8715, -122.2730), (59.9139, 10.7522)])
+def test_cold_search_makes_one_upstream_call_per_type(lat, lon):
+    places = FakePlaces(lat, lon, count=40, spread=300.0)
+    cache = _cache(places.fetch)
+    assert len(cells_within(lat, lon, 100.0, 7)) > 1
+
+    results = asyncio.run(cache.search(lat, lon, ["cafe", "museum"], 100.0, 10))
+    assert len(places.calls) == 2
+    assert [place["id"] for place in results] == places.nearest(lat, lon, ["cafe", "museum"], 100.0, 10)
+
+    # The same search again, and a nearby one inside the same tiles, come from the cache.
+    asyncio.run(cache.search(lat, lon, ["cafe", "museum"], 100.0, 10))
+    asyncio.run(cache.search(lat, lon, ["cafe"], 50.0, 10))
+    assert len(places.calls) == 2
+    assert cache.stats()["fetches"] == 2
+
+
+def test_capped_fetch_only_caches_tiles_it_covers():
+    lat, lon = 41.9009, 12.4833
+    places = FakePlaces(lat, lon, count=400, spread=300.0, seed=1)
+    cache = _cache(lambda *args: places.fetch(*args, max_results=20), max_fetch_results=20)
+
+    results = asyncio.run(cache.search(lat, lon, ["cafe"], 100.0, 10))
+    assert [place["id"] for place in results] == places.nearest(lat, lon, ["cafe"], 100.0, 10)
+    assert len(places.calls) == 1
+
+    # No tile was covered completely, so nothing is served from an incomplete tile.
+    results = asyncio.run(cache.search(lat, lon, ["cafe"], 100.0, 10))
+    assert [place["id"] for place in results] == places.nearest(lat, lon, ["cafe"], 100.0, 10)
+    assert len(places.calls) == 2
+
+
+def test_concurrent_searches_over_the_same_tiles_share_a_fetch():
+    lat, lon = 41.9009, 12.4833
+    places = FakePlaces(lat, lon, count=40, spread=300.0)
+
+    async def slow_fetch(*args):
+        await asyncio.sleep(0.01)
+        return await places.fetch(*args)
+
+    async def main():
+        cache = _cache(slow_fetch)
+        return await asyncio.gather(*(cache.search(lat, lon, ["cafe"], 100.0, 10) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(places.calls) == 1
+    assert all(result == results[0] for result in results)
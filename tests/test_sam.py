@@ -0,0 +1,118 @@
+from io import BytesIO
+import json
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from swag import sam
+
+
+class FakeBatcher(sam.SamBatcher):
+    """Runs batches without a model: each mask is the job's image size, all True."""
+
+    def __init__(self, **kwargs):
+        self.batches = []
+        self.release = threading.Event()
+        self.running = threading.Event()
+        super().__init__(None, None, **kwargs)
+
+    def _predict_batch(self, predictor, batch):
+        self.running.set()
+        self.release.wait(5)
+        self.batches.append(len(batch))
+        if any(job.img.size == 0 for job in batch):
+            raise ValueError("empty image")
+        return [np.ones(job.img.shape[:2], dtype=bool) for job in batch]
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    monkeypatch.setattr(sam, "make_predictor", lambda model: None)
+    return FakeBatcher(window=0.01, max_batch_size=4, workers=1, max_queue_size=8)
+
+
+def submit(batcher, shape=(4, 6, 3)):
+    return batcher.submit(None, np.zeros(shape, np.uint8), np.array([[1, 1]]), np.array([1]))
+
+
+def test_cancelled_jobs_are_dropped_and_the_worker_keeps_running(batcher):
+    first = submit(batcher)
+    assert batcher.running.wait(5)
+    cancelled, kept = submit(batcher), submit(batcher)
+    assert cancelled.cancel()
+    batcher.release.set()
+    assert first.result(5).shape == (4, 6)
+    assert kept.result(5).shape == (4, 6)
+    assert submit(batcher).result(5).all()
+    assert batcher.batches == [1, 1, 1]
+
+
+def test_a_failed_batch_fails_its_jobs_only(batcher):
+    batcher.release.set()
+    with pytest.raises(ValueError):
+        submit(batcher, shape=(0, 0, 3)).result(5)
+    assert submit(batcher).result(5).shape == (4, 6)
+
+
+def test_full_queue_raises_busy(monkeypatch):
+    monkeypatch.setattr(sam, "make_predictor", lambda model: None)
+    batcher = FakeBatcher(window=0.01, max_batch_size=1, workers=1, max_queue_size=1)
+    submit(batcher)
+    futures = []
+    with pytest.raises(sam.SamBusyError):
+        for _ in range(3):
+            futures.append(submit(batcher))
+    batcher.release.set()
+
+
+def rle_decode(counts, size):
+    values = np.concatenate([np.full(count, i % 2, dtype=bool) for i, count in enumerate(counts)])
+    return values.reshape(size)
+
+
+@pytest.mark.parametrize("corner", [False, True])
+def test_rle_round_trips(corner):
+    mask = np.zeros((5, 7), dtype=bool)
+    mask[1:4, 2:6] = True
+    mask[0, 0] = corner
+    counts = sam.mask_to_rle(mask)
+    assert (counts[0] == 0) == corner
+    assert sum(counts) == mask.size
+    assert (rle_decode(counts, mask.shape) == mask).all()
+
+
+def square_mask():
+    mask = np.zeros((40, 60), dtype=bool)
+    mask[10:30, 20:45] = True
+    return mask
+
+
+def test_encode_result_formats():
+    mask = square_mask()
+    pil_img = Image.new("RGB", (60, 40), "gray")
+    clicks, labels = np.array([[30, 20]]), np.array([1])
+
+    body, media_type = sam.encode_result(pil_img, mask, clicks, labels, "rle")
+    assert media_type == "application/json"
+    rle = json.loads(body)
+    assert rle["size"] == [40, 60]
+    assert (rle_decode(rle["counts"], (40, 60)) == mask).all()
+
+    body, media_type = sam.encode_result(pil_img, mask, clicks, labels, "png")
+    assert media_type == "image/png"
+    assert (np.asarray(Image.open(BytesIO(body))) == mask).all()
+
+    body, media_type = sam.encode_result(pil_img, mask, clicks, labels, "polygons")
+    polygons = json.loads(body)["polygons"]
+    assert len(polygons) == 1
+    xs, ys = zip(*polygons[0])
+    assert (min(xs), min(ys), max(xs), max(ys)) == (20, 10, 44, 29)
+
+    body, media_type = sam.encode_result(pil_img, mask, clicks, labels, "composite")
+    assert media_type == "image/jpeg"
+    assert Image.open(BytesIO(body)).size == (60, 40)
+
+    with pytest.raises(ValueError):
+        sam.encode_result(pil_img, mask, clicks, labels, "svg")
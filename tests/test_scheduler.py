@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import httpx
+
+from swag import config as cfg
+from swag.scheduler import ProviderLimiter, SchedulingTransport, TokenBucket, backoff
+
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    async def main():
+        bucket = TokenBucket(rate=50, burst=5)
+        started = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        for _ in range(5):
+            await bucket.acquire()
+        return burst, time.monotonic() - started
+
+    burst, total = asyncio.run(main())
+    assert burst < 0.02
+    # Five more tokens at 50 per second take about 0.1s.
+    assert 0.08 <= total < 0.3
+
+
+def test_backoff_honours_retry_after():
+    assert backoff(0, "2") == 2.0
+    assert backoff(0, str(cfg.OUTBOUND_BACKOFF_MAX * 10)) == cfg.OUTBOUND_BACKOFF_MAX
+
+
+def test_backoff_without_retry_after_is_jittered_exponential():
+    for attempt in range(6):
+        delay = backoff(attempt, None)
+        assert 0 <= delay <= min(cfg.OUTBOUND_BACKOFF_MAX, cfg.OUTBOUND_BACKOFF_BASE * 2 ** attempt)
+    assert 0 <= backoff(1, "Wed, 21 Oct 2015 07:28:00 GMT") <= cfg.OUTBOUND_BACKOFF_BASE * 2
+
+
+def test_scheduling_transport_retries_rate_limited_requests(monkeypatch):
+    statuses = iter([429, 503, 200])
+    delays = []
+
+    def handler(request):
+        return httpx.Response(next(statuses), headers={"Retry-After": "0.01"}, text="ok")
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    async def main():
+        limiter = ProviderLimiter("test", rate=1000, burst=10, max_concurrency=2)
+        async with httpx.AsyncClient(transport=SchedulingTransport(httpx.MockTransport(handler), limiter)) as client:
+            monkeypatch.setattr(asyncio, "sleep", sleep)
+            response = await client.get("https://example.com")
+        return response, limiter
+
+    response, limiter = asyncio.run(main())
+    assert response.status_code == 200
+    assert delays == [0.01, 0.01]
+    assert limiter.stats()["retries"] == 2
+    assert limiter.stats()["throttled"] == 1
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_scheduling_transport_gives_up_after_max_retries(monkeypatch):
+    async def sleep(delay):
+        pass
+
+    async def main():
+        limiter = ProviderLimiter("test", rate=1000, burst=10, max_concurrency=2)
+        transport = SchedulingTransport(httpx.MockTransport(lambda request: httpx.Response(429)), limiter)
+        async with httpx.AsyncClient(transport=transport) as client:
+            monkeypatch.setattr(asyncio, "sleep", sleep)
+            response = await client.get("https://example.com")
+        return response, limiter
+
+    response, limiter = asyncio.run(main())
+    assert response.status_code == 429
+    assert limiter.stats()["retries"] == cfg.OUTBOUND_MAX_RETRIES
+    assert limiter.stats()["failures"] == 1
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from swag.singleflight import SingleFlight, StreamFlight
+
+
+def test_concurrent_calls_share_one_flight():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        flight = SingleFlight("test")
+        results = await asyncio.gather(*(flight.do("key", fetch) for _ in range(5)))
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert results == ["result"] * 5
+    assert calls == 1
+    assert flight.stats() == {"leaders": 1, "followers": 4, "in_flight": 0}
+
+
+def test_errors_reach_every_caller():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def main():
+        flight = SingleFlight("test")
+        return await asyncio.gather(*(flight.do("key", fail) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_a_cancelled_caller_doesnt_cancel_the_flight():
+    async def main():
+        flight = SingleFlight("test")
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        leader = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "result"
+
+
+async def _chunks(log: list[str]):
+    for i in range(3):
+        await asyncio.sleep(0.01)
+        log.append(f"chunk {i}")
+        yield f"{i}"
+
+
+def test_stream_subscribers_receive_every_chunk():
+    async def main():
+        flight, log = StreamFlight("test"), []
+
+        async def consume():
+            return [chunk async for chunk in flight.stream("key", lambda: _chunks(log))]
+
+        first = asyncio.create_task(consume())
+        await asyncio.sleep(0.015)
+        late = asyncio.create_task(consume())
+        return await first, await late, log, flight.stats()
+
+    first, late, log, stats = asyncio.run(main())
+    assert first == late == ["0", "1", "2"]
+    assert len(log) == 3
+    assert stats == {"leaders": 1, "followers": 1, "in_flight": 0}
+
+
+def test_stream_is_cancelled_when_every_subscriber_leaves():
+    async def main():
+        flight, log = StreamFlight("test"), []
+        stream = flight.stream("key", lambda: _chunks(log))
+        assert await stream.__anext__() == "0"
+        await stream.aclose()
+        await asyncio.sleep(0.05)
+        return log, flight.stats()
+
+    log, stats = asyncio.run(main())
+    assert len(log) < 3
+    assert stats["in_flight"] == 0
@@ -0,0 +1,59 @@
+import json
+
+from main import retrieve_tools
+from swag import config as cfg
+from swag.assistant import Assistant
+from swag.tools import (
+    GetElevation,
+    GetTimeZone,
+    LoadTools,
+    ReadWebsite,
+    SearchInternet,
+    ToolRegistry,
+)
+
+
+def names(models):
+    return [model.__name__ for model in models]
+
+
+def test_search_ranks_the_matching_tool_first():
+    assert ToolRegistry.search("what time zone is Tokyo in", 3)[0] is GetTimeZone
+    assert ToolRegistry.search("how high above sea level is Mont Blanc, its elevation", 3)[0] is GetElevation
+
+
+def test_search_respects_k_and_exclude():
+    found = ToolRegistry.search("time zone elevation of a location", 1, exclude=["GetTimeZone"])
+    assert len(found) == 1
+    assert GetTimeZone not in found
+    assert ToolRegistry.search("zzzz qqqq", 3) == []
+
+
+def test_retrieve_tools_keeps_pinned_and_used_tools():
+    models = retrieve_tools("what time zone is this", used=["GetElevation", "SearchInternet"])
+    tool_names = names(models)
+    assert tool_names[: len(cfg.TOOL_RETRIEVAL_PINNED)] == cfg.TOOL_RETRIEVAL_PINNED
+    assert "GetElevation" in tool_names
+    assert "GetTimeZone" in tool_names
+    assert tool_names[-1] == "LoadTools"
+    assert len(tool_names) == len(set(tool_names))
+
+
+def test_load_tools_adds_new_tools_to_the_assistant():
+    assistant = Assistant(client=None, model="test", tools=[SearchInternet, ReadWebsite, LoadTools])
+    result = json.loads(assistant.load_tools(LoadTools(query="the time zone of a location")))
+    assert "GetTimeZone" in [tool["name"] for tool in result]
+    assert len(result) <= cfg.TOOL_RETRIEVAL_LOAD_K
+    assert "GetTimeZone" in [tool["name"] for tool in assistant.tools]
+    assert "GetTimeZone" in assistant.tool_fns
+
+    # Tools the assistant already has aren't loaded again.
+    again = assistant.load_tools(LoadTools(query="the time zone of a location"))
+    assert "GetTimeZone" not in again
+    assert len(names(assistant.tool_models)) == len(set(names(assistant.tool_models)))
+
+
+def test_load_tools_reports_when_nothing_matches():
+    assistant = Assistant(client=None, model="test", tools=[SearchInternet, LoadTools])
+    assert assistant.load_tools(LoadTools(query="zzzz qqqq")) == "No other relevant tools were found."
+    assert names(assistant.tool_models) == ["SearchInternet", "LoadTools"]
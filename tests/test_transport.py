@@ -0,0 +1,43 @@
+import asyncio
+
+import httpx
+
+from swag.scheduler import ProviderLimiter, SchedulingTransport
+from swag.transport import RedirectTransport
+
+
+def test_redirect_keeps_the_path_under_the_base_url():
+    seen = []
+
+    def handler(request):
+        seen.append((str(request.url), request.headers["Host"]))
+        return httpx.Response(200)
+
+    async def main():
+        transport = RedirectTransport(httpx.MockTransport(handler), "http://127.0.0.1:9000/jina/read")
+        async with httpx.AsyncClient(transport=transport) as client:
+            await client.get("https://r.jina.ai/https://example.com?q=1")
+
+    asyncio.run(main())
+    assert seen == [("http://127.0.0.1:9000/jina/read/https://example.com?q=1", "127.0.0.1:9000")]
+
+
+def test_retries_are_redirected_once(monkeypatch):
+    seen = []
+
+    def handler(request):
+        seen.append(request.url.path)
+        return httpx.Response(503 if len(seen) < 3 else 200)
+
+    async def sleep(delay):
+        pass
+
+    async def main():
+        redirect = RedirectTransport(httpx.MockTransport(handler), "http://127.0.0.1:9000/jina/read")
+        limiter = ProviderLimiter("test", rate=1000, burst=10, max_concurrency=2)
+        async with httpx.AsyncClient(transport=SchedulingTransport(redirect, limiter)) as client:
+            monkeypatch.setattr(asyncio, "sleep", sleep)
+            return await client.get("https://r.jina.ai/page")
+
+    assert asyncio.run(main()).status_code == 200
+    assert seen == ["/jina/read/page"] * 3